@@ -16,71 +16,3157 @@
 
 
 
-import os, sys, time, types, subprocess, signal
-import dbus
+# Imports of anything beyond these cheap modules are done where needed,
+#  as interpreter start-up dominates time to network on slow devices.
+import os, sys, time, struct, errno
 
 iface_base = 'org.bluez'
 iface_dev = '{}.Device1'.format(iface_base)
 iface_adapter = '{}.Adapter1'.format(iface_base)
+iface_net = '{}.Network1'.format(iface_base)
 iface_props = 'org.freedesktop.DBus.Properties'
+iface_objmgr = 'org.freedesktop.DBus.ObjectManager'
 
 class BTError(Exception): pass
 
+class Log(object):
+	'''Minimal stand-in for logging.getLogger() after logging.basicConfig(),
+		with same output format, to avoid importing logging module on start-up.'''
+
+	levels = dict(DEBUG=10, INFO=20, WARNING=30, ERROR=40)
+
+	def __init__(self, level='WARNING'): self.level = self.levels[level]
+
+	def log(self, level, msg, *args, exc_info=False):
+		if self.levels[level] < self.level: return
+		if args: msg = msg % args
+		if exc_info:
+			import traceback
+			msg = '{}\n{}'.format(msg, traceback.format_exc().rstrip())
+		sys.stderr.write('{}:root:{}\n'.format(level, msg))
+
+	def debug(self, msg, *args, **kws): self.log('DEBUG', msg, *args, **kws)
+	def info(self, msg, *args, **kws): self.log('INFO', msg, *args, **kws)
+	def warning(self, msg, *args, **kws): self.log('WARNING', msg, *args, **kws)
+	def error(self, msg, *args, **kws): self.log('ERROR', msg, *args, **kws)
+
+log = Log()
+
+### dbus wire protocol
+
+# Minimal D-Bus client speaking wire protocol directly over the bus socket,
+#  in place of dbus-python + glib bindings, which take large share of memory
+#  and start-up time on small devices. Only covers what this script needs:
+#  method calls (blocking or async), signal subscriptions and name owner tracking.
+
+dbus_bus_name, dbus_bus_path = 'org.freedesktop.DBus', '/org/freedesktop/DBus'
+dbus_default_address = 'unix:path=/var/run/dbus/system_bus_socket'
+dbus_default_timeout = 25.0
+dbus_fixed = dict( # type: (struct format, size/alignment)
+	y=('B', 1), b=('I', 4), n=('h', 2), q=('H', 2), i=('i', 4),
+	u=('I', 4), x=('q', 8), t=('Q', 8), d=('d', 8), h=('I', 4) )
+dbus_align = dict(s=4, o=4, g=1, v=1, a=4)
+dbus_signatures = { # signatures of method args, where guessing from python types fails
+	'org.freedesktop.DBus.Properties.Set': 'ssv' }
+DBUS_METHOD_CALL, DBUS_METHOD_RETURN, DBUS_ERROR, DBUS_SIGNAL = 1, 2, 3, 4
+DBUS_NO_REPLY_EXPECTED = 1
+DBUS_HDR_PATH, DBUS_HDR_INTERFACE, DBUS_HDR_MEMBER, DBUS_HDR_ERROR_NAME = 1, 2, 3, 4
+DBUS_HDR_REPLY_SERIAL, DBUS_HDR_DESTINATION, DBUS_HDR_SENDER, DBUS_HDR_SIGNATURE = 5, 6, 7, 8
+
+class DBusError(Exception):
+
+	def __init__(self, name, msg=''):
+		super(DBusError, self).__init__('{}: {}'.format(name, msg) if msg else name)
+		self.name = name
+
+	def get_dbus_name(self): return self.name
+
+class DBusVariant(object):
+	'Value with explicit signature, for "v" args where guessing it from python type is wrong.'
+	__slots__ = 'signature', 'value'
+	def __init__(self, signature, value): self.signature, self.value = signature, value
+
+def dbus_sig_split(sig):
+	'Splits signature into list of single complete types.'
+	types, start, depth = list(), 0, 0
+	for n, c in enumerate(sig):
+		if c in '({': depth += 1
+		elif c in ')}': depth -= 1
+		if depth or c == 'a': continue
+		types.append(sig[start:n+1])
+		start = n + 1
+	return types
+
+def dbus_sig_guess(v):
+	if isinstance(v, DBusVariant): return v.signature
+	if isinstance(v, bool): return 'b'
+	if isinstance(v, int): return 'i'
+	if isinstance(v, float): return 'd'
+	if isinstance(v, (bytes, bytearray)): return 'ay'
+	if isinstance(v, dict): return 'a{sv}'
+	if isinstance(v, (list, tuple)): return 'as'
+	return 's'
+
+def dbus_type_align(sig):
+	c = sig[0]
+	if c in '({': return 8
+	return dbus_fixed[c][1] if c in dbus_fixed else dbus_align[c]
+
+class DBusWriter(object):
+	'Marshals values into one growing bytearray, little-endian.'
+
+	def __init__(self, buf=None): self.buf = buf if buf is not None else bytearray()
+
+	def pad(self, n): self.buf.extend(bytes(-len(self.buf) % n))
+
+	def write(self, sig, v):
+		c, buf = sig[0], self.buf
+		if c in dbus_fixed:
+			fmt, size = dbus_fixed[c]
+			self.pad(size)
+			buf.extend(struct.pack('<' + fmt, v))
+		elif c in 'so':
+			v = v.encode()
+			self.pad(4)
+			buf.extend(struct.pack('<I', len(v)))
+			buf.extend(v)
+			buf.append(0)
+		elif c == 'g':
+			buf.append(len(v))
+			buf.extend(v.encode())
+			buf.append(0)
+		elif c == 'v':
+			if isinstance(v, DBusVariant): vsig, v = v.signature, v.value
+			else: vsig = dbus_sig_guess(v)
+			self.write('g', vsig)
+			self.write(vsig, v)
+		elif c == 'a':
+			self.pad(4)
+			pos = len(buf)
+			buf.extend(bytes(4))
+			self.pad(dbus_type_align(sig[1:]))
+			start = len(buf)
+			if sig[1] == '{':
+				ksig, vsig = dbus_sig_split(sig[2:-1])
+				for k, kv in v.items():
+					self.pad(8)
+					self.write(ksig, k)
+					self.write(vsig, kv)
+			elif sig[1] == 'y': buf.extend(v)
+			else:
+				for item in v: self.write(sig[1:], item)
+			struct.pack_into('<I', buf, pos, len(buf) - start)
+		elif c == '(':
+			self.pad(8)
+			for item_sig, item in zip(dbus_sig_split(sig[1:-1]), v): self.write(item_sig, item)
+		else: raise ValueError('Unsupported D-Bus type: {!r}'.format(sig))
+
+	def write_all(self, sig, values):
+		for item_sig, v in zip(dbus_sig_split(sig), values): self.write(item_sig, v)
+		return self.buf
+
+class DBusReader(object):
+	'Unmarshals values from buffer in-place, without slicing it into per-message copies.'
+
+	def __init__(self, buf, pos=0, endian='<', base=0):
+		# Alignment is relative to message start at "base" offset
+		self.buf, self.pos, self.endian, self.base = buf, pos, endian, base
+
+	def align(self, n): self.pos += -(self.pos - self.base) % n
+
+	def read(self, sig):
+		c, buf = sig[0], self.buf
+		if c in dbus_fixed:
+			fmt, size = dbus_fixed[c]
+			self.align(size)
+			v, = struct.unpack_from(self.endian + fmt, buf, self.pos)
+			self.pos += size
+			return bool(v) if c == 'b' else v
+		if c in 'so':
+			self.align(4)
+			n, = struct.unpack_from(self.endian + 'I', buf, self.pos)
+			v = bytes(buf[self.pos+4:self.pos+4+n]).decode()
+			self.pos += n + 5
+			return v
+		if c == 'g':
+			n = buf[self.pos]
+			v = bytes(buf[self.pos+1:self.pos+1+n]).decode()
+			self.pos += n + 2
+			return v
+		if c == 'v': return self.read(self.read('g'))
+		if c == 'a':
+			n = self.read('u')
+			self.align(dbus_type_align(sig[1:]))
+			end = self.pos + n
+			if sig[1] == 'y':
+				self.pos = end
+				return bytes(buf[end-n:end])
+			if sig[1] == '{':
+				ksig, vsig = dbus_sig_split(sig[2:-1])
+				items = dict()
+				while self.pos < end:
+					self.align(8)
+					k = self.read(ksig)
+					items[k] = self.read(vsig)
+				return items
+			items = list()
+			while self.pos < end: items.append(self.read(sig[1:]))
+			return items
+		if c == '(':
+			self.align(8)
+			return tuple(self.read(item_sig) for item_sig in dbus_sig_split(sig[1:-1]))
+		raise ValueError('Unsupported D-Bus type: {!r}'.format(sig))
+
+class DBusMessage(object):
+
+	__slots__ = 'mtype', 'flags', 'serial', 'fields', 'body'
+
+	def __init__(self, mtype, flags, serial, fields, body):
+		self.mtype, self.flags, self.serial, self.fields, self.body = mtype, flags, serial, fields, body
+
+	path = property(lambda s: s.fields.get(DBUS_HDR_PATH))
+	interface = property(lambda s: s.fields.get(DBUS_HDR_INTERFACE))
+	member = property(lambda s: s.fields.get(DBUS_HDR_MEMBER))
+	sender = property(lambda s: s.fields.get(DBUS_HDR_SENDER))
+	reply_serial = property(lambda s: s.fields.get(DBUS_HDR_REPLY_SERIAL))
+
+	@staticmethod
+	def build( serial, mtype, path=None, interface=None, member=None,
+			destination=None, signature='', body=(), flags=0, reply_serial=None, error_name=None ):
+		fields = list()
+		for code, sig, v in [
+				(DBUS_HDR_PATH, 'o', path), (DBUS_HDR_INTERFACE, 's', interface),
+				(DBUS_HDR_MEMBER, 's', member), (DBUS_HDR_ERROR_NAME, 's', error_name),
+				(DBUS_HDR_REPLY_SERIAL, 'u', reply_serial),
+				(DBUS_HDR_DESTINATION, 's', destination),
+				(DBUS_HDR_SIGNATURE, 'g', signature or None) ]:
+			if v is not None: fields.append((code, DBusVariant(sig, v)))
+		# Body is marshalled into the same buffer right after header, length patched-in after
+		msg = DBusWriter(bytearray(b'l'))
+		msg.write_all('yyyuua(yv)', [mtype, flags, 1, 0, serial, fields])
+		msg.pad(8)
+		body_pos = len(msg.buf)
+		msg.write_all(signature, body)
+		struct.pack_into('<I', msg.buf, 4, len(msg.buf) - body_pos)
+		return msg.buf
+
+	@staticmethod
+	def parse(buf, pos=0):
+		'Returns (message, end offset) for complete message at buf[pos:] or (None, pos).'
+		if len(buf) - pos < 16: return None, pos
+		endian = '<' if buf[pos] == ord('l') else '>'
+		body_len, serial, fields_len = struct.unpack_from(endian + 'III', buf, pos + 4)
+		body_pos = pos + 16 + fields_len + (-fields_len % 8)
+		if len(buf) < body_pos + body_len: return None, pos
+		fields = dict(DBusReader(buf, pos + 12, endian, pos).read('a(yv)'))
+		reader = DBusReader(buf, body_pos, endian, pos)
+		body = list(reader.read(sig) for sig in dbus_sig_split(fields.get(DBUS_HDR_SIGNATURE, '')))
+		return DBusMessage(buf[pos+1], buf[pos+2], serial, fields, body), body_pos + body_len
+
+class DBusObject(object):
+	'''Remote object proxy. Attribute access returns method of dbus_interface,
+		called as obj.Method(*args, [dbus_interface=..., signature=..., timeout=...,
+		reply_handler=..., error_handler=...]) - blocking unless handlers are passed.'''
+
+	def __init__(self, bus, bus_name, object_path, dbus_interface=None):
+		self.bus, self.bus_name = bus, bus_name
+		self.object_path, self.dbus_interface = object_path, dbus_interface
+
+	def __getattr__(self, member):
+		if member.startswith('_'): raise AttributeError(member)
+		def call(*args, **kws):
+			return self.bus.call( self.bus_name, self.object_path,
+				kws.pop('dbus_interface', self.dbus_interface), member, args, **kws )
+		return call
+
+def dbus_iface(obj, iface):
+	'Same as dbus.Interface(obj, iface) in dbus-python.'
+	return DBusObject(obj.bus, obj.bus_name, obj.object_path, iface)
+
+class DBusConnection(object):
+
+	def __init__(self, address=None):
+		import socket
+		address = address or os.environ.get('DBUS_SYSTEM_BUS_ADDRESS') or dbus_default_address
+		self.sock = None
+		for addr in address.split(';'):
+			transport, params = addr.split(':', 1)
+			params = dict(kv.split('=', 1) for kv in params.split(',') if '=' in kv)
+			if transport != 'unix': continue
+			path = params.get('path') or '\0' + params.get('abstract', '')
+			self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM | socket.SOCK_CLOEXEC)
+			try: self.sock.connect(path)
+			except OSError:
+				self.sock.close()
+				self.sock = None
+			else: break
+		if not self.sock: raise DBusError('org.freedesktop.DBus.Error.NoServer', address)
+		self.sock.sendall(b'\0AUTH EXTERNAL %s\r\n' % str(os.getuid()).encode().hex().encode())
+		line = b''
+		while not line.endswith(b'\r\n'):
+			chunk = self.sock.recv(256)
+			if not chunk: break
+			line += chunk
+		if not line.startswith(b'OK '):
+			raise DBusError('org.freedesktop.DBus.Error.AuthFailed', line.decode().strip())
+		self.sock.sendall(b'BEGIN\r\n')
+		self.serial, self.rbuf, self.queue = 0, bytearray(), list()
+		self.pending, self.matches, self.owners, self.owner_watches = dict(), list(), dict(), dict()
+		self.reader = False
+		self.unique_name = self.call(dbus_bus_name, dbus_bus_path, dbus_bus_name, 'Hello')
+
+	def send(self, **msg):
+		self.serial += 1
+		self.sock.sendall(DBusMessage.build(self.serial, **msg))
+		return self.serial
+
+	def recv(self, block=True, timeout=None):
+		'Reads available data from socket into buffer, returning False on timeout.'
+		import select
+		if not block: timeout = 0
+		if not select.select([self.sock], [], [], timeout)[0]: return False
+		chunk = self.sock.recv(65536)
+		if not chunk: raise DBusError('org.freedesktop.DBus.Error.Disconnected', 'Bus connection closed')
+		self.rbuf.extend(chunk)
+		return True
+
+	def parse(self):
+		msgs, pos = list(), 0
+		while True:
+			msg, pos = DBusMessage.parse(self.rbuf, pos)
+			if not msg: break
+			msgs.append(msg)
+		del self.rbuf[:pos]
+		return msgs
+
+	def call( self, bus_name, path, iface, member, args=(), signature=None,
+			timeout=None, reply_handler=None, error_handler=None ):
+		if signature is None:
+			signature = dbus_signatures.get('{}.{}'.format(iface, member))
+			if signature is None: signature = ''.join(dbus_sig_guess(v) for v in args)
+		serial = self.send( mtype=DBUS_METHOD_CALL, path=path, interface=iface,
+			member=member, destination=bus_name, signature=signature, body=args )
+		if timeout is None: timeout = dbus_default_timeout
+		if reply_handler or error_handler:
+			self.start_reader()
+			timer = loop_call_later(timeout, self.call_timeout, serial)
+			self.pending[serial] = reply_handler, error_handler, timer
+			return
+		deadline = time.monotonic() + timeout
+		while True:
+			reply = None
+			for msg in self.parse(): # anything else gets dispatched from event loop later
+				if msg.reply_serial == serial and msg.mtype in [DBUS_METHOD_RETURN, DBUS_ERROR]: reply = msg
+				else: self.queue.append(msg)
+			if reply:
+				if self.queue and self.reader: loop_call_soon(self.dispatch_queue)
+				if reply.mtype == DBUS_ERROR:
+					raise DBusError(reply.fields.get(DBUS_HDR_ERROR_NAME), *reply.body[:1])
+				return reply.body[0] if len(reply.body) == 1 else (tuple(reply.body) or None)
+			remaining = deadline - time.monotonic()
+			if remaining <= 0 or not self.recv(timeout=remaining):
+				raise DBusError('org.freedesktop.DBus.Error.NoReply', 'Timeout for {}.{}'.format(iface, member))
+
+	def call_timeout(self, serial):
+		reply_handler, error_handler, timer = self.pending.pop(serial, (None, None, None))
+		if error_handler: error_handler(DBusError('org.freedesktop.DBus.Error.NoReply', 'Timeout'))
+
+	def start_reader(self):
+		if self.reader: return
+		loop_add_reader(self.sock.fileno(), self.on_readable)
+		self.reader = True
+		if self.queue: loop_call_soon(self.dispatch_queue)
+
+	def on_readable(self):
+		try:
+			if not self.recv(block=False): return
+		except DBusError as err:
+			log.error('Lost D-Bus connection: %s', err)
+			return loop_stop()
+		self.queue.extend(self.parse())
+		self.dispatch_queue()
+
+	def flush(self):
+		'Dispatches messages received so far, for use outside of the event loop.'
+		while self.recv(block=False): pass
+		self.queue.extend(self.parse())
+		self.dispatch_queue()
+
+	def dispatch_queue(self):
+		queue, self.queue = self.queue, list()
+		for msg in queue:
+			try: self.dispatch(msg)
+			except Exception as err: log.error('Failed to handle D-Bus message: %s', err, exc_info=True)
+
+	def dispatch(self, msg):
+		if msg.mtype in [DBUS_METHOD_RETURN, DBUS_ERROR]:
+			reply_handler, error_handler, timer = self.pending.pop(msg.reply_serial, (None, None, None))
+			if timer: loop_cancel(timer)
+			if msg.mtype == DBUS_ERROR:
+				if error_handler: error_handler(DBusError(msg.fields.get(DBUS_HDR_ERROR_NAME), *msg.body[:1]))
+			elif reply_handler: reply_handler(*msg.body)
+		elif msg.mtype == DBUS_SIGNAL:
+			if msg.member == 'NameOwnerChanged' and msg.interface == dbus_bus_name:
+				name, old, new = msg.body
+				if name in self.owners:
+					self.owners[name] = new
+					for cb in self.owner_watches.get(name, list()): cb(new)
+			for handler, rule in self.matches:
+				if rule['member'] != msg.member or rule['interface'] != msg.interface: continue
+				if rule['path'] and rule['path'] != msg.path: continue
+				if rule['arg0'] is not None and msg.body[:1] != [rule['arg0']]: continue
+				if rule['bus_name'] and msg.sender not in [rule['bus_name'], self.owners.get(rule['bus_name'])]: continue
+				handler(*msg.body, **({rule['path_keyword']: msg.path} if rule['path_keyword'] else {}))
+		elif msg.mtype == DBUS_METHOD_CALL and not msg.flags & DBUS_NO_REPLY_EXPECTED:
+			# Nothing is exported, except for Peer interface that libdbus provides too
+			if msg.interface == 'org.freedesktop.DBus.Peer' and msg.member == 'Ping':
+				self.send(mtype=DBUS_METHOD_RETURN, reply_serial=msg.serial, destination=msg.sender)
+			else:
+				self.send( mtype=DBUS_ERROR, reply_serial=msg.serial, destination=msg.sender,
+					error_name='org.freedesktop.DBus.Error.UnknownMethod', signature='s',
+					body=['No such method: {}.{}'.format(msg.interface, msg.member)] )
+
+	def add_match(self, **rule):
+		rule = ','.join("{}='{}'".format(k, v) for k, v in sorted(rule.items()) if v is not None)
+		self.call(dbus_bus_name, dbus_bus_path, dbus_bus_name, 'AddMatch', [rule])
+
+	def track_owner(self, name):
+		if name in self.owners: return
+		self.add_match( type='signal', sender=dbus_bus_name,
+			interface=dbus_bus_name, member='NameOwnerChanged', arg0=name )
+		try: self.owners[name] = self.call(dbus_bus_name, dbus_bus_path, dbus_bus_name, 'GetNameOwner', [name])
+		except DBusError: self.owners[name] = ''
+
+	def add_signal_receiver( self, handler, signal_name, dbus_interface,
+			bus_name=None, path=None, path_keyword=None, arg0=None ):
+		self.start_reader()
+		if bus_name and not bus_name.startswith(':'): self.track_owner(bus_name)
+		self.add_match( type='signal', sender=bus_name,
+			interface=dbus_interface, member=signal_name, path=path, arg0=arg0 )
+		self.matches.append((handler, dict( member=signal_name, interface=dbus_interface,
+			bus_name=bus_name, path=path, path_keyword=path_keyword, arg0=arg0 )))
+
+	def watch_name_owner(self, name, cb):
+		'Calls cb(unique_name) for current owner of name (from event loop) and on every change.'
+		self.start_reader()
+		self.track_owner(name)
+		self.owner_watches.setdefault(name, list()).append(cb)
+		loop_call_soon(lambda: cb(self.owners[name]))
+
+	def get_object(self, bus_name, path): return DBusObject(self, bus_name, path)
+
+
+### bluez
+
 def get_bus():
 	bus = getattr(get_bus, 'cached_obj', None)
-	if not bus: bus = get_bus.cached_obj = dbus.SystemBus()
+	if not bus: bus = get_bus.cached_obj = DBusConnection()
 	return bus
 
 def get_manager():
 	manager = getattr(get_manager, 'cached_obj', None)
 	if not manager:
-		manager = get_manager.cached_obj = dbus.Interface(
-			get_bus().get_object(iface_base, '/'),
-			'org.freedesktop.DBus.ObjectManager' )
+		manager = get_manager.cached_obj = DBusObject(get_bus(), iface_base, '/', iface_objmgr)
 	return manager
 
 def prop_get(obj, k, iface=None):
+	'Returns property value from object cache, if one is in use, to avoid D-Bus round trip.'
 	if iface is None: iface = obj.dbus_interface
+	objects = getattr(get_objects, 'cached_obj', None)
+	if objects: return objects.get_prop(obj.object_path, iface, k)
 	return obj.Get(iface, k, dbus_interface=iface_props)
 def prop_set(obj, k, v, iface=None):
 	if iface is None: iface = obj.dbus_interface
 	return obj.Set(iface, k, v, dbus_interface=iface_props)
 
+class BTObjectCache(object):
+	'''In-process copy of org.bluez managed objects with address/path indexes.
+		Seeded once from GetManagedObjects, kept current from ObjectManager
+		InterfacesAdded/InterfacesRemoved and PropertiesChanged signals.'''
+
+	def __init__(self, bus):
+		self.objects, self.adapters, self.devices = dict(), dict(), dict()
+		self.prop_handlers = list() # handler(path, iface, changed, invalidated)
+		self.iface_handlers = list() # handler(path, ifaces, added), after cache update
+		# Subscribe before seeding, so that no update falls in-between
+		bus.add_signal_receiver( self.on_iface_added, 'InterfacesAdded',
+			dbus_interface=iface_objmgr, bus_name=iface_base )
+		bus.add_signal_receiver( self.on_iface_removed, 'InterfacesRemoved',
+			dbus_interface=iface_objmgr, bus_name=iface_base )
+		bus.add_signal_receiver( self.on_props, 'PropertiesChanged',
+			dbus_interface=iface_props, bus_name=iface_base, path_keyword='path' )
+		self.seed(get_manager().GetManagedObjects())
+
+	def seed(self, objects):
+		self.objects.clear(), self.adapters.clear(), self.devices.clear()
+		for path, ifaces in objects.items(): self.on_added(path, ifaces)
+
+	def index(self, path, obj):
+		adapter, device = obj.get(iface_adapter), obj.get(iface_dev)
+		if adapter and 'Address' in adapter: self.adapters[adapter['Address']] = path
+		if device and 'Address' in device:
+			self.devices.setdefault(device['Address'], set()).add(path)
+
+	def unindex(self, path, obj):
+		adapter, device = obj.get(iface_adapter), obj.get(iface_dev)
+		if adapter and self.adapters.get(adapter.get('Address')) == path:
+			del self.adapters[adapter['Address']]
+		if device and 'Address' in device:
+			paths = self.devices.get(device['Address'], set())
+			paths.discard(path)
+			if not paths: self.devices.pop(device['Address'], None)
+
+	def on_added(self, path, ifaces):
+		obj = self.objects.setdefault(path, dict())
+		self.unindex(path, obj)
+		for iface, props in ifaces.items(): obj.setdefault(iface, dict()).update(props)
+		self.index(path, obj)
+
+	def on_removed(self, path, ifaces):
+		obj = self.objects.get(path)
+		if obj is None: return
+		self.unindex(path, obj)
+		for iface in ifaces: obj.pop(iface, None)
+		if obj: self.index(path, obj)
+		else: del self.objects[path]
+
+	def on_iface_added(self, path, ifaces):
+		self.on_added(path, ifaces)
+		for handler in self.iface_handlers: handler(path, list(ifaces), True)
+
+	def on_iface_removed(self, path, ifaces):
+		self.on_removed(path, ifaces)
+		for handler in self.iface_handlers: handler(path, ifaces, False)
+
+	def on_props(self, iface, changed, invalidated, path=None):
+		obj = self.objects.get(path)
+		if obj is None or iface not in obj: return
+		reindex = 'Address' in changed or 'Address' in invalidated
+		if reindex: self.unindex(path, obj)
+		obj[iface].update(changed)
+		for k in invalidated: obj[iface].pop(k, None)
+		if reindex: self.index(path, obj)
+		for handler in self.prop_handlers: handler(path, iface, changed, invalidated)
+
+	def get_prop(self, path, iface, k):
+		loop = getattr(get_loop, 'cached_obj', None) # not creating one for one-shot calls
+		if not (loop and loop.is_running()): get_bus().flush() # apply already-received updates
+		props = self.objects.get(path, dict()).get(iface)
+		if props is None or k not in props: # not exported via ObjectManager - fetch all at once
+			props = get_bus().get_object(iface_base, path).GetAll(iface, dbus_interface=iface_props)
+			self.on_added(path, {iface: props})
+			if k not in props: raise DBusError(
+				'org.freedesktop.DBus.Error.InvalidArgs', 'No such property: {}'.format(k) )
+		return props[k]
+
+	def find_adapters(self, pattern=None):
+		if pattern in self.adapters: return [self.adapters[pattern]]
+		return sorted( path for path in self.adapters.values()
+			if not pattern or path.endswith(pattern) )
+
+	def find_devices(self, device_address, path_prefix=''):
+		return sorted( path for path in self.devices.get(device_address, ())
+			if path.startswith(path_prefix) )
+
+def get_objects():
+	objects = getattr(get_objects, 'cached_obj', None)
+	if not objects: objects = get_objects.cached_obj = BTObjectCache(get_bus())
+	return objects
+
 def find_adapter(pattern=None):
-	return find_adapter_in_objects(get_manager().GetManagedObjects(), pattern)
+	return find_adapter_in_objects(get_objects(), pattern)
 
 def find_adapter_in_objects(objects, pattern=None):
 	bus, obj = get_bus(), None
-	for path, ifaces in objects.items():
-		adapter = ifaces.get(iface_adapter)
-		if adapter is None: continue
-		if not pattern or pattern == adapter['Address'] or path.endswith(pattern):
-			obj = bus.get_object(iface_base, path)
-			yield dbus.Interface(obj, iface_adapter)
+	if isinstance(objects, BTObjectCache): paths = objects.find_adapters(pattern)
+	else:
+		paths = list( path for path, ifaces in objects.items()
+			if iface_adapter in ifaces and ( not pattern
+				or pattern == ifaces[iface_adapter]['Address'] or path.endswith(pattern) ) )
+	for path in paths:
+		obj = bus.get_object(iface_base, path)
+		yield dbus_iface(obj, iface_adapter)
 	if obj is None:
 		raise BTError('Bluetooth adapter not found')
 
 def find_device(device_address, adapter_pattern=None):
-	return find_device_in_objects(get_manager().GetManagedObjects(), device_address, adapter_pattern)
+	return find_device_in_objects(get_objects(), device_address, adapter_pattern)
 
 def find_device_in_objects(objects, device_address, adapter_pattern=None):
 	bus = get_bus()
 	path_prefix = ''
 	if adapter_pattern:
 		if not isinstance(adapter_pattern, (str,)): adapter = adapter_pattern
-		else: adapter = find_adapter_in_objects(objects, adapter_pattern)
+		else: adapter = next(iter(find_adapter_in_objects(objects, adapter_pattern)))
 		path_prefix = adapter.object_path
-	for path, ifaces in objects.items():
-		device = ifaces.get(iface_dev)
-		if device is None: continue
-		if device['Address'] == device_address and path.startswith(path_prefix):
-			obj = bus.get_object(iface_base, path)
-			return dbus.Interface(obj, iface_dev)
+	if isinstance(objects, BTObjectCache):
+		paths = objects.find_devices(device_address, path_prefix)
+	else:
+		paths = list( path for path, ifaces in objects.items()
+			if iface_dev in ifaces and ifaces[iface_dev]['Address'] == device_address
+				and path.startswith(path_prefix) )
+	if paths:
+		obj = bus.get_object(iface_base, paths[0])
+		return dbus_iface(obj, iface_dev)
 	raise BTError('Bluetooth device not found')
 
+bt_errors_fatal = set(
+	['{}.Error.{}'.format(iface_base, k) for k in
+		['InvalidArguments', 'NotSupported', 'DoesNotExist', 'NotAuthorized']]
+	+ ['org.freedesktop.DBus.Error.{}'.format(k) for k in
+		['UnknownObject', 'UnknownMethod', 'AccessDenied']] )
+bt_errors_busy = set( '{}.Error.{}'.format(iface_base, k)
+	for k in ['InProgress', 'AlreadyConnected'] )
+
+def bt_error_class(err):
+	'Returns "fatal", "busy" or "transient" for D-Bus exception.'
+	name = err.get_dbus_name()
+	if name in bt_errors_fatal: return 'fatal'
+	if name in bt_errors_busy: return 'busy'
+	return 'transient'
+
+def bt_reset():
+	'''Drops cached bluez proxies and re-seeds object cache, e.g. after bluetoothd restart.
+		Bus connection and signal subscriptions (by well-known name) stay valid.'''
+	get_manager.__dict__.pop('cached_obj', None)
+	objects = getattr(get_objects, 'cached_obj', None)
+	if objects: objects.seed(get_manager().GetManagedObjects())
+
+class BTRestartWatch(object):
+	'''Tracks org.bluez name owner via NameOwnerChanged, calling handler(False)
+		when bluetoothd goes away and handler(True) once it is back,
+		with bt_reset() done and time of the loss in "lost_ts" attribute.'''
+
+	def __init__(self):
+		self.handlers, self.owner, self.lost_ts = list(), None, None
+		get_bus().watch_name_owner(iface_base, self.on_owner)
+
+	def on_owner(self, owner):
+		if not owner:
+			if self.lost_ts is None: self.lost_ts = time.monotonic()
+			log.warning('bluetoothd is gone, waiting for it to come back')
+			stat_inc('bluez_restarts_total')
+			for handler in self.handlers: handler(False)
+		elif self.owner is not None and owner != self.owner:
+			if self.lost_ts is None: self.lost_ts = time.monotonic() # no owner-loss signal
+			log.debug('bluetoothd is back (new owner: %s)', owner)
+			try: bt_reset()
+			except DBusError as err:
+				log.warning('Failed to re-read bluez objects: %s', err)
+			for handler in self.handlers: handler(True)
+			self.lost_ts = None
+		self.owner = owner or self.owner
+
+def get_bt_watch():
+	watch = getattr(get_bt_watch, 'cached_obj', None)
+	if not watch: watch = get_bt_watch.cached_obj = BTRestartWatch()
+	return watch
+
+
+### event loop
+
+# Readers and call_soon() callbacks are only passed to event loop once it is
+#  created, so that one-shot runs, which never start it, don't import asyncio
+loop_deferred = dict(readers=dict(), calls=list())
+
+def get_loop():
+	loop = getattr(get_loop, 'cached_obj', None)
+	if not loop:
+		import asyncio
+		loop = get_loop.cached_obj = asyncio.new_event_loop()
+		asyncio.set_event_loop(loop)
+		for fd, (cb, args) in loop_deferred['readers'].items(): loop.add_reader(fd, cb, *args)
+		for cb, args in loop_deferred['calls']: loop.call_soon(cb, *args)
+		loop_deferred['readers'].clear(), loop_deferred['calls'].clear()
+	return loop
+
+def loop_run(): get_loop().run_forever()
+def loop_stop(): get_loop().stop()
+
+def loop_call_soon(cb, *args):
+	if getattr(get_loop, 'cached_obj', None): get_loop().call_soon(cb, *args)
+	else: loop_deferred['calls'].append((cb, args))
+
+class LoopTimer(object):
+	'Repeating timer, with same cancel() method as asyncio handles.'
+
+	def __init__(self, interval, cb, args):
+		self.interval, self.cb, self.args = interval, cb, args
+		self.handle = get_loop().call_later(interval, self.run)
+
+	def run(self):
+		self.handle = get_loop().call_later(self.interval, self.run)
+		self.cb(*self.args)
+
+	def cancel(self): self.handle.cancel()
+
+def loop_call_later(delay, cb, *args, repeat=False):
+	if repeat: return LoopTimer(delay, cb, args)
+	return get_loop().call_later(delay, cb, *args)
+
+def loop_call_every(interval, cb, *args):
+	return loop_call_later(interval, cb, *args, repeat=True)
+
+def loop_add_reader(fd, cb, *args):
+	if getattr(get_loop, 'cached_obj', None): get_loop().add_reader(fd, cb, *args)
+	else: loop_deferred['readers'][fd] = cb, args
+
+def loop_remove_reader(fd):
+	if getattr(get_loop, 'cached_obj', None): get_loop().remove_reader(fd)
+	else: loop_deferred['readers'].pop(fd, None)
+def loop_add_signal(sig, cb, *args): get_loop().add_signal_handler(sig, cb, *args)
+def loop_cancel(handle): handle.cancel()
+
+
+### rtnetlink
+
+NLMSG_ERROR, NLMSG_DONE = 2, 3
+NLM_F_REQUEST, NLM_F_ACK = 1, 4
+NLM_F_REPLACE, NLM_F_EXCL, NLM_F_CREATE, NLM_F_DUMP = 0x100, 0x200, 0x400, 0x300
+NLA_F_NESTED = 0x8000
+RTM_NEWLINK, RTM_DELLINK, RTM_GETLINK = 16, 17, 18
+RTM_NEWADDR, RTM_NEWROUTE = 20, 24
+RTMGRP_LINK = 1
+AF_BRIDGE = 7
+IFF_UP = 1
+IFLA_ADDRESS, IFLA_IFNAME, IFLA_MASTER, IFLA_LINKINFO = 1, 3, 10, 18
+IFLA_INFO_KIND, IFLA_INFO_DATA = 1, 2
+IFLA_BR_FORWARD_DELAY, IFLA_BR_STP_STATE = 1, 5
+IFA_ADDRESS, IFA_LOCAL = 1, 2
+RTA_OIF, RTA_GATEWAY = 4, 5
+RT_TABLE_MAIN, RTPROT_BOOT, RT_SCOPE_UNIVERSE, RTN_UNICAST = 254, 3, 0, 1
+
+def nl_attr(atype, data):
+	'''Encodes netlink attribute. data can be bytes, str (encoded
+		as NUL-terminated), int (u32) or list of (atype, data) for nested attrs.'''
+	if isinstance(data, str): data = data.encode() + b'\0'
+	elif isinstance(data, int): data = struct.pack('I', data)
+	elif isinstance(data, list):
+		data, atype = b''.join(nl_attr(*a) for a in data), atype | NLA_F_NESTED
+	return struct.pack('HH', 4 + len(data), atype) + data + b'\0' * (-len(data) % 4)
+
+def nl_attrs(buf, offset=0):
+	attrs = dict()
+	while offset + 4 <= len(buf):
+		alen, atype = struct.unpack_from('HH', buf, offset)
+		if alen < 4: break
+		attrs[atype & 0x3fff] = buf[offset+4:offset+alen]
+		offset += (alen + 3) & ~3
+	return attrs
+
+def nl_link_msg(index=0, flags=0, change=0, attrs=(), family=0):
+	return ( struct.pack('BxHiII', family, 0, index, flags, change)
+		+ b''.join(nl_attr(*a) for a in attrs) )
+
+def nl_link_parse(payload):
+	family, itype, index, flags, change = struct.unpack_from('BxHiII', payload)
+	attrs = nl_attrs(payload, 16)
+	link = dict( family=family, index=index, flags=flags, attrs=attrs,
+		name=attrs.get(IFLA_IFNAME, b'').rstrip(b'\0').decode(), master=0, kind=None )
+	if IFLA_MASTER in attrs: link['master'] = struct.unpack('I', attrs[IFLA_MASTER])[0]
+	if IFLA_LINKINFO in attrs:
+		kind = nl_attrs(attrs[IFLA_LINKINFO]).get(IFLA_INFO_KIND)
+		if kind: link['kind'] = kind.rstrip(b'\0').decode()
+	return link
+
+class RTNetlink(object):
+
+	def __init__(self, groups=0):
+		import socket
+		self.sock = socket.socket( socket.AF_NETLINK,
+			socket.SOCK_RAW | socket.SOCK_CLOEXEC, socket.NETLINK_ROUTE )
+		self.sock.bind((0, groups))
+		self.seq = 0
+
+	def fileno(self): return self.sock.fileno()
+
+	def recv(self):
+		buf, msgs, offset = self.sock.recv(65536), list(), 0
+		while offset + 16 <= len(buf):
+			mlen, mtype, flags, seq, pid = struct.unpack_from('IHHII', buf, offset)
+			if mlen < 16: break
+			msgs.append((mtype, flags, seq, buf[offset+16:offset+mlen]))
+			offset += (mlen + 3) & ~3
+		return msgs
+
+	def request(self, msgs, ignore=()):
+		'''Sends list of (type, flags, payload) messages in one batch
+			and waits for all acks/dumps, returning list of (type, payload) replies.
+			First error (with errno not in ignore) is raised as OSError.'''
+		buf, pending = list(), set()
+		for mtype, flags, payload in msgs:
+			self.seq += 1
+			buf.append(struct.pack( 'IHHII', 16 + len(payload),
+				mtype, flags | NLM_F_REQUEST | NLM_F_ACK, self.seq, 0 ))
+			buf.append(payload)
+			pending.add(self.seq)
+		self.sock.send(b''.join(buf))
+		replies, err = list(), None
+		while pending:
+			for mtype, flags, seq, payload in self.recv():
+				if seq not in pending: continue
+				if mtype == NLMSG_ERROR:
+					code = -struct.unpack_from('i', payload)[0]
+					if code and code not in ignore and not err: err = code
+					pending.discard(seq)
+				elif mtype == NLMSG_DONE: pending.discard(seq)
+				else: replies.append((mtype, payload))
+		if err: raise OSError(err, 'Netlink request failed: {}'.format(os.strerror(err)))
+		return replies
+
+def get_rtnl():
+	nl = getattr(get_rtnl, 'cached_obj', None)
+	if not nl: nl = get_rtnl.cached_obj = RTNetlink()
+	return nl
+
+def nl_link_get(name):
+	try: replies = get_rtnl().request([(RTM_GETLINK, 0, nl_link_msg(attrs=[(IFLA_IFNAME, name)]))])
+	except OSError as err:
+		if err.errno == errno.ENODEV: return None
+		raise
+	return nl_link_parse(replies[0][1])
+
+def nl_addr_msg(index, addr):
+	import ipaddress, socket
+	addr = ipaddress.ip_interface(addr)
+	family = socket.AF_INET if addr.version == 4 else socket.AF_INET6
+	return struct.pack( 'BBBBI', family, addr.network.prefixlen, 0, 0, index ) \
+		+ nl_attr(IFA_LOCAL, addr.ip.packed) + nl_attr(IFA_ADDRESS, addr.ip.packed)
+
+def nl_route_msg(index, gw, dst=None):
+	import ipaddress, socket
+	gw = ipaddress.ip_address(gw)
+	dst = ipaddress.ip_network(dst or ('0.0.0.0/0' if gw.version == 4 else '::/0'))
+	family = socket.AF_INET if gw.version == 4 else socket.AF_INET6
+	attrs = [(RTA_GATEWAY, gw.packed), (RTA_OIF, index)]
+	if dst.prefixlen: attrs.append((1, dst.network_address.packed)) # RTA_DST
+	return struct.pack( 'BBBBBBBBI', family, dst.prefixlen, 0, 0,
+		RT_TABLE_MAIN, RTPROT_BOOT, RT_SCOPE_UNIVERSE, RTN_UNICAST, 0 ) \
+		+ b''.join(nl_attr(*a) for a in attrs)
+
+def bridge_setup(name, addr=None, gw=None, ports=()):
+	'''Creates bridge (if missing), same as "brctl addbr/setfd 0/stp off",
+		then enslaves ports, adds address, brings it up and adds default route
+		in one batched netlink request. Already existing addr/route are left as-is.'''
+	nl = get_rtnl()
+	br_info = (IFLA_LINKINFO, [ (IFLA_INFO_KIND, 'bridge'),
+		(IFLA_INFO_DATA, [(IFLA_BR_FORWARD_DELAY, 0), (IFLA_BR_STP_STATE, 0)]) ])
+	br = nl_link_get(name)
+	if not br:
+		nl.request([( RTM_NEWLINK, NLM_F_CREATE | NLM_F_EXCL,
+			nl_link_msg(attrs=[(IFLA_IFNAME, name), br_info]) )])
+		br = nl_link_get(name)
+		log.debug('Created bridge interface: %s', name)
+	elif br['kind'] != 'bridge':
+		raise BTError('Interface {} exists, but is not a bridge ({})'.format(name, br['kind']))
+	msgs = list()
+	for port in ports:
+		msgs.append(( RTM_NEWLINK, 0,
+			nl_link_msg(attrs=[(IFLA_IFNAME, port), (IFLA_MASTER, br['index'])]) ))
+	if addr: msgs.append((RTM_NEWADDR, NLM_F_CREATE | NLM_F_EXCL, nl_addr_msg(br['index'], addr)))
+	msgs.append((RTM_NEWLINK, 0, nl_link_msg(br['index'], IFF_UP, IFF_UP)))
+	if gw: msgs.append((RTM_NEWROUTE, NLM_F_CREATE | NLM_F_EXCL, nl_route_msg(br['index'], gw)))
+	nl.request(msgs, ignore=[errno.EEXIST])
+	return br
+
+class LinkMonitor(RTNetlink):
+	'''Dispatches RTM_NEWLINK/RTM_DELLINK events from the event loop
+		to handlers, called as handler(event, link) with link from nl_link_parse().'''
+
+	def __init__(self):
+		super(LinkMonitor, self).__init__(RTMGRP_LINK)
+		self.handlers = list()
+		loop_add_reader(self.fileno(), self.dispatch)
+
+	def dispatch(self):
+		try: msgs = self.recv()
+		except OSError as err: # ENOBUFS - events were lost
+			log.warning('Netlink link monitor error: %s', err)
+			return
+		for mtype, flags, seq, payload in msgs:
+			if mtype not in [RTM_NEWLINK, RTM_DELLINK]: continue
+			link = nl_link_parse(payload)
+			if link['family'] == AF_BRIDGE: continue # port state notifications
+			for handler in self.handlers: handler(mtype, link)
+
+def get_link_monitor():
+	mon = getattr(get_link_monitor, 'cached_obj', None)
+	if not mon: mon = get_link_monitor.cached_obj = LinkMonitor()
+	return mon
+
+
+### metrics
+
+stats = dict() # {(name, labels): value}, names ending in _total are counters
+stats_hist = dict() # {(name, labels): [buckets, counts, sum, count]}
+
+def stat_inc(name, v=1, **labels):
+	k = name, tuple(sorted(labels.items()))
+	stats[k] = stats.get(k, 0) + v
+
+def stat_set(name, v, **labels):
+	stats[name, tuple(sorted(labels.items()))] = v
+
+def stat_observe(name, v, buckets, **labels):
+	'''Adds value to histogram, buckets being a sorted sequence of upper bounds.'''
+	k = name, tuple(sorted(labels.items()))
+	h = stats_hist.get(k)
+	if not h: h = stats_hist[k] = [buckets, [0] * len(buckets), 0, 0]
+	for n, le in enumerate(h[0]):
+		if v <= le: h[1][n] += 1
+	h[2], h[3] = h[2] + v, h[3] + 1
+
+def stats_drop(**labels):
+	'''Removes all stats with specified label values, e.g. for a gone interface.'''
+	labels = set(labels.items())
+	for st in stats, stats_hist:
+		for k in list(st):
+			if labels.issubset(k[1]): del st[k]
+
+stats_collectors = list() # called before rendering stats, to update them on-demand
+
+def stats_text():
+	'''Renders stats in prometheus text exposition format.'''
+	for collector in stats_collectors: collector()
+	lines, seen = list(), set()
+	for (name, labels), v in sorted(stats.items()):
+		if name not in seen:
+			seen.add(name)
+			lines.append('# TYPE btnap_{} {}'.format(
+				name, 'counter' if name.endswith('_total') else 'gauge' ))
+		labels = ','.join('{}="{}"'.format(k, v) for k, v in labels if v is not None)
+		lines.append('btnap_{}{} {}'.format(name, '{{{}}}'.format(labels) if labels else '', v))
+	for (name, labels), (buckets, counts, v_sum, v_count) in sorted(stats_hist.items()):
+		if name not in seen:
+			seen.add(name)
+			lines.append('# TYPE btnap_{} histogram'.format(name))
+		labels = ''.join('{}="{}",'.format(k, v) for k, v in labels if v is not None)
+		for le, n in zip(list(buckets) + ['+Inf'], counts + [v_count]):
+			lines.append('btnap_{}_bucket{{{}le="{}"}} {}'.format(name, labels, le, n))
+		labels = labels and '{{{}}}'.format(labels.rstrip(','))
+		lines.append('btnap_{}_sum{} {}'.format(name, labels, v_sum))
+		lines.append('btnap_{}_count{} {}'.format(name, labels, v_count))
+	return '\n'.join(lines) + '\n'
+
+def stats_dump(): sys.stderr.write(stats_text())
+
+class MetricsServer(object):
+	'''Serves stats_text() over HTTP/1.0 for prometheus scrapes.
+		Address is either "unix:/path" or "[host]:port", host defaulting to localhost.'''
+
+	def __init__(self, addr):
+		import socket
+		if addr.startswith('unix:'):
+			addr, self.sock = addr[5:], socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+			try: os.unlink(addr)
+			except FileNotFoundError: pass
+		else:
+			host, port = addr.rsplit(':', 1)
+			family, stype, proto, cname, addr = socket.getaddrinfo(
+				host.strip('[]') or 'localhost', int(port), type=socket.SOCK_STREAM )[0]
+			self.sock = socket.socket(family, stype)
+			self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self.sock.bind(addr)
+		self.sock.listen(8)
+		self.sock.setblocking(False)
+		loop_add_reader(self.sock.fileno(), self.accept)
+
+	def accept(self):
+		try: conn, addr = self.sock.accept()
+		except BlockingIOError: return
+		with conn:
+			conn.settimeout(0.5)
+			try:
+				conn.recv(4096) # request is not parsed, any path returns same stats
+				body = stats_text().encode()
+				conn.sendall( b'HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n'
+					b'Content-Length: %d\r\n\r\n' % len(body) + body )
+			except OSError as err: log.debug('Failed to send metrics: %s', err)
+
+
+### bnep ports
+
+AF_BLUETOOTH, BTPROTO_BNEP = 31, 4
+BNEPGETCONNLIST = 0x800442d2 # _IOR('B', 210, int)
+IFLA_STATS64 = 23
+
+def bnep_connections():
+	'''Returns {ifname: remote_addr} for kernel BNEP sessions or empty dict if unavailable.'''
+	import socket, fcntl, ctypes
+	class bnep_connlist_req(ctypes.Structure):
+		_fields_ = [('cnum', ctypes.c_uint32), ('ci', ctypes.c_void_p)]
+	ci_size, ci_max = 32, 64 # sizeof(struct bnep_conninfo), max sessions to query
+	ci = ctypes.create_string_buffer(ci_size * ci_max)
+	req = bnep_connlist_req(ci_max, ctypes.addressof(ci))
+	try:
+		with socket.socket(AF_BLUETOOTH, socket.SOCK_RAW, BTPROTO_BNEP) as sock:
+			fcntl.ioctl(sock.fileno(), BNEPGETCONNLIST, req)
+	except OSError as err:
+		log.debug('Failed to query BNEP connections: %s', err)
+		return dict()
+	conns = dict()
+	for n in range(req.cnum):
+		conn = ci.raw[n*ci_size:(n+1)*ci_size]
+		name = conn[14:30].split(b'\0', 1)[0].decode()
+		conns[name] = ':'.join('{:02X}'.format(b) for b in conn[8:14])
+	return conns
+
+def nl_links():
+	return list( nl_link_parse(payload) for mtype, payload in
+		get_rtnl().request([(RTM_GETLINK, NLM_F_DUMP, nl_link_msg())]) )
+
+class BNEPStats(object):
+	'''Samples rx/tx counters of all bnep ports on the bridge
+		from one RTM_GETLINK dump, tracking per-port rates and remote device addresses.
+		Handlers are called as handler(bnep_stats) after each sample.'''
+
+	counters = [ 'rx_packets', 'tx_packets', 'rx_bytes', 'tx_bytes',
+		'rx_errors', 'tx_errors', 'rx_dropped', 'tx_dropped' ]
+	rates = ['rx_packets', 'tx_packets', 'rx_bytes', 'tx_bytes']
+
+	def __init__(self, bridge, interval):
+		self.bridge, self.ports, self.handlers = bridge, dict(), list()
+		self.sample()
+		loop_call_every(interval, self.sample)
+
+	def sample(self):
+		ts, links = time.monotonic(), nl_links()
+		br = list(link['index'] for link in links if link['name'] == self.bridge)
+		ports, remotes = dict(), None
+		for link in links:
+			name = link['name']
+			if not br or link['master'] != br[0] or not name.startswith('bnep'): continue
+			port = self.ports.get(name)
+			if not port or port['index'] != link['index']:
+				if remotes is None: remotes = bnep_connections()
+				port = dict( index=link['index'], remote=remotes.get(name),
+					local=':'.join('{:02X}'.format(b) for b in link['attrs'].get(IFLA_ADDRESS, b'')) )
+				log.debug('Tracking bnep port %s (remote: %s)', name, port['remote'])
+			counters = dict(zip( self.counters,
+				struct.unpack_from('8Q', link['attrs'][IFLA_STATS64]) ))
+			port['rates'] = dict()
+			if 'counters' in port:
+				td = ts - port['ts']
+				for k in self.rates: port['rates'][k] = (counters[k] - port['counters'][k]) / td
+			port.update(ts=ts, counters=counters)
+			for k, v in counters.items():
+				stat_set('bnep_{}_total'.format(k), v, iface=name, remote=port['remote'])
+			for k, v in port['rates'].items():
+				stat_set('bnep_{}_per_second'.format(k), round(v, 1), iface=name, remote=port['remote'])
+			ports[name] = port
+		for name in set(self.ports).difference(ports):
+			log.debug('Bnep port %s is gone', name)
+			stats_drop(iface=name)
+		self.ports = ports
+		stat_set('bnep_ports', len(ports))
+		for handler in self.handlers: handler(self)
+
+
+### qdisc
+
+RTM_NEWQDISC, RTM_GETQDISC = 36, 38
+TC_H_ROOT = 0xffffffff
+TCA_KIND, TCA_OPTIONS, TCA_STATS2, TCA_STATS_QUEUE = 1, 2, 7, 3
+TCA_FQ_CODEL_TARGET, TCA_FQ_CODEL_INTERVAL, TCA_FQ_CODEL_QUANTUM = 1, 3, 6
+TCA_CAKE_BASE_RATE64 = 2
+
+def nl_qdisc_msg(index, kind=None, options=()):
+	attrs = list()
+	if kind: attrs.append((TCA_KIND, kind))
+	if options: attrs.append((TCA_OPTIONS, list(options)))
+	return ( struct.pack('BxxxiIII', 0, index, 0, TC_H_ROOT, 0)
+		+ b''.join(nl_attr(*a) for a in attrs) )
+
+def nl_qdiscs():
+	'Returns {ifindex: qdisc} for root qdiscs, with kind and queue stats.'
+	qdiscs = dict()
+	for mtype, payload in get_rtnl().request([(RTM_GETQDISC, NLM_F_DUMP, nl_qdisc_msg(0))]):
+		family, index, handle, parent, info = struct.unpack_from('BxxxiIII', payload)
+		if parent != TC_H_ROOT: continue
+		attrs = nl_attrs(payload, 20)
+		qdisc = dict(kind=attrs.get(TCA_KIND, b'').rstrip(b'\0').decode())
+		queue = nl_attrs(attrs.get(TCA_STATS2, b'')).get(TCA_STATS_QUEUE)
+		if queue: qdisc.update(zip( ['qlen', 'backlog', 'drops',
+			'requeues', 'overlimits'], struct.unpack_from('5I', queue) ))
+		qdiscs[index] = qdisc
+	return qdiscs
+
+class PortQdisc(object):
+	'''Attaches fq_codel or cake qdisc as root of every bnep port on the bridge,
+		as soon as link monitor reports it. Rate (bytes/s) is cake shaper bandwidth,
+		or used to pick fq_codel target above one full-size packet transmission time.
+		update(bnep_stats) adjusts cake rate to measured link capacity - tx rate
+		while packets are queued in qdisc, as bnep device stops its queue when its
+		L2CAP socket backs up - probing upwards while the shaper is the bottleneck.'''
+
+	rate_min, rate_max = 100e3 / 8, 3e6 / 8 # BR/EDR ACL throughput range
+	rate_step_up, rate_margin = 1.05, 0.9
+
+	def __init__(self, bridge_index, kind, rate):
+		self.bridge_index, self.kind, self.rate = bridge_index, kind, rate
+		self.ports = dict() # {index: {name, rate, drops, overlimits}}
+
+	def options(self, rate):
+		if self.kind == 'cake': return [(TCA_CAKE_BASE_RATE64, struct.pack('Q', int(rate)))]
+		target = max(5000, int(1.5 * 1514 / rate * 1e6)) # us
+		return [ (TCA_FQ_CODEL_TARGET, target),
+			(TCA_FQ_CODEL_INTERVAL, max(100000, target * 20)), (TCA_FQ_CODEL_QUANTUM, 300) ]
+
+	def on_link(self, event, link):
+		if not link['name'].startswith('bnep'): return
+		if event == RTM_DELLINK or link['master'] != self.bridge_index:
+			self.ports.pop(link['index'], None)
+			return
+		if link['index'] in self.ports: return
+		ts = time.monotonic()
+		try:
+			get_rtnl().request([( RTM_NEWQDISC, NLM_F_CREATE | NLM_F_REPLACE,
+				nl_qdisc_msg(link['index'], self.kind, self.options(self.rate)) )])
+		except OSError as err:
+			return log.error('Failed to attach %s qdisc to %s: %s', self.kind, link['name'], err)
+		td = time.monotonic() - ts
+		self.ports[link['index']] = dict(name=link['name'], rate=self.rate, drops=0, overlimits=0)
+		stat_set('qdisc_attach_seconds', round(td, 6))
+		log.debug('Attached %s qdisc to %s in %.1fms', self.kind, link['name'], td * 1e3)
+
+	def set_rate(self, index, port, rate):
+		rate = int(min(self.rate_max, max(self.rate_min, rate)))
+		if abs(rate - port['rate']) < port['rate'] * 0.02: return
+		try:
+			get_rtnl().request([(RTM_NEWQDISC, 0, nl_qdisc_msg(index, self.kind, self.options(rate)))])
+		except OSError as err:
+			return log.warning('Failed to update %s qdisc rate: %s', port['name'], err)
+		log.debug( 'Changed %s qdisc rate on %s: %.0f -> %.0f kbit/s',
+			self.kind, port['name'], port['rate'] * 8e-3, rate * 8e-3 )
+		port['rate'] = rate
+
+	def update(self, bnep_stats):
+		qdiscs = nl_qdiscs()
+		for port in bnep_stats.ports.values():
+			index, remote = port['index'], port['remote']
+			qp, qdisc = self.ports.get(index), qdiscs.get(index)
+			if not qp or not qdisc or qdisc['kind'] != self.kind: continue
+			name, drops, overlimits = qp['name'], qdisc['drops'], qdisc['overlimits']
+			stat_set('qdisc_backlog_bytes', qdisc['backlog'], iface=name, remote=remote)
+			stat_set('qdisc_drops_total', drops, iface=name, remote=remote)
+			if self.kind == 'cake' and 'tx_bytes' in port['rates']:
+				tx, rate = port['rates']['tx_bytes'], qp['rate']
+				if qdisc['backlog'] and tx < rate * self.rate_margin:
+					self.set_rate(index, qp, tx * self.rate_margin) # link is the bottleneck
+				elif overlimits > qp['overlimits'] and tx >= rate * self.rate_margin:
+					self.set_rate(index, qp, rate * self.rate_step_up) # shaper is
+				stat_set('qdisc_rate_bits_per_second', qp['rate'] * 8, iface=name, remote=remote)
+			qp.update(drops=drops, overlimits=overlimits)
+
+
+### bridge policy
+
+RTM_SETLINK = 19
+IFLA_PROTINFO = 12
+IFLA_BRPORT_NEIGH_SUPPRESS, IFLA_BRPORT_ISOLATED = 32, 33
+mcast_chatter = dict(mdns='5353', ssdp='1900', llmnr='5355', netbios='{ 137, 138 }') # udp ports
+
+def nl_brport_msg(index, flags):
+	'RTM_SETLINK message payload to set {IFLA_BRPORT_*: bool} flags on bridge port.'
+	return nl_link_msg( index, family=AF_BRIDGE,
+		attrs=[(IFLA_PROTINFO, list((k, struct.pack('B', v)) for k, v in flags.items()))] )
+
+def nft_run(script=None, *args):
+	'Runs nft with script on stdin or args, returning its stdout.'
+	import subprocess
+	try:
+		proc = subprocess.run( ['nft'] + (['-f', '-'] if script else list(args)),
+			input=script and script.encode(), stdout=subprocess.PIPE, stderr=subprocess.PIPE )
+	except OSError as err: raise BTError('Failed to run nft: {}'.format(err))
+	if proc.returncode: raise BTError('nft failed: {}'.format(proc.stderr.decode().strip()))
+	return proc.stdout
+
+class BridgePolicy(object):
+	'''Traffic policy for bnep ports on the bridge, to save airtime on bluetooth links.
+		Port flags are set from link monitor events: "isolated" stops client-to-client
+		traffic (ports can still reach bridge itself and non-isolated uplinks),
+		"neigh_suppress" makes bridge answer ARP/ND requests for clients from its
+		neighbour table, without flooding them over links. Multicast chatter (mDNS,
+		SSDP, LLMNR, NetBIOS) to bnep ports is dropped or rate-limited per port via
+		nftables bridge table, with counters exported as saved bytes and airtime.'''
+
+	nft_table = 'btnap'
+
+	def __init__(self, bridge_index, isolate=False, neigh_suppress=False,
+			mcast_filter=(), mcast_limit=0, link_rate=None ):
+		self.bridge_index, self.link_rate, self.ports = bridge_index, link_rate, set()
+		self.flags = dict()
+		if isolate: self.flags[IFLA_BRPORT_ISOLATED] = True
+		if neigh_suppress: self.flags[IFLA_BRPORT_NEIGH_SUPPRESS] = True
+		self.mcast_filter, self.mcast_limit = list(mcast_filter), mcast_limit
+
+	def ruleset(self):
+		rules = list()
+		for proto in self.mcast_filter:
+			match = 'oifname "bnep*" udp dport {}'.format(mcast_chatter[proto])
+			if self.mcast_limit: match += ( ' meter {}_limit {{ oifname limit'
+				' rate over {}/second }}' ).format(proto, self.mcast_limit)
+			rules.append('\t\t{} counter drop comment "{}"'.format(match, proto))
+		return ( 'table bridge {0}\ndelete table bridge {0}\n'
+			'table bridge {0} {{\n\tchain forward {{\n'
+			'\t\ttype filter hook forward priority 0; policy accept;\n{1}\n\t}}\n}}\n'
+			).format(self.nft_table, '\n'.join(rules))
+
+	def start(self):
+		if self.flags:
+			get_link_monitor().handlers.append(self.on_link)
+			for link in nl_links(): self.on_link(RTM_NEWLINK, link)
+		if self.mcast_filter:
+			try: nft_run(self.ruleset())
+			except BTError as err:
+				log.error('Failed to set up multicast filter, continuing without it: %s', err)
+				self.mcast_filter = list()
+			else: stats_collectors.append(self.collect)
+		log.debug( 'Bridge policy: port flags=%s, mcast filter=%s (%s)', self.flags,
+			self.mcast_filter, '{}/s limit'.format(self.mcast_limit) if self.mcast_limit else 'drop' )
+
+	def stop(self):
+		if not self.mcast_filter: return
+		try: nft_run(None, 'delete', 'table', 'bridge', self.nft_table)
+		except BTError as err: log.warning('Failed to remove nftables table: %s', err)
+
+	def on_link(self, event, link):
+		if not link['name'].startswith('bnep'): return
+		if event == RTM_DELLINK or link['master'] != self.bridge_index:
+			self.ports.discard(link['index'])
+			return
+		if link['index'] in self.ports: return
+		try: get_rtnl().request([(RTM_SETLINK, 0, nl_brport_msg(link['index'], self.flags))])
+		except OSError as err:
+			return log.error('Failed to set bridge port flags on %s: %s', link['name'], err)
+		self.ports.add(link['index'])
+		log.debug('Applied bridge port policy to %s', link['name'])
+
+	def collect(self):
+		import json
+		try: ruleset = json.loads(nft_run(None, '-j', 'list', 'table', 'bridge', self.nft_table))
+		except (BTError, ValueError) as err:
+			return log.warning('Failed to read nftables counters: %s', err)
+		for item in ruleset.get('nftables', list()):
+			rule = item.get('rule')
+			if not rule or rule.get('comment') not in mcast_chatter: continue
+			for expr in rule['expr']:
+				if 'counter' not in expr: continue
+				proto, counter = rule['comment'], expr['counter']
+				stat_set('bridge_filtered_packets_total', counter['packets'], proto=proto)
+				stat_set('bridge_filtered_bytes_total', counter['bytes'], proto=proto)
+				if self.link_rate: stat_set( 'bridge_filtered_airtime_seconds_total',
+					round(counter['bytes'] / self.link_rate, 3), proto=proto )
+
+
+### router
+
+def sysctl_set(name, value):
+	'Sets sysctl value, returning old one.'
+	path = '/proc/sys/{}'.format(name.replace('.', '/'))
+	with open(path, 'r+') as f:
+		old = f.read().strip()
+		if old != str(value):
+			f.seek(0)
+			f.write(str(value))
+	return old
+
+class Router(object):
+	'''Routed mode for the bridge: IPv4 forwarding between it and uplink interface,
+		with masquerade for traffic from the bridge and nftables flowtable, which moves
+		established TCP/UDP flows to the fast path (skipping forward/postrouting chains).
+		Whole ruleset is loaded in one nft batch, replacing table from any earlier run.'''
+
+	nft_table = 'btnap_router'
+
+	def __init__(self, bridge, uplink, flowtable=True, downlinks=()):
+		self.bridge, self.uplink, self.flowtable = bridge, uplink, flowtable
+		self.downlinks = [bridge] + list(downlinks) # masqueraded, e.g. compression tunnel
+		self.forwarding = None
+
+	def ruleset(self):
+		rules = [ 'table ip {0}', 'delete table ip {0}', 'table ip {0} {{' ]
+		if self.flowtable: rules.extend([
+			'\tflowtable ft {{', '\t\thook ingress priority 0; devices = {{ "{1}", "{2}" }};', '\t}}' ])
+		rules.extend([ '\tchain forward {{',
+			'\t\ttype filter hook forward priority 0; policy accept;' ])
+		if self.flowtable:
+			rules.append('\t\tmeta l4proto {{ tcp, udp }} ct state established flow add @ft')
+		rules.extend([ '\t}}', '\tchain postrouting {{',
+			'\t\ttype nat hook postrouting priority 100; policy accept;',
+			'\t\tiifname {{ {3} }} oifname "{2}" masquerade', '\t}}', '}}' ])
+		return '\n'.join(rules).format( self.nft_table, self.bridge, self.uplink,
+			', '.join('"{}"'.format(iface) for iface in self.downlinks) ) + '\n'
+
+	def start(self):
+		if not nl_link_get(self.uplink):
+			raise BTError('Uplink interface for routed mode not found: {}'.format(self.uplink))
+		nft_run(self.ruleset())
+		self.forwarding = sysctl_set('net.ipv4.ip_forward', 1)
+		log.debug( 'Routing %s via %s with masquerade (flowtable: %s)',
+			self.bridge, self.uplink, self.flowtable )
+
+	def stop(self):
+		if self.forwarding is None: return
+		sysctl_set('net.ipv4.ip_forward', self.forwarding)
+		try: nft_run(None, 'delete', 'table', 'ip', self.nft_table)
+		except BTError as err: log.warning('Failed to remove nftables table: %s', err)
+		self.forwarding = None
+
+
+### compression tunnel
+
+TUNSETIFF, IFF_TUN, IFF_NO_PI = 0x400454ca, 0x0001, 0x1000
+IFLA_MTU = 4
+TUN_RAW, TUN_ZLIB, TUN_ZSTD, TUN_DICT, TUN_DICT_ACK, TUN_HELLO = range(6)
+tunnel_name, tunnel_port, tunnel_net = 'btz0', 5333, '10.222.0.0/16'
+
+def tun_open(name):
+	'Creates/opens TUN interface (no packet info header), returning non-blocking fd.'
+	import fcntl
+	fd = os.open('/dev/net/tun', os.O_RDWR | os.O_NONBLOCK | os.O_CLOEXEC)
+	fcntl.ioctl(fd, TUNSETIFF, struct.pack('16sH22x', name.encode(), IFF_TUN | IFF_NO_PI))
+	return fd
+
+def tunnel_addr(net, peer_ip=None):
+	'''Returns tunnel ip/prefix for server (first address in net) or client,
+		derived from ip address it uses to reach server (UDP source on server),
+		so that both sides get same one without any negotiation.'''
+	import ipaddress
+	net = ipaddress.ip_network(net)
+	host = 1 if not peer_ip else int(ipaddress.ip_address(peer_ip)) % (net.num_addresses - 3) + 2
+	return '{}/{}'.format(net.network_address + host, net.prefixlen)
+
+def tunnel_zstd():
+	'Returns zstandard module, if installed - python3-zstandard is optional, zlib is fallback.'
+	zstd = getattr(tunnel_zstd, 'cached_obj', None)
+	if zstd is None:
+		try: import zstandard as zstd
+		except ImportError: zstd = False
+		tunnel_zstd.cached_obj = zstd
+	return zstd
+
+class TunnelPeer(object):
+	'''Per-packet compression state for one tunnel peer.
+		Sending side trains a dictionary on its first/recent outgoing packets,
+		announces it to the peer (repeating until acked) and only starts using it
+		after ack, retraining every retrain_packets packets. Packets that do not get
+		smaller are sent as-is. Receiving side keeps last few announced dictionaries.
+		Codec is zstd when both sides have python zstandard module, zlib otherwise.'''
+
+	samples_max, retrain_packets, dict_size, rx_dicts_max = 200, 5000, 8192, 4
+	hello_interval, announce_interval = 5.0, 1.0
+
+	def __init__(self, tunnel, addr, label):
+		self.tunnel, self.addr, self.label = tunnel, addr, label
+		self.codecs = 1 << TUN_ZLIB | (1 << TUN_ZSTD if tunnel_zstd() else 0)
+		self.codec, self.hello_ok = TUN_ZLIB, False
+		self.samples, self.packets, self.rx_dicts = list(), 0, dict()
+		self.tx_dict, self.tx_dict_id, self.tx_comp = None, 0, None
+		self.pending, self.timer, self.hello_timer = None, None, None
+
+	def stop(self):
+		for timer in self.timer, self.hello_timer:
+			if timer: loop_cancel(timer)
+		self.timer = self.hello_timer = None
+
+	def hello(self, reply=True):
+		self.tunnel.sendto(self.addr, struct.pack('BBB', TUN_HELLO, self.codecs, reply))
+		if not self.hello_ok: self.hello_timer = loop_call_later(self.hello_interval, self.hello)
+
+	def on_hello(self, codecs, reply):
+		'Handles hello from peer, which is sent with reply=True when it (re-)starts.'
+		if self.hello_timer: loop_cancel(self.hello_timer)
+		self.hello_ok, self.hello_timer = True, None
+		if reply: self.hello(reply=False)
+		codec = TUN_ZSTD if self.codecs & codecs & (1 << TUN_ZSTD) else TUN_ZLIB
+		if reply or codec != self.codec: # peer has no dictionaries, or they are for other codec
+			if self.timer: loop_cancel(self.timer)
+			self.codec, self.tx_dict, self.tx_dict_id, self.tx_comp = codec, None, 0, None
+			self.pending = self.timer = None
+			if len(self.samples) >= self.samples_max: self.train()
+		log.debug('Tunnel peer %s: using %s', self.label, 'zstd' if codec == TUN_ZSTD else 'zlib')
+
+	def compressor(self):
+		if not self.tx_comp:
+			if self.codec == TUN_ZSTD:
+				zstd = tunnel_zstd()
+				self.tx_comp = zstd.ZstdCompressor( level=3, write_checksum=False,
+					dict_data=self.tx_dict and zstd.ZstdCompressionDict(self.tx_dict) ).compress
+			else:
+				import zlib
+				base = ( zlib.compressobj(6, zlib.DEFLATED, -15, zdict=self.tx_dict)
+					if self.tx_dict else zlib.compressobj(6, zlib.DEFLATED, -15) )
+				def compress(pkt): # copy of primed compressor, to skip dictionary setup
+					c = base.copy()
+					return c.compress(pkt) + c.flush()
+				self.tx_comp = compress
+		return self.tx_comp
+
+	def send(self, pkt):
+		self.packets += 1
+		if len(pkt) >= 64:
+			if len(self.samples) >= self.samples_max: self.samples.pop(0)
+			self.samples.append(pkt)
+			if not self.pending and ( self.packets % self.retrain_packets == 0
+					or (not self.tx_dict and len(self.samples) >= self.samples_max) ):
+				self.train()
+		data = self.compressor()(pkt)
+		if len(data) + 1 < len(pkt): msg = struct.pack('BB', self.codec, self.tx_dict_id) + data
+		else:
+			msg = struct.pack('B', TUN_RAW) + pkt
+			stat_inc('tunnel_tx_raw_packets_total', peer=self.label)
+		stat_inc('tunnel_tx_packets_total', peer=self.label)
+		stat_inc('tunnel_tx_bytes_total', len(pkt), peer=self.label)
+		stat_inc('tunnel_tx_wire_bytes_total', len(msg), peer=self.label)
+		self.tunnel.sendto(self.addr, msg)
+
+	def train(self):
+		if self.codec == TUN_ZSTD:
+			zstd = tunnel_zstd()
+			try: data = zstd.train_dictionary(self.dict_size, self.samples).as_bytes()
+			except zstd.ZstdError as err:
+				return log.debug('Failed to train tunnel dictionary: %s', err)
+		else: data = b''.join(self.samples)[-self.dict_size:] # most recent packets at the end, nearest to data
+		self.pending = self.tx_dict_id % 255 + 1, data
+		self.announce()
+
+	def announce(self):
+		if not self.pending: return
+		dict_id, data = self.pending
+		self.tunnel.sendto(self.addr, struct.pack('BBB', TUN_DICT, dict_id, self.codec) + data)
+		self.timer = loop_call_later(self.announce_interval, self.announce)
+
+	def on_dict_ack(self, dict_id):
+		if not self.pending or self.pending[0] != dict_id: return
+		if self.timer: loop_cancel(self.timer)
+		(self.tx_dict_id, self.tx_dict), self.pending, self.timer = self.pending, None, None
+		self.tx_comp = None
+		stat_inc('tunnel_dicts_total', peer=self.label)
+		log.debug('Tunnel peer %s: switched to dictionary %s (%sB)', self.label, dict_id, len(self.tx_dict))
+
+	def recv(self, msg):
+		'Returns decompressed packet from message or None for control/bad ones.'
+		mtype = msg[0]
+		stat_inc('tunnel_rx_wire_bytes_total', len(msg), peer=self.label)
+		if mtype == TUN_RAW: pkt = msg[1:]
+		elif mtype in [TUN_ZLIB, TUN_ZSTD] and len(msg) > 2:
+			dict_id, data = msg[1], msg[2:]
+			zdict = self.rx_dicts.get((mtype, dict_id)) if dict_id else b''
+			if zdict is None: # peer state is from before restart, make it start over
+				if not self.hello_timer:
+					self.hello_ok = False
+					self.hello()
+				return stat_inc('tunnel_rx_dropped_total', peer=self.label, reason='dict')
+			try:
+				if mtype == TUN_ZSTD:
+					zstd = tunnel_zstd()
+					if not zstd: return stat_inc('tunnel_rx_dropped_total', peer=self.label, reason='codec')
+					pkt = zstd.ZstdDecompressor(dict_data=zdict and
+						zstd.ZstdCompressionDict(zdict)).decompress(data, max_output_size=65536)
+				else:
+					import zlib
+					d = zlib.decompressobj(-15, zdict=zdict) if zdict else zlib.decompressobj(-15)
+					pkt = d.decompress(data, 65536)
+					if d.unconsumed_tail: raise ValueError('packet is too large')
+			except Exception as err:
+				log.debug('Failed to decompress tunnel packet: %s', err)
+				return stat_inc('tunnel_rx_dropped_total', peer=self.label, reason='error')
+		elif mtype == TUN_DICT and len(msg) > 3:
+			dict_id, codec = msg[1], msg[2]
+			if codec == TUN_ZSTD and not tunnel_zstd(): return
+			self.rx_dicts[codec, dict_id] = bytes(msg[3:])
+			while len(self.rx_dicts) > self.rx_dicts_max: del self.rx_dicts[next(iter(self.rx_dicts))]
+			return self.tunnel.sendto(self.addr, struct.pack('BB', TUN_DICT_ACK, dict_id))
+		elif mtype == TUN_DICT_ACK and len(msg) == 2: return self.on_dict_ack(msg[1])
+		elif mtype == TUN_HELLO and len(msg) == 3: return self.on_hello(msg[1], msg[2])
+		else: return stat_inc('tunnel_rx_dropped_total', peer=self.label, reason='bad')
+		stat_inc('tunnel_rx_bytes_total', len(pkt), peer=self.label)
+		return pkt
+
+class CompressTunnel(object):
+	'''IPv4 tunnel over UDP between client and NAP, with per-packet compression.
+		Tunnel address of each client is derived from its UDP source address (see
+		tunnel_addr), and server routes packets from TUN to clients by these,
+		dropping ones from clients with any other source address inside.
+		Client sends all traffic (0.0.0.0/1 + 128.0.0.0/1 routes) via server tunnel address.'''
+
+	overhead = 28 + 2 # ipv4/udp headers and message type/dict id
+
+	def __init__(self, net, remote=None, bind_iface=None, link_mtu=1500):
+		import socket, ipaddress
+		self.net, self.remote, self.peers, self.routes = net, remote, dict(), dict()
+		self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM | socket.SOCK_CLOEXEC)
+		self.sock.setblocking(False)
+		if remote:
+			host, port = (remote.rsplit(':', 1) + [tunnel_port])[:2]
+			self.sock.connect((host, int(port)))
+			addr = tunnel_addr(net, self.sock.getsockname()[0])
+		else:
+			if bind_iface:
+				self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_BINDTODEVICE, bind_iface.encode())
+			self.sock.bind(('', tunnel_port))
+			addr = tunnel_addr(net)
+		addr = ipaddress.ip_interface(addr)
+		self.fd = tun_open(tunnel_name)
+		self.index = nl_link_get(tunnel_name)['index']
+		msgs = [ (RTM_NEWLINK, 0, nl_link_msg( self.index, IFF_UP, IFF_UP,
+				attrs=[(IFLA_MTU, link_mtu - self.overhead)] )),
+			(RTM_NEWADDR, NLM_F_CREATE | NLM_F_EXCL, nl_addr_msg(self.index, str(addr))) ]
+		if remote:
+			gw = str(addr.network.network_address + 1)
+			for dst in '0.0.0.0/1', '128.0.0.0/1':
+				msgs.append((RTM_NEWROUTE, NLM_F_CREATE | NLM_F_EXCL, nl_route_msg(self.index, gw, dst)))
+		get_rtnl().request(msgs, ignore=[errno.EEXIST])
+		if remote:
+			peer = self.peers[None] = TunnelPeer(self, None, host)
+			peer.hello()
+		loop_add_reader(self.fd, self.on_tun)
+		loop_add_reader(self.sock.fileno(), self.on_sock)
+		log.debug( 'Compression tunnel %s (%s) is up, %s', tunnel_name,
+			addr, 'server: {}'.format(remote) if remote else 'listening on port {}'.format(tunnel_port) )
+
+	def stop(self):
+		for peer in self.peers.values(): peer.stop()
+		loop_remove_reader(self.fd)
+		loop_remove_reader(self.sock.fileno())
+		os.close(self.fd)
+		self.sock.close()
+
+	def sendto(self, addr, msg):
+		try:
+			if addr is None: self.sock.send(msg)
+			else: self.sock.sendto(msg, addr)
+		except OSError as err: # e.g. bnep link is down, or full socket buffer
+			stat_inc('tunnel_tx_errors_total', errno=errno.errorcode.get(err.errno, err.errno))
+
+	def on_tun(self):
+		while True:
+			try: pkt = os.read(self.fd, 65536)
+			except BlockingIOError: break
+			if len(pkt) < 20 or pkt[0] >> 4 != 4: continue # ipv4 only
+			peer = self.peers.get(None) if self.remote else self.routes.get(pkt[16:20])
+			if peer: peer.send(pkt)
+			else: stat_inc('tunnel_tx_dropped_total')
+
+	def peer_add(self, addr):
+		'Adds peer for new UDP source, replacing old one from same ip (e.g. after restart).'
+		import ipaddress
+		ip = ipaddress.ip_interface(tunnel_addr(self.net, addr[0])).ip.packed
+		peer = self.routes.get(ip)
+		if peer:
+			peer.stop()
+			del self.peers[peer.addr]
+		log.debug('New tunnel peer: %s', addr[0])
+		peer = self.peers[addr] = self.routes[ip] = TunnelPeer(self, addr, addr[0])
+		return peer
+
+	def on_sock(self):
+		while True:
+			try: msg, addr = self.sock.recvfrom(65536)
+			except BlockingIOError: break
+			except OSError as err: # icmp errors for earlier sends
+				log.debug('Tunnel socket error: %s', err)
+				continue
+			if not msg: continue
+			peer = self.peers.get(None if self.remote else addr)
+			if not peer: peer = self.peer_add(addr)
+			pkt = peer.recv(msg)
+			if not pkt or len(pkt) < 20: continue
+			if not self.remote and self.routes.get(pkt[12:16]) is not peer:
+				stat_inc('tunnel_rx_dropped_total', peer=peer.label, reason='src')
+				continue
+			try: os.write(self.fd, pkt)
+			except OSError as err: log.debug('Failed to write packet to tunnel: %s', err)
+
+
+### tcp proxy
+
+IP_TRANSPARENT, TCP_NOTSENT_LOWAT = 19, 25
+RTM_DELROUTE, RTM_NEWRULE, RTM_DELRULE = 25, 32, 33
+FRA_PRIORITY, FRA_FWMARK = 6, 10
+FR_ACT_TO_TBL, RTN_LOCAL, RT_SCOPE_HOST = 1, 2, 254
+proxy_rate_buckets = tuple(2**n * 1000 for n in range(4, 16)) # 16kbit/s - 32Mbit/s
+proxy_time_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+class TCPProxy(object):
+	'''Split-TCP proxy for connections from routed bridge (and other downlinks).
+		nftables tproxy rule (with fwmark + local route policy routing) redirects
+		forwarded TCP connections to a transparent listening socket, and proxy
+		opens its own connection to original destination, so that each leg runs
+		its own congestion control and loss recovery. Upstream data is read
+		as fast as it arrives into up to buffer bytes per connection, which are
+		then sent to the bnep link, keeping little unsent data in kernel buffers.'''
+
+	nft_table, fwmark, route_table, rule_priority = 'btnap_proxy', 0xb7a, 107, 107
+	connect_timeout, upstream_buffer, client_lowat = 10.0, 4 << 20, 128 << 10
+
+	def __init__(self, ifaces, port, buffer):
+		self.ifaces, self.port, self.buffer = ifaces, port, buffer
+		self.flows, self.server = dict(), None # {task: writers}
+
+	def ruleset(self):
+		return '\n'.join([ 'table ip {0}', 'delete table ip {0}', 'table ip {0} {{',
+			'\tchain prerouting {{', '\t\ttype filter hook prerouting priority mangle; policy accept;',
+			'\t\tiifname {{ {1} }} meta l4proto tcp socket transparent 1 meta mark set {2} accept',
+			'\t\tiifname {{ {1} }} meta l4proto tcp fib daddr type != local'
+				' tproxy to :{3} meta mark set {2} accept', '\t}}', '}}' ]).format(
+			self.nft_table, ', '.join('"{}"'.format(iface) for iface in self.ifaces),
+			self.fwmark, self.port ) + '\n'
+
+	def nl_msgs(self, add=True):
+		'''Returns netlink messages for "ip rule add fwmark M lookup T" and
+			"ip route add local 0.0.0.0/0 dev lo table T", same as for any tproxy setup.'''
+		import socket
+		flags = NLM_F_CREATE | NLM_F_EXCL if add else 0
+		rule = struct.pack( 'BBBBBBBBI', socket.AF_INET, 0, 0, 0,
+				self.route_table, 0, 0, FR_ACT_TO_TBL, 0 ) \
+			+ nl_attr(FRA_PRIORITY, self.rule_priority) + nl_attr(FRA_FWMARK, self.fwmark)
+		route = struct.pack( 'BBBBBBBBI', socket.AF_INET, 0, 0, 0,
+				self.route_table, RTPROT_BOOT, RT_SCOPE_HOST, RTN_LOCAL, 0 ) \
+			+ nl_attr(RTA_OIF, nl_link_get('lo')['index'])
+		return [ (RTM_NEWRULE if add else RTM_DELRULE, flags, rule),
+			(RTM_NEWROUTE if add else RTM_DELROUTE, flags, route) ]
+
+	def start(self):
+		import asyncio, socket
+		sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM | socket.SOCK_CLOEXEC)
+		sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		sock.setsockopt(socket.SOL_IP, IP_TRANSPARENT, 1)
+		sock.bind(('0.0.0.0', self.port))
+		sock.listen(64)
+		sock.setblocking(False)
+		try: nft_run(self.ruleset())
+		except BTError:
+			sock.close()
+			raise
+		get_rtnl().request(self.nl_msgs(), ignore=[errno.EEXIST])
+		self.server = get_loop().run_until_complete(asyncio.start_server(self.on_conn, sock=sock))
+		stats_collectors.append(self.collect)
+		log.debug('TCP proxy for %s listening on port %s', ', '.join(self.ifaces), self.port)
+
+	def stop(self):
+		if not self.server: return
+		self.server.close()
+		for flow in list(self.flows): flow.cancel()
+		stats_collectors.remove(self.collect)
+		try: nft_run(None, 'delete', 'table', 'ip', self.nft_table)
+		except BTError as err: log.warning('Failed to remove nftables table: %s', err)
+		try: get_rtnl().request(self.nl_msgs(add=False), ignore=[errno.ENOENT, errno.ESRCH])
+		except OSError as err: log.warning('Failed to remove proxy routing rules: %s', err)
+		self.server = None
+
+	def collect(self):
+		stat_set('proxy_connections', len(self.flows))
+		for k in 'up', 'down': stat_set('proxy_buffer_bytes', 0, direction=k)
+		for writers in self.flows.values():
+			for k, writer in writers.items():
+				if not writer.is_closing():
+					stat_inc('proxy_buffer_bytes', writer.transport.get_write_buffer_size(), direction=k)
+
+	def on_conn(self, reader, writer):
+		import asyncio
+		writers = dict(down=writer)
+		flow = asyncio.ensure_future(self.run_flow(reader, writer, writers))
+		self.flows[flow] = writers
+		flow.add_done_callback(lambda flow: self.flows.pop(flow, None))
+
+	async def run_flow(self, c_reader, c_writer, writers):
+		import asyncio, socket
+		c_sock = c_writer.get_extra_info('socket')
+		dst, src = c_sock.getsockname(), c_writer.get_extra_info('peername')
+		if dst[1] == self.port: return c_writer.close() # direct connection, not a redirected one
+		c_sock.setsockopt(socket.IPPROTO_TCP, TCP_NOTSENT_LOWAT, self.client_lowat)
+		c_writer.transport.set_write_buffer_limits(self.buffer)
+		u_sock, ts = socket.socket(socket.AF_INET, socket.SOCK_STREAM | socket.SOCK_CLOEXEC), time.monotonic()
+		try:
+			for k in socket.SO_RCVBUF, socket.SO_SNDBUF:
+				u_sock.setsockopt(socket.SOL_SOCKET, k, self.upstream_buffer)
+			u_sock.setblocking(False)
+			await asyncio.wait_for(get_loop().sock_connect(u_sock, dst), self.connect_timeout)
+			u_reader, u_writer = await asyncio.open_connection(sock=u_sock, limit=self.buffer)
+		except (OSError, asyncio.TimeoutError) as err:
+			log.debug('TCP proxy connection %s -> %s failed: %s', src, dst, err)
+			stat_inc('proxy_connections_total', result='failed')
+			u_sock.close()
+			c_sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0)) # RST
+			return c_writer.close()
+		stat_inc('proxy_connections_total', result='ok')
+		stat_observe('proxy_connect_seconds', time.monotonic() - ts, proxy_time_buckets)
+		writers['up'] = u_writer
+		try:
+			await asyncio.gather(
+				self.pipe(c_reader, u_writer, 'up'), self.pipe(u_reader, c_writer, 'down') )
+		except (OSError, asyncio.IncompleteReadError) as err:
+			log.debug('TCP proxy connection %s -> %s error: %s', src, dst, err)
+		finally:
+			for writer in u_writer, c_writer: writer.close()
+
+	async def pipe(self, reader, writer, direction):
+		n, ts = 0, None
+		while True:
+			buf = await reader.read(65536)
+			if not buf: break
+			if not ts: ts = time.monotonic()
+			writer.write(buf)
+			n += len(buf)
+			stat_inc('proxy_bytes_total', len(buf), direction=direction)
+			await writer.drain()
+		if writer.can_write_eof(): writer.write_eof()
+		if n >= 64 << 10: # too little data to say anything about link throughput otherwise
+			stat_observe( 'proxy_flow_bits_per_second',
+				n * 8 / (time.monotonic() - ts), proxy_rate_buckets, direction=direction )
+
+
+### dns
+
+dns_time_buckets = (0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+def dns_skip_name(buf, pos):
+	while True:
+		n = buf[pos]
+		if n >= 0xc0: return pos + 2
+		pos += n + 1
+		if not n: return pos
+
+def dns_question(buf):
+	'Returns (cache key, end offset) for first question in DNS message.'
+	pos = dns_skip_name(buf, 12)
+	qtype, qclass = struct.unpack_from('>HH', buf, pos)
+	return (bytes(buf[12:pos]).lower(), qtype, qclass), pos + 4
+
+def dns_minimal(resp):
+	'''Returns (minimal response, [(ttl offset, ttl), ...], min ttl) for upstream response.
+		Kept are header, question, answer records, authority ones if there
+		are no answers (SOA for negative caching) and EDNS OPT record. As these
+		are a prefix of the message plus OPT (which has root name), dropping
+		rest does not break any name compression pointers.'''
+	qdcount, ancount, nscount, arcount = struct.unpack_from('>4H', resp, 4)
+	pos = 12
+	for n in range(qdcount): pos = dns_skip_name(resp, pos) + 4
+	out, ttls, counts = bytearray(resp[:pos]), list(), [qdcount, 0, 0, 0]
+	for section, count in enumerate([ancount, nscount, arcount], 1):
+		for n in range(count):
+			start, pos = pos, dns_skip_name(resp, pos)
+			rtype, rclass, ttl, rdlen = struct.unpack_from('>HHIH', resp, pos)
+			ttl_pos, pos = pos + 4 - start, pos + 10 + rdlen
+			if not ( section == 1 or (section == 2 and not ancount)
+				or (section == 3 and rtype == 41) ): continue
+			if rtype != 41: ttls.append((len(out) + ttl_pos, ttl))
+			out += resp[start:pos]
+			counts[section] += 1
+	if pos > len(resp): raise IndexError('Truncated DNS message')
+	struct.pack_into('>4H', out, 4, *counts)
+	return out, ttls, min((ttl for pos, ttl in ttls), default=0)
+
+class DNSEntry(object):
+	__slots__ = 'resp', 'ttls', 'ttl', 'ts', 'hits'
+
+	def __init__(self, resp, ttls, ttl):
+		self.resp, self.ttls, self.ttl, self.ts, self.hits = resp, ttls, ttl, time.monotonic(), 0
+
+	def render(self, qid, age, stale_ttl):
+		buf = bytearray(self.resp)
+		buf[:2] = qid
+		for pos, ttl in self.ttls:
+			struct.pack_into('>I', buf, pos, max(0, int(ttl - age)) if age < self.ttl else stale_ttl)
+		return buf
+
+class DNSForwarder(object):
+	'''Caching DNS forwarder for clients on the bridge (UDP only).
+		Responses are kept in LRU cache with up to cache_size entries, with TTLs
+		counted down. Expired entries are still served (with stale_ttl) for up
+		to stale_max seconds while being refreshed in the background, and hot ones
+		(hit at least prefetch_hits times) are refreshed before they expire.
+		Only answer records are returned (see dns_minimal), to save airtime.'''
+
+	timeout, stale_ttl, stale_max, negative_ttl_max = 2.0, 30, 86400, 300
+	prefetch_hits, prefetch_ratio = 3, 0.1
+
+	def __init__(self, iface, upstreams, cache_size=1000):
+		import collections
+		self.upstreams, self.cache_size = list(), cache_size
+		for addr in upstreams:
+			host, port = (addr.rsplit(':', 1) + [53])[:2] if addr.count(':') == 1 else (addr, 53)
+			if ':' in host: log.debug('Skipping IPv6 DNS upstream: %s', addr)
+			else: self.upstreams.append((host, int(port)))
+		if not self.upstreams: raise BTError('No IPv4 DNS upstream servers found')
+		self.iface, self.cache = iface, collections.OrderedDict()
+		self.pending, self.queries = dict(), dict()
+		self.sock = self.sock_up = None
+
+	def start(self):
+		import socket
+		self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM | socket.SOCK_CLOEXEC)
+		self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_BINDTODEVICE, self.iface.encode())
+		self.sock.bind(('0.0.0.0', 53))
+		self.sock.setblocking(False)
+		self.sock_up = socket.socket(socket.AF_INET, socket.SOCK_DGRAM | socket.SOCK_CLOEXEC)
+		self.sock_up.setblocking(False)
+		loop_add_reader(self.sock.fileno(), self.on_sock)
+		loop_add_reader(self.sock_up.fileno(), self.on_sock_up)
+		stats_collectors.append(self.collect)
+		log.debug( 'DNS forwarder on %s, upstreams: %s', self.iface,
+			', '.join('{}:{}'.format(*addr) for addr in self.upstreams) )
+
+	def stop(self):
+		for sock in self.sock, self.sock_up:
+			loop_remove_reader(sock.fileno())
+			sock.close()
+		stats_collectors.remove(self.collect)
+
+	def collect(self): stat_set('dns_cache_entries', len(self.cache))
+
+	def on_sock(self):
+		import asyncio
+		while True:
+			try: query, addr = self.sock.recvfrom(4096)
+			except BlockingIOError: break
+			except OSError as err:
+				log.debug('DNS socket error: %s', err)
+				continue
+			asyncio.ensure_future(self.on_query(query, addr))
+
+	def on_sock_up(self):
+		while True:
+			try: resp, addr = self.sock_up.recvfrom(65536)
+			except BlockingIOError: break
+			except OSError as err: # icmp errors for earlier queries
+				log.debug('DNS upstream socket error: %s', err)
+				continue
+			if len(resp) < 12: continue
+			fut, upstream = self.queries.get(resp[:2], (None, None))
+			if fut and addr == upstream and not fut.done(): fut.set_result(resp)
+
+	async def on_query(self, query, addr):
+		ts = time.monotonic()
+		try:
+			if len(query) < 12 or query[2] & 0xf8: raise ValueError # response or non-query opcode
+			key, qend = dns_question(query)
+		except (ValueError, IndexError, struct.error):
+			return stat_inc('dns_queries_total', result='bad')
+		entry, age = self.cache.get(key), 0
+		if entry:
+			self.cache.move_to_end(key)
+			entry.hits, age = entry.hits + 1, ts - entry.ts
+			if age < entry.ttl:
+				result = 'hit'
+				if entry.hits >= self.prefetch_hits and entry.ttl - age < entry.ttl * self.prefetch_ratio:
+					self.refresh(key, query)
+			elif age < entry.ttl + self.stale_max:
+				result = 'stale'
+				self.refresh(key, query)
+			else: entry, age = None, 0
+		if not entry:
+			result = 'miss'
+			try: entry = await self.resolve(key, query)
+			except BTError as err:
+				log.debug('DNS query failed: %s', err)
+				resp = bytearray(query[:qend])
+				resp[2], resp[3] = 0x80 | query[2] & 0x79, 0x82 # QR, RA, SERVFAIL
+				struct.pack_into('>4H', resp, 4, 1, 0, 0, 0)
+				entry, result = None, 'error'
+		if entry: resp = entry.render(query[:2], age, self.stale_ttl)
+		try: self.sock.sendto(resp, addr)
+		except OSError as err: log.debug('Failed to send DNS response: %s', err)
+		stat_inc('dns_queries_total', result=result)
+		stat_observe('dns_response_seconds', time.monotonic() - ts, dns_time_buckets, result=result)
+
+	def refresh(self, key, query):
+		if key in self.pending: return
+		def done(fut):
+			if not fut.cancelled() and fut.exception():
+				log.debug('DNS refresh failed: %s', fut.exception())
+		import asyncio
+		asyncio.ensure_future(self.resolve(key, query)).add_done_callback(done)
+		stat_inc('dns_refreshes_total')
+
+	async def resolve(self, key, query):
+		'Returns DNSEntry for query, sharing upstream request with other same-key ones.'
+		import asyncio
+		fut = self.pending.get(key)
+		if not fut:
+			fut = self.pending[key] = asyncio.ensure_future(self.fetch(key, query))
+			fut.add_done_callback(lambda fut: self.pending.pop(key, None))
+		return await asyncio.shield(fut)
+
+	async def fetch(self, key, query):
+		import asyncio
+		for upstream in self.upstreams:
+			while True:
+				qid = os.urandom(2)
+				if qid not in self.queries: break
+			fut, ts = get_loop().create_future(), time.monotonic()
+			self.queries[qid] = fut, upstream
+			try:
+				self.sock_up.sendto(qid + query[2:], upstream)
+				resp = await asyncio.wait_for(fut, self.timeout)
+				if dns_question(resp)[0] != key: raise ValueError('question mismatch')
+				resp, ttls, ttl = dns_minimal(resp)
+			except (OSError, asyncio.TimeoutError, ValueError, IndexError, struct.error) as err:
+				log.debug('DNS upstream %s:%s failed: %s', upstream[0], upstream[1], err or 'timeout')
+				stat_inc('dns_upstream_errors_total', upstream=upstream[0])
+				continue
+			finally: del self.queries[qid]
+			stat_observe( 'dns_upstream_seconds', time.monotonic() - ts,
+				dns_time_buckets, upstream=upstream[0] )
+			break
+		else: raise BTError('No response from DNS upstreams')
+		rcode, entry = resp[3] & 0xf, DNSEntry(resp, ttls, ttl)
+		if rcode == 3 or not struct.unpack_from('>H', resp, 6)[0]: # negative
+			entry.ttl = min(entry.ttl, self.negative_ttl_max)
+		if entry.ttl > 0 and rcode in [0, 3] and not resp[2] & 0x02: # not truncated
+			self.cache[key] = entry
+			self.cache.move_to_end(key)
+			while len(self.cache) > self.cache_size: self.cache.popitem(last=False)
+		return entry
+
+def resolv_conf_servers(path='/etc/resolv.conf'):
+	try:
+		with open(path) as src:
+			return list( line.split()[1] for line in src
+				if line.startswith('nameserver') and len(line.split()) > 1 )
+	except OSError: return list()
+
+
+### dhcp
+
+RTM_NEWNEIGH, NDA_DST, NDA_LLADDR, NUD_STALE = 28, 1, 2, 0x04
+DHCP_DISCOVER, DHCP_OFFER, DHCP_REQUEST, DHCP_DECLINE = 1, 2, 3, 4
+DHCP_ACK, DHCP_NAK, DHCP_RELEASE, DHCP_INFORM = 5, 6, 7, 8
+DHCP_OPT_MASK, DHCP_OPT_ROUTER, DHCP_OPT_DNS, DHCP_OPT_REQ_ADDR = 1, 3, 6, 50
+DHCP_OPT_LEASE, DHCP_OPT_TYPE, DHCP_OPT_SERVER_ID, DHCP_OPT_T1, DHCP_OPT_T2 = 51, 53, 54, 58, 59
+DHCP_OPT_RAPID_COMMIT = 80
+dhcp_magic, dhcp_bootp = b'\x63\x82\x53\x63', struct.Struct('!BBBBIHH4s4s4s4s16s64s128s')
+dhcp_msg_names = dict(enumerate(
+	'discover offer request decline ack nak release inform'.split(), 1 ))
+dhcp_time_buckets = (0.1, 0.25, 0.5, 1, 2, 3, 5, 10, 30, 60)
+
+def dhcp_duration(spec):
+	'Parses lease time in dnsmasq format (e.g. 3600, 45m, 12h, 1d) to seconds.'
+	mul = dict(s=1, m=60, h=3600, d=86400, w=604800).get(spec[-1:].lower())
+	return int(spec[:-1]) * mul if mul else int(spec)
+
+def dhcp_options(buf):
+	opts, pos = dict(), 0
+	while pos < len(buf):
+		code = buf[pos]
+		if code == 255: break
+		if code == 0:
+			pos += 1
+			continue
+		n = buf[pos+1]
+		opts[code] = opts.get(code, b'') + buf[pos+2:pos+2+n] # long options can be split
+		pos += 2 + n
+	return opts
+
+class DHCPServer(object):
+	'''DHCPv4 server for clients on the bridge, with Rapid Commit (RFC 4039)
+		two-message exchange for clients that ask for it, and leases pinned to
+		client MAC (bluetooth adapter address), which are kept in lease_file.
+		Address for a new client is picked from the range by hash of its MAC,
+		so it's likely to be the same even with lease file lost, and expired leases
+		are only given to other clients when range has no never-used addresses left.
+		Lease file is written right away when address of a client changes, and
+		expiry-only updates (renewals) are batched, saved after lease_save_delay.
+		Replies are unicast to clients, adding neighbour entry for them beforehand.
+		Time between bnep port appearing on the bridge and lease for the
+		remote device on it is recorded as time-to-lease.'''
+
+	lease_file = '/var/lib/btnap/dhcp.leases'
+	lease_save_delay = 600.0
+
+	def __init__(self, iface, addr, pool, lease_time, router=None, dns=()):
+		import ipaddress
+		self.iface, self.lease_time = iface, lease_time
+		addr = ipaddress.ip_interface(addr)
+		self.addr, self.net = addr.ip, addr.network
+		self.pool = list( ipaddress.ip_address(n) for n in
+			range(int(pool[0]), int(pool[1]) + 1) if ipaddress.ip_address(n) != self.addr )
+		if not self.pool or any(ip not in self.net for ip in pool):
+			raise BTError('DHCP range must be within bridge network {}: {}-{}'.format(self.net, *pool))
+		self.leases = dict() # {mac: [ip, expires]}
+		self.ports, self.connects = dict(), dict() # {index: name}, {remote mac or port name: ts}
+		self.lease_load()
+		self.reply_opts = [(DHCP_OPT_SERVER_ID, self.addr.packed), (DHCP_OPT_MASK, self.net.netmask.packed)]
+		if router: self.reply_opts.append((DHCP_OPT_ROUTER, ipaddress.ip_address(router).packed))
+		if dns: self.reply_opts.append((DHCP_OPT_DNS, b''.join(ipaddress.ip_address(ip).packed for ip in dns)))
+		self.sock, self.index, self.save_timer = None, None, None
+
+	def start(self):
+		import socket
+		self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM | socket.SOCK_CLOEXEC)
+		self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+		self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_BINDTODEVICE, self.iface.encode())
+		self.sock.bind(('0.0.0.0', 67))
+		self.sock.setblocking(False)
+		self.index = nl_link_get(self.iface)['index']
+		loop_add_reader(self.sock.fileno(), self.on_sock)
+		get_link_monitor().handlers.append(self.on_link)
+		log.debug( 'DHCP server on %s, range: %s - %s (%s addresses), leases: %s',
+			self.iface, self.pool[0], self.pool[-1], len(self.pool), len(self.leases) )
+
+	def stop(self):
+		loop_remove_reader(self.sock.fileno())
+		self.sock.close()
+		get_link_monitor().handlers.remove(self.on_link)
+		if self.save_timer: self.lease_save()
+
+	def lease_load(self):
+		import json, ipaddress
+		try:
+			with open(self.lease_file) as src: leases = json.load(src)
+		except FileNotFoundError: return
+		except (OSError, ValueError) as err:
+			return log.warning('Failed to load DHCP leases from %s: %s', self.lease_file, err)
+		for mac, (ip, expires) in leases.items():
+			ip = ipaddress.ip_address(ip)
+			if ip in self.pool: self.leases[mac] = [ip, expires]
+
+	def lease_save(self, delay=False):
+		if delay:
+			if not self.save_timer: self.save_timer = loop_call_later(self.lease_save_delay, self.lease_save)
+			return
+		if self.save_timer: loop_cancel(self.save_timer)
+		self.save_timer = None
+		import json
+		os.makedirs(os.path.dirname(self.lease_file), exist_ok=True)
+		tmp = self.lease_file + '.new'
+		try:
+			with open(tmp, 'w') as dst:
+				json.dump(dict((mac, [str(ip), expires]) for mac, (ip, expires) in self.leases.items()), dst)
+			os.rename(tmp, self.lease_file)
+		except OSError as err: log.warning('Failed to save DHCP leases to %s: %s', self.lease_file, err)
+
+	def lease_addr(self, mac, requested=None):
+		'''Returns address pinned to mac or picks a new one,
+			preferring requested one, or returns None if range is exhausted.'''
+		lease = self.leases.get(mac)
+		if lease: return lease[0]
+		used, ts = dict((lease[0], mac) for mac, lease in self.leases.items()), time.time()
+		if requested in self.pool and requested not in used: return requested
+		n = int.from_bytes(bytes.fromhex(mac.replace(':', '')), 'big') % len(self.pool)
+		for ip in self.pool[n:] + self.pool[:n]:
+			if ip not in used: return ip
+		mac_old, (ip, expires) = min(self.leases.items(), key=lambda kv: kv[1][1])
+		if expires > ts: return None
+		log.debug('Reusing expired DHCP lease %s of %s for %s', ip, mac_old, mac)
+		del self.leases[mac_old]
+		return ip
+
+	def on_link(self, event, link):
+		'Records time when bnep port is added to the bridge, for time-to-lease metric.'
+		if not link['name'].startswith('bnep'): return
+		if event == RTM_DELLINK or link['master'] != self.index:
+			name = self.ports.pop(link['index'], None)
+			self.connects.pop(name, None)
+			return
+		if link['index'] in self.ports: return
+		name = self.ports[link['index']] = link['name']
+		self.connects[bnep_connections().get(name) or name] = time.monotonic()
+
+	def on_lease(self, mac):
+		ts = self.connects.pop(mac, None)
+		if ts is None: # no remote address for port, assume oldest port
+			ports = sorted((ts, k) for k, ts in self.connects.items() if k.startswith('bnep'))
+			if ports: ts = self.connects.pop(ports[0][1])
+		if ts is None: return
+		delay = time.monotonic() - ts
+		stat_observe('dhcp_time_to_lease_seconds', delay, dhcp_time_buckets)
+		log.debug('DHCP lease for %s %.2fs after connection', mac, delay)
+
+	def on_sock(self):
+		while True:
+			try: msg, addr = self.sock.recvfrom(4096)
+			except BlockingIOError: break
+			except OSError as err:
+				log.debug('DHCP socket error: %s', err)
+				continue
+			try: self.handle(msg)
+			except (IndexError, ValueError, struct.error) as err:
+				log.debug('Bad DHCP message: %s', err)
+				stat_inc('dhcp_requests_total', type='bad')
+
+	def handle(self, msg):
+		import socket, ipaddress
+		( op, htype, hlen, hops, xid, secs, flags, ciaddr,
+			yiaddr, siaddr, giaddr, chaddr, sname, bfile ) = dhcp_bootp.unpack_from(msg)
+		if op != 1 or htype != 1 or hlen != 6 or msg[236:240] != dhcp_magic: raise ValueError('not a request')
+		opts = dhcp_options(msg[240:])
+		mtype, mac = opts[DHCP_OPT_TYPE][0], ':'.join('{:02X}'.format(b) for b in chaddr[:6])
+		stat_inc('dhcp_requests_total', type=dhcp_msg_names.get(mtype, mtype))
+		requested = opts.get(DHCP_OPT_REQ_ADDR)
+		requested = requested and len(requested) == 4 and ipaddress.ip_address(requested)
+		ciaddr, lease, ts = ipaddress.ip_address(ciaddr), self.leases.get(mac), time.time()
+		reply, ip, rapid = None, None, False
+
+		if mtype == DHCP_DISCOVER:
+			ip = self.lease_addr(mac, requested)
+			if not ip: return log.warning('DHCP range exhausted, not offering address to %s', mac)
+			rapid = DHCP_OPT_RAPID_COMMIT in opts
+			reply = DHCP_ACK if rapid else DHCP_OFFER
+		elif mtype == DHCP_REQUEST:
+			server_id = opts.get(DHCP_OPT_SERVER_ID)
+			if server_id and server_id != self.addr.packed: return # client picked other server
+			ip = requested or ciaddr
+			if ip == self.lease_addr(mac, ip): reply = DHCP_ACK
+			elif server_id or int(ciaddr) or ip in self.net: reply = DHCP_NAK
+			else: return # init-reboot with address from other network, RFC 2131 4.3.2
+		elif mtype == DHCP_DECLINE: # address is in use by something else, block it for a while
+			if lease and requested == lease[0]:
+				del self.leases[mac]
+				self.leases['declined-{}'.format(requested)] = [requested, ts + self.lease_time]
+				self.lease_save()
+			return log.warning('DHCP address %s declined by %s', requested, mac)
+		elif mtype == DHCP_RELEASE: # lease stays pinned to mac, only expires
+			if lease and lease[0] == ciaddr:
+				lease[1] = ts
+				self.lease_save(delay=True)
+			return
+		elif mtype == DHCP_INFORM: reply = DHCP_ACK
+		else: return
+
+		reply_opts = [(DHCP_OPT_TYPE, bytes([reply]))]
+		if reply != DHCP_NAK:
+			reply_opts.extend(self.reply_opts)
+			if mtype != DHCP_INFORM:
+				lt = self.lease_time
+				reply_opts.extend([ (DHCP_OPT_LEASE, lt),
+					(DHCP_OPT_T1, lt // 2), (DHCP_OPT_T2, lt * 7 // 8) ])
+			if rapid: reply_opts.append((DHCP_OPT_RAPID_COMMIT, b''))
+		else: reply_opts.append((DHCP_OPT_SERVER_ID, self.addr.packed))
+		yiaddr = ip.packed if ip and reply != DHCP_NAK and mtype != DHCP_INFORM else bytes(4)
+		buf = dhcp_bootp.pack( 2, htype, hlen, 0, xid, 0, flags, msg[12:16],
+			yiaddr, bytes(4), msg[24:28], chaddr, bytes(64), bytes(128) ) + dhcp_magic
+		for code, data in reply_opts:
+			if isinstance(data, int): data = struct.pack('!I', data)
+			buf += bytes([code, len(data)]) + data
+		buf += b'\xff'
+
+		if reply == DHCP_NAK or flags & 0x8000: dst = '255.255.255.255'
+		elif int(ciaddr): dst = str(ciaddr)
+		else: # unicast to address that client doesn't have yet
+			dst = str(ip)
+			try:
+				get_rtnl().request([( RTM_NEWNEIGH, NLM_F_CREATE | NLM_F_REPLACE,
+					struct.pack('BxxxiHBB', socket.AF_INET, self.index, NUD_STALE, 0, 0)
+					+ nl_attr(NDA_DST, ip.packed) + nl_attr(NDA_LLADDR, chaddr[:6]) )])
+			except OSError as err:
+				log.debug('Failed to add neighbour entry for %s (%s): %s', ip, mac, err)
+				dst = '255.255.255.255'
+		try: self.sock.sendto(buf, (dst, 68))
+		except OSError as err: return log.debug('Failed to send DHCP reply to %s: %s', dst, err)
+		stat_inc('dhcp_replies_total', type=dhcp_msg_names[reply])
+		if reply == DHCP_ACK and mtype != DHCP_INFORM:
+			self.leases[mac] = [ip, ts + self.lease_time]
+			self.lease_save(delay=bool(lease and lease[0] == ip)) # only expiry changed
+			if not int(ciaddr): self.on_lease(mac) # not a renewal
+		stat_set('dhcp_leases', sum(1 for ip, expires in self.leases.values() if expires > ts))
+
+
+### link aggregation
+
+IFLA_BOND_MODE, IFLA_BOND_MIIMON, IFLA_BOND_XMIT_HASH_POLICY = 1, 3, 14
+BOND_XMIT_POLICY_LAYER34 = 1
+bond_modes = {'balance-rr': 0, 'active-backup': 1, 'balance-xor': 2}
+
+class LinkBond(object):
+	'''Enslaves bnep interfaces of client links (one per local adapter) to a bond,
+		which keeps traffic on one of them (active-backup), with others taking over
+		when a link is lost, or spreads outgoing traffic over all of them (balance-rr,
+		or per-flow balance-xor). Latter does not aggregate downstream bandwidth
+		with links to same NAP, as its bridge sees bond address on several ports,
+		and keeps moving it between them (flapping FDB entry).
+		Bond is created if missing and left in place on exit, same as bridge with --bridge-setup.
+		Lost bnep interfaces go away and drop out of the bond, new ones are added on reconnect.
+		Used as ClientLink handler.'''
+
+	miimon = 100 # ms, link state checks, to stop using bnep interface as soon as it is down
+
+	def __init__(self, name, mode='active-backup'):
+		self.name, self.mode, self.index = name, mode, None
+
+	def start(self):
+		nl, bond = get_rtnl(), nl_link_get(self.name)
+		if not bond:
+			data = [(IFLA_BOND_MODE, bytes([bond_modes[self.mode]])), (IFLA_BOND_MIIMON, self.miimon)]
+			if self.mode == 'balance-xor':
+				data.append((IFLA_BOND_XMIT_HASH_POLICY, bytes([BOND_XMIT_POLICY_LAYER34])))
+			try:
+				nl.request([( RTM_NEWLINK, NLM_F_CREATE | NLM_F_EXCL, nl_link_msg(attrs=[ (IFLA_IFNAME, self.name),
+					(IFLA_LINKINFO, [(IFLA_INFO_KIND, 'bond'), (IFLA_INFO_DATA, data)]) ]) )])
+			except OSError as err: # EOPNOTSUPP without bonding module
+				raise BTError('Failed to create bond interface {}: {}'.format(self.name, err))
+			bond = nl_link_get(self.name)
+			log.debug('Created bond interface: %s (mode: %s)', self.name, self.mode)
+		elif bond['kind'] != 'bond':
+			raise BTError('Interface {} exists, but is not a bond ({})'.format(self.name, bond['kind']))
+		self.index = bond['index']
+		nl.request([(RTM_NEWLINK, 0, nl_link_msg(self.index, IFF_UP, IFF_UP))])
+		stats_collectors.append(self.collect)
+
+	def stop(self):
+		if self.index is None: return
+		stats_collectors.remove(self.collect)
+		self.index = None
+
+	def on_link(self, link, event, value):
+		if event != 'connected' or not link.iface or self.index is None: return
+		try:
+			get_rtnl().request([ # interface must be down to be enslaved, bond brings it up
+				(RTM_NEWLINK, 0, nl_link_msg(change=IFF_UP, attrs=[(IFLA_IFNAME, link.iface)])),
+				(RTM_NEWLINK, 0, nl_link_msg(attrs=[(IFLA_IFNAME, link.iface), (IFLA_MASTER, self.index)])) ])
+		except OSError as err:
+			return log.error('Failed to add %s to bond %s: %s', link.iface, self.name, err)
+		log.debug('Added %s to bond %s', link.iface, self.name)
+
+	def collect(self):
+		stat_set('client_bond_links', sum(1 for link in nl_links() if link['master'] == self.index))
+
+
+### roaming
+
+RTM_DELADDR, RTM_GETADDR, RTM_GETROUTE = 21, 22, 26
+IFA_BROADCAST, IFA_CACHEINFO = 4, 6
+RTA_DST, RTA_PRIORITY, RTA_PREFSRC = 1, 6, 7
+ETH_P_ARP = 0x0806
+handover_time_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2)
+
+def link_move(old, new):
+	'''Moves IPv4 addresses and gateway routes (main table) from old to new interface
+		in one netlink batch: addresses are added to new one, routes replaced with same
+		ones (dst, metric) via new one, then addresses removed from old one.
+		Established connections keep using same addresses. Returns (addrs, default gw).'''
+	import ipaddress, socket
+	nl, old, new = get_rtnl(), nl_link_get(old)['index'], nl_link_get(new)['index']
+	addrs, msgs_add, msgs_del = list(), list(), list()
+	for mtype, payload in nl.request([(RTM_GETADDR, NLM_F_DUMP, struct.pack('BBBBI', socket.AF_INET, 0, 0, 0, 0))]):
+		family, prefixlen, flags, scope, index = struct.unpack_from('BBBBI', payload)
+		if family != socket.AF_INET or index != old: continue
+		attrs = nl_attrs(payload, 8)
+		addrs.append('{}/{}'.format(ipaddress.ip_address(attrs[IFA_LOCAL]), prefixlen))
+		msgs_add.append(( RTM_NEWADDR, NLM_F_CREATE | NLM_F_REPLACE,
+			struct.pack('BBBBI', family, prefixlen, flags, scope, new) + b''.join( nl_attr(k, attrs[k])
+				for k in [IFA_LOCAL, IFA_ADDRESS, IFA_BROADCAST, IFA_CACHEINFO] if k in attrs ) ))
+		msgs_del.append((RTM_DELADDR, 0, payload))
+	gw, msgs_route = None, list()
+	for mtype, payload in nl.request([(RTM_GETROUTE, NLM_F_DUMP, struct.pack('BBBBBBBBI', socket.AF_INET, *[0]*8))]):
+		hdr, attrs = list(struct.unpack_from('BBBBBBBBI', payload)), nl_attrs(payload, 12)
+		if hdr[4] != RT_TABLE_MAIN or RTA_GATEWAY not in attrs: continue
+		if struct.unpack('I', attrs.get(RTA_OIF, b'\0' * 4))[0] != old: continue
+		if not hdr[1]: gw = str(ipaddress.ip_address(attrs[RTA_GATEWAY]))
+		hdr[8] = 0 # rtm_flags
+		msgs_route.append(( RTM_NEWROUTE, NLM_F_CREATE | NLM_F_REPLACE,
+			struct.pack('BBBBBBBBI', *hdr) + nl_attr(RTA_OIF, new) + b''.join( nl_attr(k, attrs[k])
+				for k in [RTA_DST, RTA_GATEWAY, RTA_PRIORITY, RTA_PREFSRC] if k in attrs ) ))
+	nl.request(msgs_add + msgs_route + msgs_del, ignore=[errno.EEXIST, errno.EADDRNOTAVAIL])
+	return addrs, gw
+
+def arp_probe(iface, src, dst, handler, timeout=2.0):
+	'''Broadcasts ARP request for dst from src address on iface, which also updates
+		neighbour caches and bridge forwarding tables on the way for new link.
+		Calls handler(seconds) when reply arrives, or handler(None) on timeout.'''
+	import socket, ipaddress
+	src, dst = (ipaddress.ip_address(addr.split('/')[0]).packed for addr in [src, dst])
+	mac = nl_link_get(iface)['attrs'][IFLA_ADDRESS][:6]
+	sock = socket.socket( socket.AF_PACKET,
+		socket.SOCK_DGRAM | socket.SOCK_NONBLOCK | socket.SOCK_CLOEXEC, socket.htons(ETH_P_ARP) )
+	sock.bind((iface, ETH_P_ARP))
+	ts, timer = time.monotonic(), None
+	def done(td):
+		loop_remove_reader(sock.fileno())
+		loop_cancel(timer)
+		sock.close()
+		handler(td)
+	def on_recv():
+		while True:
+			try: pkt = sock.recv(64)
+			except BlockingIOError: return
+			if pkt[6:8] == b'\0\2' and pkt[14:18] == dst: return done(time.monotonic() - ts)
+	loop_add_reader(sock.fileno(), on_recv)
+	timer = loop_call_later(timeout, done, None)
+	sock.sendto( struct.pack('!HHBBH6s4s6s4s', 1, 0x0800, 6, 4, 1, mac, src, bytes(6), dst),
+		(iface, ETH_P_ARP, 0, 0, b'\xff' * 6) )
+
+
+### hci/mgmt
+
+BTPROTO_HCI, HCI_CHANNEL_RAW, HCI_CHANNEL_CONTROL, HCI_DEV_NONE = 1, 0, 3, 0xffff
+HCISETLINKPOL = 0x400448de # _IOW('H', 222, int)
+HCI_LP = dict(rswitch=1, hold=2, sniff=4, park=8)
+MGMT_EV_CMD_COMPLETE, MGMT_EV_CMD_STATUS, MGMT_EV_INDEX_ADDED = 1, 2, 4
+MGMT_OP_SET_CONNECTABLE, MGMT_OP_SET_FAST_CONNECTABLE = 0x07, 0x13
+MGMT_OP_GET_CONN_INFO, MGMT_OP_SET_DEF_SYSTEM_CONFIG = 0x31, 0x4b
+MGMT_SC_PAGE_SCAN_TYPE, MGMT_SC_PAGE_SCAN_INT, MGMT_SC_PAGE_SCAN_WIN = 0, 1, 2
+
+def hci_index(dev):
+	'Returns hciN number for Adapter1 proxy.'
+	return int(dev.object_path.rsplit('/hci', 1)[-1])
+
+def hci_socket(dev=HCI_DEV_NONE, channel=HCI_CHANNEL_RAW):
+	'Returns HCI socket bound to dev/channel, via libc, as python lacks sockaddr_hci channel support.'
+	import socket, ctypes
+	sock = socket.socket(AF_BLUETOOTH, socket.SOCK_RAW | socket.SOCK_CLOEXEC, BTPROTO_HCI)
+	addr = struct.pack('=HHH', AF_BLUETOOTH, dev, channel)
+	libc = ctypes.CDLL(None, use_errno=True)
+	if libc.bind(sock.fileno(), addr, len(addr)):
+		err = ctypes.get_errno()
+		sock.close()
+		raise OSError(err, 'Failed to bind HCI socket (dev={}, channel={}): {}'.format(
+			dev, channel, os.strerror(err) ))
+	return sock
+
+def mgmt_reply(buf, index, op):
+	'''Returns response parameters if buf is mgmt reply to op command, None for other events,
+		raising BTError on failure status.'''
+	ev, ev_index, n = struct.unpack_from('<HHH', buf)
+	if ev not in [MGMT_EV_CMD_COMPLETE, MGMT_EV_CMD_STATUS] or ev_index != index: return
+	ev_op, status = struct.unpack_from('<HB', buf, 6)
+	if ev_op != op: return
+	if status: raise BTError(
+		'mgmt command 0x{:04x} failed for hci{}, status: 0x{:02x}'.format(op, index, status) )
+	return buf[9:6+n]
+
+def mgmt_request(sock, index, op, params=b''):
+	'Sends mgmt command and returns its response parameters, raising BTError on failure.'
+	sock.send(struct.pack('<HHH', op, index, len(params)) + params)
+	while True:
+		reply = mgmt_reply(sock.recv(1024), index, op)
+		if reply is not None: return reply
+
+class MgmtRequest(object):
+	'''Same as mgmt_request, but with response read from event loop instead of blocking it.
+		Runs callback(reply, err) with either response parameters or exception,
+		unless cancel() is called before that.'''
+
+	def __init__(self, index, op, params, callback, timeout=2.0):
+		self.index, self.op, self.callback, self.sock = index, op, callback, None
+		try:
+			self.sock = hci_socket(channel=HCI_CHANNEL_CONTROL)
+			self.sock.setblocking(False)
+			self.sock.send(struct.pack('<HHH', op, index, len(params)) + params)
+		except OSError as err:
+			if self.sock: self.sock.close()
+			self.sock, self.timer = None, loop_call_later(0, callback, None, err)
+			return
+		loop_add_reader(self.sock.fileno(), self.on_read)
+		self.timer = loop_call_later( timeout, self.done, None,
+			BTError('mgmt command 0x{:04x} timed out for hci{}'.format(op, index)) )
+
+	def cancel(self):
+		if self.timer: loop_cancel(self.timer)
+		if self.sock:
+			loop_remove_reader(self.sock.fileno())
+			self.sock.close()
+		self.sock = self.timer = None
+
+	def done(self, reply, err=None):
+		self.cancel()
+		self.callback(reply, err)
+
+	def on_read(self):
+		while self.sock:
+			try: reply = mgmt_reply(self.sock.recv(1024), self.index, self.op)
+			except BlockingIOError: return
+			except (OSError, BTError, struct.error) as err: return self.done(None, err)
+			if reply is not None: return self.done(reply)
+
+def hci_conn_rssi_query(index, addr, callback):
+	'''Queries RSSI (dBm) of BR/EDR connection to addr on hciN without blocking,
+		running callback(rssi, err), with rssi=None if it's not available.
+		Returns MgmtRequest, which can be cancelled.'''
+	def done(info, err):
+		rssi = struct.unpack_from('b', info, 7)[0] if not err else None
+		callback(None if rssi == 127 else rssi, err)
+	return MgmtRequest( index, MGMT_OP_GET_CONN_INFO,
+		bytes.fromhex(addr.replace(':', ''))[::-1] + b'\0', done ) # bdaddr_t is little-endian
+
+class MgmtIndexWatch(object):
+	'''Records when kernel adds hciN controllers (mgmt Index Added events),
+		which is right after USB enumeration, before bluetoothd sets them up.
+		Timestamps (time.monotonic) are kept in "added" dict by index.'''
+
+	def __init__(self):
+		self.added, self.sock = dict(), hci_socket(channel=HCI_CHANNEL_CONTROL)
+		self.sock.setblocking(False)
+		loop_add_reader(self.sock.fileno(), self.on_event)
+
+	def close(self):
+		loop_remove_reader(self.sock.fileno())
+		self.sock.close()
+
+	def on_event(self):
+		while True:
+			try: buf = self.sock.recv(1024)
+			except BlockingIOError: return
+			ev, index, n = struct.unpack_from('<HHH', buf)
+			if ev == MGMT_EV_INDEX_ADDED: self.added[index] = time.monotonic()
+
+def hci_set_connectable(index, state):
+	'Enables/disables page scan on hciN via mgmt API, for bluez without writable Connectable property.'
+	with hci_socket(channel=HCI_CHANNEL_CONTROL) as sock:
+		sock.settimeout(2.0)
+		mgmt_request(sock, index, MGMT_OP_SET_CONNECTABLE, bytes([bool(state)]))
+
+def hci_tune(index, fast_connectable=False, page_scan=None, link_policy=None):
+	'''Applies connection setup tuning to hciN adapter via kernel mgmt API.
+		page_scan is (type, interval, window) tuple, with None for kernel defaults,
+			where type is 0 (standard) or 1 (interlaced) and interval/window are in ms.
+		link_policy is a list of HCI_LP keys to replace default link policy with.'''
+	import socket
+	with hci_socket(channel=HCI_CHANNEL_CONTROL) as sock:
+		sock.settimeout(2.0)
+		params = b''
+		for sc, v in zip([ MGMT_SC_PAGE_SCAN_TYPE,
+				MGMT_SC_PAGE_SCAN_INT, MGMT_SC_PAGE_SCAN_WIN ], page_scan or ()):
+			if v is None: continue
+			if sc != MGMT_SC_PAGE_SCAN_TYPE: v = round(v / 0.625) # baseband slots
+			params += struct.pack('<HBH', sc, 2, v)
+		if params: mgmt_request(sock, index, MGMT_OP_SET_DEF_SYSTEM_CONFIG, params)
+		# Fast connectable mode uses interlaced page scan with short interval,
+		#  overriding page scan parameters above while enabled
+		if fast_connectable: mgmt_request(sock, index, MGMT_OP_SET_FAST_CONNECTABLE, b'\1')
+	if link_policy is not None:
+		import fcntl
+		policy = sum(HCI_LP[k] for k in link_policy)
+		with socket.socket(AF_BLUETOOTH, socket.SOCK_RAW | socket.SOCK_CLOEXEC, BTPROTO_HCI) as sock:
+			fcntl.ioctl(sock.fileno(), HCISETLINKPOL, struct.pack('@HI', index, policy))
+	log.debug( 'Applied connection tuning to hci%s: fast-connectable=%s'
+		' page-scan=%s link-policy=%s', index, fast_connectable, page_scan, link_policy )
+
 
 ### bt-pan
 
+def sd_notify(*states):
+	'''Sends newline-separated states to $NOTIFY_SOCKET, same as sd_notify(3).
+		Returns False if not running under systemd with notification socket.'''
+	path = os.environ.get('NOTIFY_SOCKET')
+	if not path: return False
+	import socket
+	if path.startswith('@'): path = '\0' + path[1:] # abstract namespace
+	with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM | socket.SOCK_CLOEXEC) as sock:
+		sock.connect(path)
+		sock.sendall('\n'.join(states).encode())
+	return True
+
+class Watchdog(object):
+	'''Pings systemd watchdog only when health probe - Peer.Ping call to
+		bluetoothd - succeeds within deadline, so that hung bluetoothd/dbus
+		or event loop get the service restarted by systemd.'''
+
+	def __init__(self, interval, deadline):
+		self.deadline, self.probing = deadline, False
+		loop_call_every(interval, self.probe)
+
+	def probe(self):
+		if self.probing: return # previous one still pending
+		self.probing = True
+		get_manager().Ping( dbus_interface='org.freedesktop.DBus.Peer',
+			reply_handler=self.on_reply, error_handler=self.on_error, timeout=self.deadline )
+
+	def on_reply(self):
+		self.probing = False
+		sd_notify('WATCHDOG=1')
+
+	def on_error(self, err):
+		self.probing = False
+		stat_inc('watchdog_probe_failures_total')
+		log.warning('BlueZ health probe failed, not pinging watchdog: %s', err)
+
+class AdapterBalancer(object):
+	'''Steers new clients of a multi-adapter server away from loaded adapters.
+		Load is max(connections / max_conns, rx+tx rate / max_rate) per adapter,
+		with bnep ports mapped to adapters by MAC, which is the local adapter address.
+		Adapters at or over 1.0 load are made non-connectable/discoverable
+		while any other one is under it, which leaves established links up.
+		Connectable state is set via kernel mgmt API on bluez versions where
+		adapter property for it is read-only.'''
+
+	def __init__(self, devs, max_conns=None, max_rate=None):
+		self.devs, self.max_conns, self.max_rate = devs, max_conns, max_rate
+		self.closed = dict() # {addr: discoverable state to restore}
+		self.use_mgmt = False
+
+	def update(self, bnep_stats):
+		conns, rates = dict.fromkeys(self.devs, 0), dict.fromkeys(self.devs, 0)
+		for port in bnep_stats.ports.values():
+			if port['local'] not in conns: continue
+			conns[port['local']] += 1
+			rates[port['local']] += sum(port['rates'].get(k, 0) for k in ['rx_bytes', 'tx_bytes'])
+		loads = dict()
+		for addr in self.devs:
+			loads[addr] = max(
+				conns[addr] / self.max_conns if self.max_conns else 0,
+				rates[addr] / self.max_rate if self.max_rate else 0 )
+			stat_set('adapter_connections', conns[addr], adapter=addr)
+			stat_set('adapter_load', round(loads[addr], 2), adapter=addr)
+		has_spare = any(load < 1 for load in loads.values())
+		for addr, dev in self.devs.items():
+			close = has_spare and loads[addr] >= 1
+			if close == (addr in self.closed): continue
+			try: self.set_open(addr, dev, not close)
+			except (DBusError, BTError, OSError) as err:
+				log.warning('Failed to toggle connectable state of adapter %s: %s', addr, err)
+
+	def set_open(self, addr, dev, state):
+		if not state:
+			log.debug('Adapter %s is loaded, steering new clients to other ones', addr)
+			self.closed[addr], discoverable = bool(prop_get(dev, 'Discoverable')), False
+		else:
+			log.debug('Adapter %s is accepting new clients again', addr)
+			discoverable = self.closed.pop(addr)
+		if not self.use_mgmt:
+			try: prop_set(dev, 'Connectable', state) # newer bluez only
+			except DBusError as err:
+				log.debug( 'Failed to set adapter Connectable property (%s),'
+					' using kernel mgmt API instead', err.get_dbus_name() )
+				self.use_mgmt = True
+		if self.use_mgmt: hci_set_connectable(hci_index(dev), state)
+		prop_set(dev, 'Discoverable', discoverable)
+		stat_inc('adapter_steer_toggles_total', adapter=addr)
+
+	def reopen(self):
+		for addr in list(self.closed): self.set_open(addr, self.devs[addr], True)
+
+
+adapter_time_buckets = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10)
+
+class NAPServer(object):
+	'''Registers NetworkServer1 uuid/bridge on local adapters (devs dict of
+		address to Adapter1 proxy, updated in-place), re-powering and re-registering
+		all of them after bluetoothd restart, retrying for up to restart_timeout seconds.
+		Adapters that appear later (plugged in or re-enumerated after reset) are powered
+		and registered as soon as bluetoothd exports them - any new one with hotplug_all,
+		otherwise only ones already in devs - and removed ones are dropped from devs.
+		Handlers are called as handler(addr, dev) for added, re-registered (after
+		bluetoothd restart, once adapter is powered up again) and re-powered adapters,
+		and handler(addr, None) for removed ones, e.g. to apply per-adapter settings.'''
+
+	restart_timeout, restart_retry = 30.0, 0.5
+
+	def __init__(self, devs, uuid, bridge, hotplug_all=False):
+		self.devs, self.uuid, self.bridge = devs, uuid, bridge
+		self.servers, self.lost_ts, self.timer, self.error = dict(), None, None, None
+		self.hotplug_all, self.handlers, self.index_watch = hotplug_all, list(), None
+		self.powered = set() # to only run handlers when adapter gets powered up by others
+
+	def start_hotplug(self):
+		get_objects().iface_handlers.append(self.on_iface)
+		get_objects().prop_handlers.append(self.on_props)
+		try: self.index_watch = MgmtIndexWatch()
+		except OSError as err:
+			log.debug('Failed to watch kernel hci index events, measuring from D-Bus ones: %s', err)
+
+	def stop_hotplug(self):
+		if self.on_iface in get_objects().iface_handlers: get_objects().iface_handlers.remove(self.on_iface)
+		if self.on_props in get_objects().prop_handlers: get_objects().prop_handlers.remove(self.on_props)
+		if self.index_watch: self.index_watch.close()
+		self.index_watch = None
+
+	def on_props(self, path, iface, changed, invalidated):
+		if iface != iface_adapter or 'Powered' not in changed or self.lost_ts is not None: return
+		for dev_addr, dev in list(self.devs.items()):
+			if dev.object_path != path or dev_addr not in self.servers: continue
+			if not changed['Powered']: self.powered.discard(dev_addr)
+			if not changed['Powered'] or dev_addr in self.powered: continue
+			self.powered.add(dev_addr)
+			log.debug('Bluetooth adapter powered up: %s (%s)', dev_addr, path)
+			for handler in self.handlers: handler(dev_addr, dev)
+
+	def on_iface(self, path, ifaces, added):
+		if iface_adapter not in ifaces or self.lost_ts is not None: return # restart re-registers all
+		ts = time.monotonic()
+		if not added:
+			for dev_addr, dev in list(self.devs.items()):
+				if dev.object_path != path: continue
+				log.debug('Bluetooth adapter removed: %s (%s)', dev_addr, path)
+				stat_inc('adapters_removed_total')
+				self.servers.pop(dev_addr, None)
+				self.powered.discard(dev_addr)
+				if self.hotplug_all: del self.devs[dev_addr]
+				for handler in self.handlers: handler(dev_addr, None)
+			return
+		dev_addr = get_objects().objects.get(path, dict()).get(iface_adapter, dict()).get('Address')
+		if not dev_addr or dev_addr in self.servers: return
+		if not self.hotplug_all and dev_addr not in self.devs:
+			return log.debug('Not using new adapter %s (%s) without --device-all', dev_addr, path)
+		dev = self.devs[dev_addr] = dbus_iface(get_bus().get_object(iface_base, path), iface_adapter)
+		try:
+			prop_set(dev, 'Powered', True)
+			self.register_adapter(dev_addr, dev)
+			self.powered.add(dev_addr)
+		except DBusError as err:
+			return log.error('Failed to set up new adapter %s (%s): %s', dev_addr, path, err)
+		for handler in self.handlers: handler(dev_addr, dev)
+		plug_ts = self.index_watch and self.index_watch.added.pop(hci_index(dev), None)
+		td = time.monotonic() - (plug_ts or ts)
+		stat_inc('adapters_added_total')
+		stat_observe('adapter_plug_to_serving_seconds', td, adapter_time_buckets)
+		log.debug('Bluetooth adapter added: %s (%s), serving after %.3fs', dev_addr, path, td)
+
+	def register(self):
+		if self.lost_ts is not None and self.hotplug_all: # adapters could've come and gone meanwhile
+			self.devs.clear()
+			self.devs.update((prop_get(dev, 'Address'), dev) for dev in find_adapter())
+		for dev_addr in list(self.devs):
+			dev = self.devs[dev_addr]
+			if self.lost_ts is not None: # proxies are stale after restart
+				dev = self.devs[dev_addr] = next(iter(find_adapter(dev_addr)))
+				prop_set(dev, 'Powered', True)
+			self.register_adapter(dev_addr, dev)
+			self.powered.add(dev_addr) # powered by main() on start
+			if self.lost_ts is not None:
+				for handler in self.handlers: handler(dev_addr, dev)
+
+	def register_adapter(self, dev_addr, dev):
+		server = dbus_iface(dev, 'org.bluez.NetworkServer1')
+		server.Unregister(self.uuid) # in case already registered
+		server.Register(self.uuid, self.bridge)
+		self.servers[dev_addr] = server
+		log.debug( 'Registered uuid %r with'
+			' bridge/dev: %s / %s', self.uuid, self.bridge, dev_addr )
+
+	def unregister(self):
+		if self.timer: loop_cancel(self.timer)
+		for server in self.servers.values():
+			try: server.Unregister(self.uuid)
+			except DBusError as err:
+				log.warning('Failed to unregister server: %s', err)
+		if self.servers: log.debug('Unregistered server uuids')
+		self.servers.clear()
+
+	def on_bluez(self, up):
+		if self.timer: loop_cancel(self.timer)
+		self.timer = None
+		self.lost_ts = get_bt_watch().lost_ts
+		if not up:
+			self.servers.clear()
+			self.powered.clear()
+			sd_notify('STATUS=bluetoothd is gone, waiting for it to restart...')
+		else: self.reregister()
+
+	def reregister(self):
+		self.timer = None
+		try: self.register()
+		except (BTError, DBusError) as err:
+			if time.monotonic() - self.lost_ts < self.restart_timeout:
+				log.debug('Failed to re-register server (will retry): %s', err)
+				self.timer = loop_call_later(self.restart_retry, self.reregister)
+				return
+			log.error('Failed to re-register server after bluetoothd restart: %s', err)
+			self.error = err
+			return loop_stop()
+		td, self.lost_ts = time.monotonic() - self.lost_ts, None
+		stat_set('bluez_reregister_seconds', round(td, 3))
+		log.warning('Re-registered server %.1fs after bluetoothd restart', td)
+		sd_notify('STATUS=Running in server mode...')
+
+class ClientLink(object):
+	'''Keeps Network1 connection to a remote device up.
+		Link loss (Connected=False via PropertiesChanged) is followed by an immediate
+		reconnect, with exponential backoff and jitter between attempts that keep failing.
+		Errors that retrying won't fix stop the event loop, leaving them in "error" attribute.
+		Handlers are called as handler(link, event, value) for "connected" (with
+		connect time), "failed" (error class) and "lost" events.'''
+
+	backoff_min, backoff_max = 1.0, 120.0
+
+	def __init__(self, dev_remote, uuid):
+		self.dev, self.uuid = dev_remote, uuid
+		self.net = dbus_iface(dev_remote, iface_net)
+		self.failures, self.lost_ts, self.timer = 0, None, None
+		self.connecting, self.error, self.restart_ts = False, None, None
+		self.iface, self.connect_ts, self.handlers, self.active = None, None, list(), False
+
+	def start(self, iface=None):
+		'Starts connecting, or supervising already established link with iface, if passed.'
+		get_objects().prop_handlers.append(self.on_props)
+		get_bt_watch().handlers.append(self.on_bluez)
+		self.active = True
+		if iface: self.iface = iface
+		else: self.connect()
+
+	def stop(self):
+		if not self.active: return
+		get_objects().prop_handlers.remove(self.on_props)
+		get_bt_watch().handlers.remove(self.on_bluez)
+		if self.timer: loop_cancel(self.timer)
+		self.timer, self.active = None, False
+
+	def on_props(self, path, iface, changed, invalidated):
+		if path != self.dev.object_path or iface != iface_net: return
+		if changed.get('Connected', True) or self.connecting or self.timer: return
+		log.warning('Lost network link to %s, reconnecting', path)
+		sd_notify('STATUS=Link lost, reconnecting...')
+		stat_inc('client_link_lost_total')
+		self.lost_ts, self.iface = time.monotonic(), None
+		for handler in self.handlers: handler(self, 'lost', None)
+		if self.active: self.connect()
+
+	def on_bluez(self, up):
+		if self.timer: loop_cancel(self.timer)
+		self.timer = None
+		if not up:
+			if self.lost_ts is None: self.lost_ts = time.monotonic()
+			return
+		# Same object path, but proxies are bound to old bluetoothd connection
+		self.restart_ts = time.monotonic()
+		self.dev = dbus_iface(get_bus().get_object(iface_base, self.dev.object_path), iface_dev)
+		self.net = dbus_iface(self.dev, iface_net)
+		if not self.connecting: self.connect()
+
+	def schedule(self):
+		self.failures += 1
+		delay = min(self.backoff_max, self.backoff_min * 2**(self.failures - 1))
+		import random
+		delay = random.uniform(delay / 2, delay)
+		log.debug('Reconnect attempt %s in %.1fs', self.failures + 1, delay)
+		self.timer = loop_call_later(delay, self.connect)
+
+	def connect(self):
+		self.timer, self.connecting, self.connect_ts = None, True, time.monotonic()
+		stat_inc('client_connect_attempts_total')
+		# ConnectProfile fails sometimes, but still creates Network1 interface
+		self.dev.ConnectProfile( self.uuid,
+			reply_handler=self.connect_net, error_handler=self.on_profile_error )
+
+	def on_profile_error(self, err):
+		if bt_error_class(err) == 'fatal': return self.on_error(err)
+		log.debug('ConnectProfile failed (%s), trying Network1.Connect', err.get_dbus_name())
+		self.connect_net()
+
+	def connect_net(self):
+		self.net.Connect( self.uuid,
+			reply_handler=self.on_connected, error_handler=self.on_error )
+
+	def on_connected(self, iface):
+		self.connecting, self.failures, self.iface = False, 0, iface
+		stat_inc('client_connect_success_total')
+		if self.lost_ts is not None:
+			td = time.monotonic() - self.lost_ts
+			stat_set('client_reconnect_seconds', td)
+			stat_inc('client_reconnect_seconds_total', td)
+			self.lost_ts = None
+		log.debug('Connected to network (dev_remote: %s) with iface: %s', self.dev.object_path, iface)
+		sd_notify('STATUS=Connected with iface: {}'.format(iface))
+		for handler in self.handlers: handler(self, 'connected', time.monotonic() - self.connect_ts)
+
+	def on_error(self, err):
+		self.connecting, err_class = False, bt_error_class(err)
+		if err_class == 'fatal' and self.restart_ts is not None \
+				and time.monotonic() - self.restart_ts < NAPServer.restart_timeout:
+			err_class = 'transient' # objects can still be missing after bluetoothd restart
+		stat_inc('client_connect_failures_total', reason=err_class)
+		if err_class != 'fatal':
+			try: connected = prop_get(self.net, 'Connected')
+			except DBusError: connected = False
+			if connected: return self.on_connected(prop_get(self.net, 'Interface'))
+		log.debug('Failed to connect to %s (%s): %s', self.dev.object_path, err_class, err)
+		for handler in self.handlers: handler(self, 'failed', err_class)
+		if not self.active: return # handler switched to other device
+		if err_class == 'fatal':
+			log.error('Failed to connect to %s: %s', self.dev.object_path, err)
+			self.error = err
+			return loop_stop()
+		self.schedule()
+
+def client_connect(dev_remote, uuid, reconnect=False, if_not_connected=False):
+	'''Connects to remote NAP device with blocking calls, returning (net, iface).
+		Pre-established connection is either re-established, used or raises error.'''
+	try: dev_remote.ConnectProfile(uuid)
+	except DBusError as err:
+		# Fails sometimes, but still creates dbus interface
+		if bt_error_class(err) == 'fatal': raise
+		log.debug('ConnectProfile failed (%s), trying Network1.Connect', err.get_dbus_name())
+	net = dbus_iface(dev_remote, iface_net)
+	for n in range(2):
+		try: iface = net.Connect(uuid)
+		except DBusError as err:
+			if err.get_dbus_name() != 'org.bluez.Error.Failed': raise
+			connected = prop_get(net, 'Connected')
+			if not connected: raise
+			if reconnect and not n:
+				log.debug( 'Detected pre-established connection'
+					' (iface: %s), reconnecting', prop_get(net, 'Interface') )
+				net.Disconnect()
+				continue
+			if not if_not_connected: raise
+			iface = prop_get(net, 'Interface')
+		break
+	return net, iface
+
+client_time_buckets = (0.5, 1, 2, 3, 5, 7.5, 10, 15, 20, 30, 60)
+
+class ConnectRace(object):
+	'''Connects to several candidate NAP devices at once, keeping first link to come up.
+		Attempts (async ConnectProfile + Network1.Connect, same as in ClientLink) run for up to
+		"parallel" candidates at a time, in passed order, each one limited to deadline seconds,
+		with next candidate started when one fails. Once one connects, pending attempts are
+		aborted via Device1.Disconnect and ones that still connect later get disconnected.
+		handler(race, addr, iface) is called once, with addr=None if all attempts failed,
+		connect times (None for failures) in "times" and last error in "error" attributes.'''
+
+	def __init__(self, devs, uuid, handler, parallel=None, deadline=15.0):
+		self.devs, self.uuid, self.handler, self.deadline = devs, uuid, handler, deadline
+		self.parallel, self.queue, self.pending = parallel or len(devs), list(), dict()
+		self.times, self.error, self.ts = dict(), None, None
+
+	def start(self, addrs):
+		self.queue, self.ts = list(addrs), time.monotonic()
+		while self.queue and len(self.pending) < self.parallel: self.attempt(self.queue.pop(0))
+		if not self.pending: self.done(None, None)
+
+	def stop(self):
+		self.handler, self.queue = None, list()
+		for addr in list(self.pending): self.abort(addr)
+
+	def attempt(self, addr):
+		import functools as ft
+		log.debug('Connecting to %s', addr)
+		stat_inc('client_connect_attempts_total')
+		self.pending[addr] = time.monotonic(), loop_call_later(self.deadline, self.on_error, addr, None)
+		self.devs[addr].ConnectProfile( self.uuid, timeout=self.deadline,
+			reply_handler=ft.partial(self.connect_net, addr),
+			error_handler=ft.partial(self.on_profile_error, addr) )
+
+	def on_profile_error(self, addr, err):
+		if addr not in self.pending: return
+		if bt_error_class(err) == 'fatal': return self.on_error(addr, err)
+		log.debug('ConnectProfile to %s failed (%s), trying Network1.Connect', addr, err.get_dbus_name())
+		self.connect_net(addr)
+
+	def connect_net(self, addr):
+		import functools as ft
+		if addr not in self.pending: return
+		timeout = max(0.1, self.deadline - (time.monotonic() - self.pending[addr][0]))
+		dbus_iface(self.devs[addr], iface_net).Connect( self.uuid, timeout=timeout,
+			reply_handler=ft.partial(self.on_connected, addr),
+			error_handler=ft.partial(self.on_error, addr) )
+
+	def abort(self, addr):
+		ts, timer = self.pending.pop(addr)
+		loop_cancel(timer)
+		self.devs[addr].Disconnect(reply_handler=lambda: None, error_handler=lambda err: None)
+
+	def on_connected(self, addr, iface):
+		if addr not in self.pending: # aborted or timed out, but still connected
+			log.debug('Disconnecting late link to %s', addr)
+			return dbus_iface(self.devs[addr], iface_net).Disconnect(
+				reply_handler=lambda: None, error_handler=lambda err: None )
+		ts, timer = self.pending.pop(addr)
+		loop_cancel(timer)
+		self.times[addr] = time.monotonic() - ts
+		stat_inc('client_connect_success_total')
+		log.debug('Connected to network (dev_remote: %s) with iface: %s', self.devs[addr].object_path, iface)
+		sd_notify('STATUS=Connected with iface: {}'.format(iface))
+		for k in list(self.pending):
+			log.debug('Aborting connection attempt to %s', k)
+			self.abort(k)
+		self.queue = list()
+		self.done(addr, iface)
+
+	def on_error(self, addr, err):
+		'Handles failed attempt, with err=None for deadline.'
+		if addr not in self.pending: return
+		err_class = 'timeout' if err is None else bt_error_class(err)
+		if err is not None and err_class != 'fatal':
+			try: connected = prop_get(dbus_iface(self.devs[addr], iface_net), 'Connected')
+			except DBusError: connected = False
+			if connected: return self.on_connected(addr, prop_get(dbus_iface(self.devs[addr], iface_net), 'Interface'))
+		if err is None:
+			err = DBusError('org.freedesktop.DBus.Error.NoReply', 'Timeout after {:.1f}s'.format(self.deadline))
+			self.abort(addr) # stops paging
+		else: loop_cancel(self.pending.pop(addr)[1])
+		log.debug('Failed to connect to %s (%s): %s', addr, err_class, err)
+		stat_inc('client_connect_failures_total', reason=err_class)
+		self.times[addr], self.error = None, err
+		if self.queue: self.attempt(self.queue.pop(0))
+		elif not self.pending: self.done(None, None)
+
+	def done(self, addr, iface):
+		handler, self.handler = self.handler, None
+		if addr: stat_observe('client_time_to_network_seconds', time.monotonic() - self.ts, client_time_buckets)
+		if handler: handler(self, addr, iface)
+
+def client_connect_race( devs, uuid, addrs, parallel=None,
+		deadline=15.0, reconnect=False, if_not_connected=False ):
+	'''Same as client_connect, but for several candidate devices at once, using ConnectRace
+		and running event loop until it is done. Returns (addr, net, iface, connect times).'''
+	for addr in addrs:
+		net = dbus_iface(devs[addr], iface_net)
+		try:
+			if not prop_get(net, 'Connected'): continue
+		except DBusError: continue
+		if reconnect:
+			log.debug('Detected pre-established connection to %s, reconnecting', addr)
+			net.Disconnect()
+		elif if_not_connected: return addr, net, prop_get(net, 'Interface'), dict()
+		else: raise BTError('Already connected to {}'.format(addr))
+	result = list()
+	def on_done(race, addr, iface):
+		result.extend([addr, iface])
+		if get_loop().is_running(): loop_stop() # not when race is over right away
+	race = ConnectRace(devs, uuid, on_done, parallel, deadline)
+	race.start(addrs)
+	try:
+		if race.handler: loop_run()
+	finally: race.stop()
+	if not result: raise BTError('Interrupted while connecting')
+	addr, iface = result
+	if not addr: raise race.error or BTError('No NAP candidates to connect to')
+	return addr, dbus_iface(devs[addr], iface_net), iface, race.times
+
+class NAPSelector(object):
+	'''Keeps ClientLink to the best one of several candidate NAP devices.
+		Candidates are ranked by score = RSSI (dBm; measured on current link,
+		cached in Device1 properties or from history for others), minus penalties
+		for slow connects and recent failures, plus bonus for throughput seen before.
+		Connect times, RSSI and throughput are kept in history_file across restarts.
+		Link is switched when other candidate scores better by margin dB for
+		switch_after checks in a row, or right away when connecting to current one fails.
+		With race > 1, initial connection and failover use ConnectRace with that many
+		candidates at once, keeping whichever connects first, instead of best-ranked one.
+		With roam_rssi set, RSSI of current link is also checked every roam_interval,
+		and when it drops below that or other NAP ranks better, link to better one is
+		made first (via alt adapter, if any, or same one), addresses and routes are moved
+		to it with link_move() and only then old link is disconnected (make-before-break).
+		Has same start/stop/net/error/handlers interface as ClientLink,
+		with "connected" event value being None for links adopted from ConnectRace.'''
+
+	history_file = '/var/lib/btnap/nap-history.json'
+	rssi_default, connect_penalty, fail_penalty, fails_max = -90, 3.0, 10.0, 5
+	rate_ref, rate_idle, ewma = 50e3, 1e3, 0.3
+	roam_holdoff = 10.0 # seconds after handover or failed attempt
+
+	def __init__( self, devs, uuid, adapter_index,
+			interval=30, margin=6.0, switch_after=3, race=1, deadline=15.0,
+			roam_rssi=None, roam_interval=2.0, alt=None ):
+		self.devs, self.uuid, self.adapter_index = devs, uuid, adapter_index
+		self.interval, self.margin, self.switch_after = interval, margin, switch_after
+		self.history, self.rssi, self.link, self.timer = dict(), dict(), None, None
+		self.better, self.check_ts, self.rate_sample, self.error = (None, 0), None, None, None
+		self.attempts, self.race, self.deadline, self.racing = 0, race, deadline, None
+		self.roam_rssi, self.roam_interval, self.roaming, self.roam_ts = roam_rssi, roam_interval, None, 0
+		self.alt, self.on_alt, self.roam_timer = alt, False, None # alt = (adapter_index, devs)
+		self.handlers, self.rssi_query = list(), None
+		self.history_load()
+		self.current = self.rank()[0]
+		for addr, dev in devs.items(): # adopt pre-established connection
+			try:
+				if prop_get(dbus_iface(dev, iface_net), 'Connected'): self.current = addr
+			except DBusError: pass
+
+	@property
+	def net(self): return dbus_iface(self.dev(self.current, self.on_alt), iface_net)
+
+	def dev(self, addr, alt=False): return (self.alt[1] if alt else self.devs)[addr]
+
+	def history_load(self):
+		import json
+		try:
+			with open(self.history_file) as src: self.history = json.load(src)
+		except FileNotFoundError: pass
+		except (OSError, ValueError) as err:
+			log.warning('Failed to load NAP history from %s: %s', self.history_file, err)
+
+	def history_save(self):
+		import json
+		os.makedirs(os.path.dirname(self.history_file), exist_ok=True)
+		tmp = self.history_file + '.new'
+		try:
+			with open(tmp, 'w') as dst: json.dump(self.history, dst)
+			os.rename(tmp, self.history_file)
+		except OSError as err: log.warning('Failed to save NAP history to %s: %s', self.history_file, err)
+
+	def history_update(self, addr, k, v):
+		h = self.history.setdefault(addr, dict())
+		h[k] = v if h.get(k) is None else h[k] * (1 - self.ewma) + v * self.ewma
+
+	def score(self, addr):
+		import math
+		h, rssi = self.history.get(addr, dict()), self.rssi.get(addr)
+		if rssi is None: # measured one is only for current link
+			rssi = get_objects().objects.get(self.devs[addr].object_path, dict()).get(iface_dev, dict()).get('RSSI')
+		if rssi is None: rssi = h.get('rssi', self.rssi_default)
+		score = ( rssi - self.connect_penalty * h.get('connect', 0)
+			- self.fail_penalty * min(self.fails_max, h.get('fails', 0)) )
+		if h.get('rate'): score += max(-6, min(6, 3 * math.log2(h['rate'] / self.rate_ref)))
+		return score
+
+	def rank(self):
+		return sorted(self.devs, key=self.score, reverse=True)
+
+	def start(self):
+		self.check_ts = time.monotonic()
+		try: connected = prop_get(self.net, 'Connected')
+		except DBusError: connected = False
+		if self.race > 1 and not connected: self.race_start()
+		else: self.switch(self.current)
+		self.timer = loop_call_every(self.interval, self.check)
+		if self.roam_rssi is not None: self.roam_timer = loop_call_every(self.roam_interval, self.roam_check)
+
+	def stop(self):
+		for timer in self.timer, self.roam_timer:
+			if timer: loop_cancel(timer)
+		for race in self.racing, self.roaming:
+			if race: race.stop()
+		if self.rssi_query: self.rssi_query.cancel()
+		if self.link: self.link.stop()
+		self.timer = self.roam_timer = self.racing = self.roaming = self.rssi_query = None
+
+	def race_start(self, reason=None):
+		import functools as ft
+		if self.link: self.link.stop()
+		self.racing = ConnectRace( self.devs, self.uuid,
+			ft.partial(self.on_race, reason), self.race, self.deadline )
+		self.racing.start(sorted(self.rank(), key=lambda addr: bool(reason) and addr == self.current))
+
+	def on_race(self, reason, race, addr, iface):
+		self.racing = None
+		for k, td in race.times.items(): self.on_connect(k, td)
+		if addr: return self.switch(addr, reason, iface)
+		log.debug('Failed to connect to any NAP device, retrying: %s', race.error)
+		self.switch(self.rank()[0], reason)
+		self.link.failures = 1
+
+	def switch(self, addr, reason=None, iface=None, alt=False):
+		if self.link:
+			self.link.stop()
+			if addr != self.current:
+				log.debug('Switching NAP link from %s to %s (%s)', self.current, addr, reason)
+				stat_inc('client_switches_total', reason=reason)
+				self.link.net.Disconnect(reply_handler=lambda: None, error_handler=lambda err: None)
+		failures = self.link.failures if self.link and reason == 'failure' and not iface else 0
+		self.current, self.better, self.rate_sample, self.attempts = addr, (None, 0), None, 0
+		self.rssi.clear()
+		self.on_alt = alt
+		self.link = ClientLink(self.dev(addr, alt), self.uuid)
+		self.link.failures = failures # backoff keeps growing when all candidates fail
+		self.link.handlers.append(self.on_link)
+		self.link.start(iface)
+		if iface:
+			for handler in self.handlers: handler(self, 'connected', None)
+
+	def on_connect(self, addr, td):
+		'Records connect time or failure (td=None) in history.'
+		h = self.history.setdefault(addr, dict())
+		if td is None: h['fails'] = h.get('fails', 0) + 1
+		else:
+			h['fails'] = 0
+			self.history_update(addr, 'connect', td)
+		self.history_save()
+
+	def on_link(self, link, event, value):
+		if link is not self.link: return
+		for handler in self.handlers: handler(self, event, value)
+		if event == 'connected': self.on_connect(self.current, value)
+		elif event == 'failed':
+			self.on_connect(self.current, None)
+			self.attempts += 1
+			if value == 'fatal' or self.attempts >= 2:
+				if self.race > 1: return self.race_start('failure')
+				for addr in self.rank():
+					if addr != self.current: return self.switch(addr, 'failure')
+
+	def rssi_start(self, callback):
+		'''Queries RSSI of current link in the background (HCI request can take seconds),
+			running callback(rssi) with None if it is not available, or when link changes.'''
+		addr, link = self.current, self.link
+		def done(rssi, err):
+			self.rssi_query = None
+			if err: log.debug('Failed to get RSSI for %s: %s', addr, err)
+			elif link is self.link: self.rssi[addr] = rssi
+			callback(rssi if link is self.link else None)
+		self.rssi_query = hci_conn_rssi_query(self.alt[0] if self.on_alt else self.adapter_index, addr, done)
+
+	def check(self):
+		'Samples current link, updates time-on-best-link and switches to better one, if any.'
+		if self.racing: return
+		if self.link.iface and not self.rssi_query: self.rssi_start(self.check_link)
+		else: self.check_link()
+
+	def check_link(self, rssi=None):
+		ts, addr, link = time.monotonic(), self.current, self.link
+		if self.racing: return
+		if link.iface:
+			if rssi is not None: self.history_update(addr, 'rssi', rssi)
+			port = nl_link_get(link.iface)
+			if port and IFLA_STATS64 in port['attrs']:
+				rx, tx = struct.unpack_from('2Q', port['attrs'][IFLA_STATS64], 16) # rx/tx_bytes
+				if self.rate_sample:
+					rate = (rx + tx - self.rate_sample[1]) / (ts - self.rate_sample[0])
+					if rate > self.rate_idle: self.history_update(addr, 'rate', rate)
+				self.rate_sample = ts, rx + tx
+			self.history_save()
+		ranked, scores = self.rank(), dict((k, self.score(k)) for k in self.devs)
+		for k, v in scores.items(): stat_set('client_nap_score', round(v, 1), remote=k)
+		if link.iface:
+			stat_inc('client_link_seconds_total', ts - self.check_ts, remote=addr)
+			if ranked[0] == addr: stat_inc('client_best_link_seconds_total', ts - self.check_ts)
+		self.check_ts = ts
+		best = ranked[0]
+		if best == addr or scores[best] < scores[addr] + self.margin: self.better = None, 0
+		else:
+			n = self.better[1] + 1 if self.better[0] == best else 1
+			self.better = best, n
+			if n < self.switch_after: pass
+			elif self.roam_rssi is None: self.switch(best, 'rank')
+			elif not self.roaming: self.roam_start([best], 'rank')
+
+	def roam_check(self):
+		'Starts handover to better-ranked NAP when RSSI of current link drops below roam_rssi.'
+		if self.racing or self.roaming or self.rssi_query or not self.link.iface: return
+		if time.monotonic() - self.roam_ts < self.roam_holdoff: return
+		self.rssi_start(self.roam_rssi_check)
+
+	def roam_rssi_check(self, rssi):
+		addr = self.current
+		if self.racing or self.roaming or rssi is None or rssi >= self.roam_rssi: return
+		score = self.score(addr)
+		addrs = list(k for k in self.rank() if k != addr and self.score(k) > score)
+		if not addrs: return
+		log.debug('RSSI of link to %s is %s dBm, roaming to one of: %s', addr, rssi, ', '.join(addrs))
+		self.roam_start(addrs, 'rssi')
+
+	def roam_start(self, addrs, reason):
+		'''Connects to one of addrs while keeping current link, via other adapter, if there
+			are two and candidates are known on it, or using same one (its controller pages
+			for new link in time slices between traffic on the current one).'''
+		import functools as ft
+		alt = self.alt is not None and not self.on_alt
+		devs = dict((k, self.dev(k, alt)) for k in addrs if k in (self.alt[1] if alt else self.devs))
+		if not devs: alt, devs = self.on_alt, dict((k, self.dev(k, self.on_alt)) for k in addrs)
+		self.roaming = ConnectRace( devs, self.uuid,
+			ft.partial(self.on_roam, reason, alt), self.race, self.deadline )
+		self.roaming.start(list(devs))
+
+	def on_roam(self, reason, alt, race, addr, iface):
+		self.roaming, self.roam_ts = None, time.monotonic()
+		for k, td in race.times.items(): self.on_connect(k, td)
+		if not addr:
+			stat_inc('client_handovers_total', result='failed')
+			return log.debug('Failed to connect to other NAP, staying on %s: %s', self.current, race.error)
+		old, ts, moved = self.link.iface, time.monotonic(), (list(), None)
+		if old:
+			try: moved = link_move(old, iface)
+			except (OSError, KeyError, TypeError) as err: # old one went away meanwhile
+				log.warning('Failed to move addresses from %s to %s: %s', old, iface, err)
+		log.debug('Moved addresses %s and routes from %s to %s', ', '.join(moved[0]) or '-', old, iface)
+		self.switch(addr, reason, iface, alt) # disconnects old link
+		addrs, gw = moved
+		def on_probe(td):
+			if td is None:
+				stat_inc('client_handovers_total', result='no-reply')
+				return log.warning('No ARP reply from gateway %s on %s after handover', gw, iface)
+			stat_inc('client_handovers_total', result='ok')
+			stat_observe('client_handover_gap_seconds', time.monotonic() - ts, handover_time_buckets)
+		if not (addrs and gw): return on_probe(time.monotonic() - ts)
+		try: arp_probe(iface, addrs[0], gw, on_probe)
+		except OSError as err:
+			log.warning('Failed to send ARP request to gateway %s on %s: %s', gw, iface, err)
+
+
 def main(args=None):
 	import argparse
 	parser = argparse.ArgumentParser(
@@ -90,14 +3176,27 @@ def main(args=None):
 		help='Local device address/pattern to use (if not default).')
 	parser.add_argument('-a', '--device-all', action='store_true',
 		help='Use all local hci devices, not just default one.'
-			' Only valid with "server" mode, mutually exclusive with --device option.')
+			' In server mode, adapters plugged in later are used as well.'
+			' In "client --supervise" mode, links from all of them are aggregated in a bond.'
+			' Mutually exclusive with --device option.')
 	parser.add_argument('-u', '--uuid',
 		metavar='uuid_or_shortcut', default='nap',
 		help='Service UUID to use. Can be either full UUID'
 			' or one of the shortcuts: gn, panu, nap. Default: %(default)s.')
 	parser.add_argument('--systemd', action='store_true',
 		help='Use systemd service'
-			' notification/watchdog mechanisms in daemon modes, if available.')
+			' notification/watchdog mechanisms in daemon modes, if available.'
+			' Implemented via $NOTIFY_SOCKET directly, without python-systemd.')
+	parser.add_argument('--metrics', metavar='unix:path | [host]:port',
+		help='Serve metrics in prometheus text format (over HTTP) on specified socket.'
+			' Host for TCP sockets defaults to localhost.')
+	parser.add_argument('--metrics-interval',
+		metavar='seconds', type=float, default=10.0,
+		help='Interval between samples of bnep port counters'
+			' in server mode, used for rate metrics. Default: %(default)ss.')
+	parser.add_argument('--compress-net', metavar='ip/prefix', default=tunnel_net,
+		help='Network for --compress tunnel addresses, first one is used by server,'
+			' client ones are derived from their bridge addresses. Default: %(default)s.')
 	parser.add_argument('--debug',
 		action='store_true', help='Verbose operation mode.')
 
@@ -107,122 +3206,420 @@ def main(args=None):
 	cmd = cmds.add_parser('server', help='Run infinitely as a NAP network server.')
 	cmd.add_argument('iface_name',
 		help='Bridge interface name to which each link will be added by bluez.'
-			' It must be created and configured before starting the server.')
+			' It must be created and configured before starting the server,'
+			' unless --bridge-setup option is used.')
+	cmd.add_argument('-b', '--bridge-setup', action='store_true',
+		help='Create bridge interface (if missing) and configure it via netlink,'
+			' using --bridge-* options below.')
+	cmd.add_argument('--bridge-addr', metavar='ip/prefix',
+		help='Address to add to the bridge with --bridge-setup.')
+	cmd.add_argument('--bridge-gw', metavar='ip',
+		help='Default gateway to route via bridge with --bridge-setup.')
+	cmd.add_argument('--balance-conns', metavar='n', type=int,
+		help='Connections per adapter at which it stops accepting new clients,'
+			' as long as other adapters are under their threshold. Used with --device-all.')
+	cmd.add_argument('--balance-kbps', metavar='kbit/s', type=float,
+		help='Same as --balance-conns, but for combined rx/tx throughput of the adapter.'
+			' Throughput is sampled every --metrics-interval seconds.')
+	cmd.add_argument('--bridge-port', metavar='iface', action='append', default=list(),
+		help='Interface to add to the bridge with --bridge-setup, e.g. eth0 for nap.'
+			' Can be specified multiple times.')
+	cmd.add_argument('--route-via', metavar='iface',
+		help='Routed mode: forward traffic between bridge and specified uplink interface,'
+			' with masquerade (NAT) and nftables flowtable fast path for established flows,'
+			' instead of bridging uplink with --bridge-port.')
+	cmd.add_argument('--no-flowtable', action='store_true',
+		help='Do not use nftables flowtable in --route-via mode.')
+	cmd.add_argument('--compress', action='store_true',
+		help='Accept compression tunnel from clients started with --compress option'
+			' (UDP port {} on bridge) and route it same as bridge. Requires --route-via.'
+			' Uses zstd with python3-zstandard module (on both sides), zlib otherwise.'.format(tunnel_port))
+	cmd.add_argument('--tcp-proxy', action='store_true',
+		help='Split-TCP proxy for TCP connections from clients in --route-via mode:'
+			' redirect them (nftables tproxy) to a local proxy, which connects to destination'
+			' itself and buffers downloaded data before bnep links, so that slow/high-latency'
+			' bluetooth link does not hold up upstream TCP transfers.')
+	cmd.add_argument('--tcp-proxy-port', metavar='port', type=int, default=5334,
+		help='Local port for --tcp-proxy transparent listening socket. Default: %(default)s.')
+	cmd.add_argument('--tcp-proxy-buffer', metavar='KiB', type=int, default=1024,
+		help='Max data buffered by --tcp-proxy per connection and direction. Default: %(default)s.')
+	cmd.add_argument('--dns', action='store_true',
+		help='Run caching DNS forwarder on the bridge (UDP port 53), for clients to use'
+			' instead of e.g. dnsmasq (which should not listen on bridge port 53 then).')
+	cmd.add_argument('--dns-upstream', metavar='ip[:port]', action='append', default=list(),
+		help='Upstream DNS server for --dns forwarder, tried in the order specified.'
+			' Can be specified multiple times. Default: nameservers from /etc/resolv.conf.')
+	cmd.add_argument('--dns-cache', metavar='n', type=int, default=1000,
+		help='Max number of responses in --dns forwarder cache. Default: %(default)s.')
+	cmd.add_argument('--dhcp', metavar='first,last[,lease-time]',
+		help='Run DHCP server on the bridge, giving out addresses from specified range,'
+			' same format as dnsmasq dhcp-range (e.g. 192.168.20.100,192.168.20.150,12h).'
+			' Leases are pinned to client addresses and stored in {}.'
+			' Requires --bridge-addr.'.format(DHCPServer.lease_file))
+	cmd.add_argument('--qdisc', choices=['fq_codel', 'cake'],
+		help='Queue management discipline to attach to every bnep port on the bridge,'
+			' to keep latency low for other flows while link is saturated.'
+			' Default is to keep one that kernel assigns (usually pfifo_fast).')
+	cmd.add_argument('--qdisc-rate', metavar='kbit/s', type=float, default=1500,
+		help='Initial link capacity estimate for --qdisc, which is the shaper rate for cake,'
+			' adjusted to measured capacity every --metrics-interval. Default: %(default)s.')
+	cmd.add_argument('--isolate-clients', action='store_true',
+		help='Block traffic between bluetooth clients, using bridge port isolation.')
+	cmd.add_argument('--neigh-suppress', action='store_true',
+		help='Answer ARP/ND requests for clients on the bridge from its neighbour table,'
+			' instead of flooding them over bluetooth links.')
+	cmd.add_argument('--mcast-filter', metavar='list',
+		help='Comma-separated list of multicast protocols to filter on the way to bluetooth'
+			' links via nftables bridge table, or "all". Protocols: {}.'.format(', '.join(mcast_chatter)))
+	cmd.add_argument('--mcast-limit', metavar='pps', type=int, default=0,
+		help='Rate-limit --mcast-filter traffic to this many packets/s'
+			' per link and protocol, instead of dropping all of it.')
+	cmd.add_argument('--fast-connectable', action='store_true',
+		help='Enable Fast Connectable mode on adapters via kernel mgmt API,'
+			' for shorter connection setup at the cost of higher idle power use.'
+			' Overrides --page-scan-* parameters while enabled.')
+	cmd.add_argument('--page-scan-type', choices=['standard', 'interlaced'],
+		help='Page scan type to set as adapter default via mgmt API.')
+	cmd.add_argument('--page-scan-interval', metavar='ms', type=float,
+		help='Page scan interval to set as adapter default via mgmt API (11.25-2560ms).')
+	cmd.add_argument('--page-scan-window', metavar='ms', type=float,
+		help='Page scan window to set as adapter default via mgmt API (10.625ms-interval).')
+	cmd.add_argument('--link-policy', metavar='list',
+		help='Comma-separated default link policy for adapters, replacing kernel one.'
+			' Flags: {}, or "none" for empty policy.'.format(', '.join(HCI_LP)))
 
 	cmd = cmds.add_parser('client', help='Connect to a PAN network.')
-	cmd.add_argument('remote_addr', help='Remote device address to connect to.')
+	cmd.add_argument('remote_addr', nargs='+',
+		help='Remote device address to connect to. Several candidate NAP addresses'
+			' can be specified, to connect to the best one (by link quality and history).')
 	cmd.add_argument('-w', '--wait', action='store_true',
 		help='Go into an endless wait-loop after connection, terminating it on exit.')
 	cmd.add_argument('-c', '--if-not-connected', action='store_true',
 		help='Dont raise error if connection is already established.')
 	cmd.add_argument('-r', '--reconnect', action='store_true',
 		help='Force reconnection if some connection is already established.')
+	cmd.add_argument('-s', '--supervise', action='store_true',
+		help='Stay running and reconnect whenever the link drops,'
+			' backing off on repeated failures. Implies --wait.')
+	cmd.add_argument('--rank-interval', metavar='seconds', type=float, default=30,
+		help='Interval between link quality checks with multiple'
+			' remote addresses in --supervise mode. Default: %(default)ss.')
+	cmd.add_argument('--switch-margin', metavar='dB', type=float, default=6,
+		help='Score difference for other NAP to be considered better'
+			' than current one (3 checks in a row) to switch to it. Default: %(default)s.')
+	cmd.add_argument('--race', metavar='n', type=int, default=1,
+		help='Connect to up to n of multiple remote addresses at once, in ranked order,'
+			' keeping first one to connect and disconnecting others.'
+			' Default is to try them one after another.')
+	cmd.add_argument('--connect-deadline', metavar='seconds', type=float, default=15,
+		help='Time limit for each connection attempt with --race. Default: %(default)ss.')
+	cmd.add_argument('--roam-rssi', metavar='dBm', type=float,
+		help='Make-before-break roaming with multiple remote addresses in --supervise mode:'
+			' when RSSI of current link drops below this, or other NAP ranks better,'
+			' connect to better one first, move addresses and routes to it, then disconnect'
+			' old one. Needs all NAPs bridged to the same network. Example: -75.')
+	cmd.add_argument('--roam-interval', metavar='seconds', type=float, default=2,
+		help='Interval between RSSI checks for --roam-rssi. Default: %(default)ss.')
+	cmd.add_argument('--roam-device', metavar='local-addr/pattern',
+		help='Second local device to connect new link from with --roam-rssi,'
+			' alternating with main one. Default is to use main one for both links.')
+	cmd.add_argument('--bond', metavar='iface', default='btbond0',
+		help='Bond interface for links from all adapters with --device-all. Default: %(default)s.')
+	cmd.add_argument('--bond-mode', choices=sorted(bond_modes), default='active-backup',
+		help='Bonding mode: active-backup (one link at a time, for failover),'
+			' balance-rr (packets round-robin) or balance-xor (per flow).'
+			' Balancing modes only spread upstream traffic, as NAP bridge sees bond address'
+			' on several ports and sends downstream traffic via one of them at a time.'
+			' Default: %(default)s.')
+	cmd.add_argument('--compress', metavar='ip[:port]',
+		help='Send all IPv4 traffic through compression tunnel to specified server address,'
+			' which must be directly reachable via bnep link (e.g. bridge address of a server'
+			' running with --compress). Only valid with --wait or --supervise.')
 
 	opts = parser.parse_args()
+	import signal
 
 	global log
-	import logging
-	logging.basicConfig(level=logging.DEBUG if opts.debug else logging.WARNING)
-	log = logging.getLogger()
+	log = Log('DEBUG' if opts.debug else 'WARNING')
 
 	if not opts.device_all: devs = [next(iter(find_adapter(opts.device)))]
 	else:
-		if opts.call != 'server':
-			parser.error('--device-all option is only valid with "server" mode.')
+		if opts.call != 'server' and not (opts.call == 'client' and opts.supervise):
+			parser.error('--device-all option is only valid with "server" or "client --supervise" modes.')
 		devs = list(find_adapter())
 	devs = dict((prop_get(dev, 'Address'), dev) for dev in devs)
 	for dev_addr, dev in devs.items():
 		prop_set(dev, 'Powered', True)
 		log.debug('Using local device (addr: %s): %s', dev_addr, dev.object_path)
 
-	wait_iter_noop = 3600
-	if opts.systemd:
-		from systemd import daemon
-		def wait_iter():
-			if not wait_iter.sd_ready:
-				daemon.notify('READY=1')
-				daemon.notify('STATUS=Running in {} mode...'.format(opts.call))
-				wait_iter.sd_ready = True
-			time.sleep(wait_iter.timeout)
-			if wait_iter.sd_wdt: daemon.notify('WATCHDOG=1')
-		wd_pid, wd_usec = (os.environ.get(k) for k in ['WATCHDOG_PID', 'WATCHDOG_USEC'])
-		if wd_pid and wd_pid.isdigit() and int(wd_pid) == os.getpid():
-			wd_interval = float(wd_usec) / 2e6 # half of interval in seconds
-			assert wd_interval > 0, wd_interval
-		else: wd_interval = None
-		if wd_interval:
-			log.debug('Initializing systemd watchdog pinger with interval: %ss', wd_interval)
-			wait_iter.sd_wdt, wait_iter.timeout = True, min(wd_interval, wait_iter_noop)
-		else: wait_iter.sd_wdt, wait_iter.timeout = False, wait_iter_noop
-		wait_iter.sd_ready = False
-	else: wait_iter = lambda: time.sleep(wait_iter_noop)
-	signal.signal(signal.SIGTERM, lambda sig,frm: sys.exit(0))
-
+	def run_daemon(links=None):
+		'Runs event loop, sending READY=1 right away, or when any of the links first connects.'
+		if opts.systemd:
+			if not links: sd_notify('READY=1', 'STATUS=Running in {} mode...'.format(opts.call))
+			else:
+				sd_notify('STATUS=Connecting...')
+				ready = False
+				def notify_ready(link, event, value):
+					nonlocal ready
+					if ready or event != 'connected': return
+					sd_notify('READY=1')
+					ready = True
+				for link in links: link.handlers.append(notify_ready)
+			wd_pid, wd_usec = (os.environ.get(k) for k in ['WATCHDOG_PID', 'WATCHDOG_USEC'])
+			if wd_pid and wd_pid.isdigit() and int(wd_pid) == os.getpid():
+				wd_interval = float(wd_usec) / 2e6 # half of interval in seconds
+				assert wd_interval > 0, wd_interval
+			else: wd_interval = None
+			if wd_interval:
+				log.debug('Initializing systemd watchdog pinger with interval: %ss', wd_interval)
+				Watchdog(wd_interval, wd_interval / 2)
+		loop_run()
+	if opts.call == 'server' or opts.supervise or opts.wait: # one-shot client runs without loop
+		for sig in signal.SIGTERM, signal.SIGINT: loop_add_signal(sig, loop_stop)
+		loop_add_signal(signal.SIGUSR1, stats_dump)
+	if opts.metrics: MetricsServer(opts.metrics)
 
 	if opts.call == 'server':
-		brctl = subprocess.Popen(
-			['brctl', 'show', opts.iface_name],
-			stdout=open(os.devnull, 'wb'), stderr=subprocess.PIPE )
-		brctl_stderr = brctl.stderr.read()
-		if brctl.wait() or brctl_stderr:
+		if opts.route_via in opts.bridge_port:
+			parser.error('--route-via interface cannot also be a --bridge-port')
+		if opts.compress and not opts.route_via:
+			parser.error('--compress option requires --route-via')
+		if opts.tcp_proxy and not opts.route_via:
+			parser.error('--tcp-proxy option requires --route-via')
+		if opts.dhcp:
+			import ipaddress
+			if not opts.bridge_addr: parser.error('--dhcp option requires --bridge-addr')
+			try:
+				dhcp_range = opts.dhcp.split(',')
+				dhcp_range = ( tuple(map(ipaddress.IPv4Address, dhcp_range[:2])),
+					dhcp_duration(dhcp_range[2]) if len(dhcp_range) > 2 else 3600 )
+			except ValueError: parser.error('Invalid --dhcp range: {}'.format(opts.dhcp))
+		if opts.bridge_setup:
+			bridge_setup( opts.iface_name,
+				opts.bridge_addr, opts.bridge_gw, opts.bridge_port )
+		br = nl_link_get(opts.iface_name)
+		if not br or br['kind'] != 'bridge':
 			p = lambda fmt='',*a,**k: print(fmt.format(*a,**k), file=sys.stderr)
-			p('brctl check failed for interface: {}', opts.iface_name)
+			p('Bridge check failed for interface: {}', opts.iface_name)
 			p()
 			p('Bridge interface must be added and configured before starting server, e.g. with:')
-			p('  brctl addbr bnep-bridge')
-			p('  brctl setfd bnep-bridge 0')
-			p('  brctl stp bnep-bridge off')
+			p('  ip link add bnep-bridge type bridge forward_delay 0 stp_state 0')
 			p('  ip addr add 10.101.225.84/24 dev bnep-bridge')
 			p('  ip link set bnep-bridge up')
+			p('Or created by this script, using --bridge-setup option.')
 			return 1
 
-		servers = list()
+		page_scan = ( opts.page_scan_type and ['standard', 'interlaced'].index(opts.page_scan_type),
+			opts.page_scan_interval, opts.page_scan_window )
+		link_policy = opts.link_policy and opts.link_policy.split(',')
+		if link_policy == ['none']: link_policy = list()
+		if link_policy and set(link_policy).difference(HCI_LP):
+			parser.error('Unknown --link-policy flag(s): {}'.format(opts.link_policy))
+		tune = opts.fast_connectable or link_policy is not None or any(v is not None for v in page_scan)
+		def tune_adapter(dev_addr, dev):
+			if not dev: return
+			try: hci_tune(hci_index(dev), opts.fast_connectable, page_scan, link_policy)
+			except (BTError, OSError) as err:
+				log.warning('Failed to apply connection tuning to %s: %s', dev_addr, err)
+		if tune: # re-applied from NAPServer handlers, as bluetoothd resets these on adapter init
+			for dev_addr, dev in devs.items(): tune_adapter(dev_addr, dev)
+
+		def log_bnep_port(event, link):
+			if not link['name'].startswith('bnep') or link['master'] != br['index']: return
+			log.debug( 'Bridge port %s: %s', 'added'
+				if event == RTM_NEWLINK else 'removed', link['name'] )
+		get_link_monitor().handlers.append(log_bnep_port)
+		qdisc = opts.qdisc and PortQdisc(br['index'], opts.qdisc, opts.qdisc_rate * 1000 / 8)
+		if qdisc:
+			get_link_monitor().handlers.append(qdisc.on_link)
+			for link in nl_links(): qdisc.on_link(RTM_NEWLINK, link) # already-connected clients
+		tunnel = opts.compress and CompressTunnel(opts.compress_net, bind_iface=opts.iface_name)
+		router = opts.route_via and Router( opts.iface_name,
+			opts.route_via, not opts.no_flowtable, tunnel and [tunnel_name] )
+		if router: router.start()
+		proxy = opts.tcp_proxy and TCPProxy( router.downlinks,
+			opts.tcp_proxy_port, opts.tcp_proxy_buffer * 1024 )
+		if proxy:
+			try: proxy.start()
+			except BTError as err:
+				log.error('Failed to set up TCP proxy, running without it: %s', err)
+				proxy = None
+		mcast_filter = opts.mcast_filter and opts.mcast_filter.split(',')
+		if mcast_filter == ['all']: mcast_filter = list(mcast_chatter)
+		if mcast_filter and set(mcast_filter).difference(mcast_chatter):
+			parser.error('Unknown --mcast-filter protocol(s): {}'.format(opts.mcast_filter))
+		policy = None
+		if opts.isolate_clients or opts.neigh_suppress or mcast_filter:
+			policy = BridgePolicy( br['index'], opts.isolate_clients, opts.neigh_suppress,
+				mcast_filter or (), opts.mcast_limit, opts.qdisc_rate * 1000 / 8 )
+			policy.start()
+		dns = opts.dns and DNSForwarder( opts.iface_name,
+			opts.dns_upstream or resolv_conf_servers(), opts.dns_cache )
+		if dns: dns.start()
+		dhcp = None
+		if opts.dhcp:
+			br_ip = opts.bridge_addr.split('/')[0]
+			dns_servers = [br_ip] if opts.dns else list( ip for ip in
+				resolv_conf_servers() if ':' not in ip and not ip.startswith('127.') ) or [br_ip]
+			dhcp = DHCPServer( opts.iface_name, opts.bridge_addr,
+				*dhcp_range, router=opts.bridge_port and opts.bridge_gw or br_ip, dns=dns_servers )
+			dhcp.start()
+		balance, balancer = opts.balance_conns or opts.balance_kbps, None
+		if opts.metrics or balance or qdisc:
+			bnep_stats = BNEPStats(opts.iface_name, opts.metrics_interval)
+		if qdisc: bnep_stats.handlers.append(qdisc.update)
+		if balance:
+			balancer = AdapterBalancer( devs, opts.balance_conns,
+				opts.balance_kbps and opts.balance_kbps * 1000 / 8 )
+			bnep_stats.handlers.append(balancer.update)
+			balancer.update(bnep_stats)
+			get_bt_watch().handlers.append(lambda up: balancer.closed.clear())
+			def sample_ports(event, link): # connection counts are updated right away
+				if link['name'].startswith('bnep'): bnep_stats.sample()
+			get_link_monitor().handlers.append(sample_ports)
+
+		nap = NAPServer(devs, opts.uuid, opts.iface_name, hotplug_all=opts.device_all)
+		if tune: nap.handlers.append(tune_adapter)
+		if balancer: nap.handlers.append(lambda dev_addr, dev: balancer.closed.pop(dev_addr, None))
 		try:
-			for dev_addr, dev in devs.items():
-				server = dbus.Interface(dev, 'org.bluez.NetworkServer1')
-				server.Unregister(opts.uuid) # in case already registered
-				server.Register(opts.uuid, opts.iface_name)
-				servers.append(server)
-				log.debug( 'Registered uuid %r with'
-					' bridge/dev: %s / %s', opts.uuid, opts.iface_name, dev_addr )
-			while True: wait_iter()
+			nap.register()
+			get_bt_watch().handlers.append(nap.on_bluez)
+			nap.start_hotplug()
+			run_daemon()
 		except KeyboardInterrupt: pass
 		finally:
-			if servers:
-				for server in servers: server.Unregister(opts.uuid)
-				log.debug('Unregistered server uuids')
+			nap.stop_hotplug()
+			if balancer: balancer.reopen()
+			if policy: policy.stop()
+			if dhcp: dhcp.stop()
+			if dns: dns.stop()
+			if proxy: proxy.stop()
+			if router: router.stop()
+			if tunnel: tunnel.stop()
+			nap.unregister()
+		if nap.error: return 1
+
+
+	elif opts.call == 'client' and len(devs) > 1: # one link per adapter, in a bond
+		bond, links = LinkBond(opts.bond, opts.bond_mode), list()
+		for n, (dev_addr, adapter) in enumerate(devs.items()):
+			addr = opts.remote_addr[n % len(opts.remote_addr)]
+			try: dev_remote = find_device(addr, adapter)
+			except BTError:
+				log.warning('Bluetooth device %s not found for adapter %s, not using it', addr, dev_addr)
+				continue
+			log.debug('Using remote device (addr: %s) via %s: %s', addr, dev_addr, dev_remote.object_path)
+			links.append(ClientLink(dev_remote, opts.uuid))
+			links[-1].handlers.append(bond.on_link)
+		if not links: raise BTError('Bluetooth device not found')
+		bond.start()
+		for link in links:
+			if prop_get(link.net, 'Connected'):
+				if opts.reconnect:
+					log.debug('Detected pre-established connection, reconnecting')
+					link.net.Disconnect()
+				elif not opts.if_not_connected: raise BTError('Already connected')
+			link.start()
+		tunnel = None
+		try:
+			if opts.compress: tunnel = CompressTunnel(opts.compress_net, remote=opts.compress)
+			run_daemon(links)
+		except KeyboardInterrupt: pass
+		finally:
+			if tunnel: tunnel.stop()
+			for link in links:
+				link.stop()
+				try: link.net.Disconnect()
+				except DBusError: pass
+			bond.stop()
+			log.debug('Disconnected from network')
+		if any(link.error for link in links): return 1
 
 
 	elif opts.call == 'client':
-		dev_remote = find_device(opts.remote_addr, list(devs.values())[0])
-		log.debug( 'Using remote device (addr: %s): %s',
-			prop_get(dev_remote, 'Address'), dev_remote.object_path )
-		try: dev_remote.ConnectProfile(opts.uuid)
-		except: pass # no idea why it fails sometimes, but still creates dbus interface
-
-		net = dbus.Interface(dev_remote, 'org.bluez.Network1')
-		for n in range(2):
-			try: iface = net.Connect(opts.uuid)
-			except dbus.exceptions.DBusException as err:
-				if err.get_dbus_name() != 'org.bluez.Error.Failed': raise
-				connected = prop_get(net, 'Connected')
-				if not connected: raise
+		adapter, devs_remote = list(devs.values())[0], dict()
+		for addr in opts.remote_addr:
+			try: devs_remote[addr] = find_device(addr, adapter)
+			except BTError:
+				if len(opts.remote_addr) == 1: raise
+				log.warning('Bluetooth device not found: %s', addr)
+				continue
+			log.debug('Using remote device (addr: %s): %s', addr, devs_remote[addr].object_path)
+		if not devs_remote: raise BTError('Bluetooth device not found')
+		if opts.roam_rssi is not None and not (opts.supervise and len(devs_remote) > 1):
+			parser.error('--roam-rssi option requires --supervise and multiple remote devices')
+		alt = None
+		if opts.roam_device:
+			adapter_alt = next(iter(find_adapter(opts.roam_device)))
+			if adapter_alt.object_path == adapter.object_path:
+				parser.error('--roam-device must be different from the main local device')
+			prop_set(adapter_alt, 'Powered', True)
+			alt = hci_index(adapter_alt), dict()
+			for addr in devs_remote:
+				try: alt[1][addr] = find_device(addr, adapter_alt)
+				except BTError: log.warning('Bluetooth device %s not found for --roam-device', addr)
+		selector = len(devs_remote) > 1 and NAPSelector( devs_remote, opts.uuid,
+			hci_index(adapter), opts.rank_interval, opts.switch_margin,
+			race=opts.race, deadline=opts.connect_deadline,
+			roam_rssi=opts.roam_rssi, roam_interval=opts.roam_interval, alt=alt )
+
+		if opts.compress and not (opts.wait or opts.supervise):
+			parser.error('--compress option is only valid with --wait or --supervise')
+		tunnel = None
+		def tunnel_start():
+			nonlocal tunnel
+			if opts.compress: tunnel = CompressTunnel(opts.compress_net, remote=opts.compress)
+
+		if opts.supervise:
+			link = selector or ClientLink(next(iter(devs_remote.values())), opts.uuid)
+			if prop_get(link.net, 'Connected'):
 				if opts.reconnect:
-					log.debug( 'Detected pre-established connection'
-						' (iface: %s), reconnecting', prop_get(net, 'Interface') )
-					net.Disconnect()
+					log.debug('Detected pre-established connection, reconnecting')
+					link.net.Disconnect()
+				elif not opts.if_not_connected: raise BTError('Already connected')
+			link.start()
+			try:
+				tunnel_start()
+				run_daemon([link])
+			except KeyboardInterrupt: pass
+			finally:
+				if tunnel: tunnel.stop()
+				link.stop()
+				if not link.error:
+					try: link.net.Disconnect()
+					except DBusError: pass
+					log.debug('Disconnected from network')
+			return 1 if link.error else None
+
+		candidates = selector.rank() if selector else list(devs_remote)
+		if selector and opts.race > 1:
+			addr, net, iface, times = client_connect_race( devs_remote, opts.uuid, candidates,
+				opts.race, opts.connect_deadline, opts.reconnect, opts.if_not_connected )
+			for k, td in times.items(): selector.on_connect(k, td)
+		else:
+			for n, addr in enumerate(candidates, 1): # in order, until one connects
+				ts = time.monotonic()
+				try:
+					net, iface = client_connect( devs_remote[addr],
+						opts.uuid, opts.reconnect, opts.if_not_connected )
+				except DBusError as err:
+					if n == len(candidates): raise
+					log.debug('Failed to connect to %s: %s', addr, err)
+					if selector: selector.on_connect(addr, None)
 					continue
-				if not opts.if_not_connected: raise
-			else: break
+				if selector: selector.on_connect(addr, time.monotonic() - ts)
+				break
 		log.debug(
 			'Connected to network (dev_remote: %s, addr: %s) uuid %r with iface: %s',
-			dev_remote.object_path, prop_get(dev_remote, 'Address'), opts.uuid, iface )
+			devs_remote[addr].object_path, addr, opts.uuid, iface )
 
 		if opts.wait:
 			try:
-				while True: wait_iter()
+				tunnel_start()
+				run_daemon()
 			except KeyboardInterrupt: pass
 			finally:
+				if tunnel: tunnel.stop()
 				net.Disconnect()
 				log.debug('Disconnected from network')
 
@@ -15,24 +15,28 @@
 
 source /etc/btnap.conf
 
-# --- create bridge   ------------------------------------------------------
-
-if [ "$MODE" = "server" ]; then
-  if [ -n "$(brctl show $BR_DEV 2>&1 >/dev/null)" ]; then
-     brctl addbr "$BR_DEV"
-     brctl setfd "$BR_DEV" 0
-     brctl stp "$BR_DEV" off
-     ip addr add "$BR_IP" dev "$BR_DEV"
-     [ -n "$ADD_IF" ] && brctl addif "$BR_DEV" "$ADD_IF"
-     ip link set "$BR_DEV" up
-     [ -n "$BR_GW" ] && ip route add default via "$BR_GW" dev "$BR_DEV"
-  fi
-fi
-
 # --- start service-script -------------------------------------------------
 
-if [ "$MODE" = "server" ]; then
-  exec /usr/local/sbin/btnap.service.py ${DEBUG:+--debug} server $BR_DEV
+if [ "$MODE" = "server" -o "$MODE" = "router" ]; then
+  # bridge is created/configured by the service via netlink
+  if [ "$MODE" = "router" ]; then
+    # bnep bridge is routed (with NAT) to ADD_IF instead of being bridged with it
+    UPLINK_OPTS="--route-via $ADD_IF ${COMPRESS:+--compress} ${TCP_PROXY:+--tcp-proxy}"
+  else
+    UPLINK_OPTS="${BR_GW:+--bridge-gw $BR_GW} ${ADD_IF:+--bridge-port $ADD_IF}"
+  fi
+  exec /usr/local/sbin/btnap.service.py ${DEBUG:+--debug} --systemd \
+    ${METRICS:+--metrics "$METRICS"} server \
+    --bridge-setup --bridge-addr "$BR_IP" $UPLINK_OPTS \
+    ${FAST_CONNECT:+--fast-connectable} \
+    ${QDISC:+--qdisc "$QDISC"} ${QDISC_RATE:+--qdisc-rate "$QDISC_RATE"} \
+    ${ISOLATE_CLIENTS:+--isolate-clients} ${NEIGH_SUPPRESS:+--neigh-suppress} \
+    ${MCAST_FILTER:+--mcast-filter "$MCAST_FILTER"} ${DNS:+--dns} \
+    ${DHCP:+--dhcp "$DHCP"} $BR_DEV
 else
-  exec /usr/local/sbin/btnap.service.py ${DEBUG:+--debug} client $REMOTE_DEV
+  exec /usr/local/sbin/btnap.service.py ${DEBUG:+--debug} --systemd \
+    ${METRICS:+--metrics "$METRICS"} ${BOND:+--device-all} client -s \
+    ${COMPRESS:+--compress "$COMPRESS"} ${RACE:+--race "$RACE"} \
+    ${ROAM_RSSI:+--roam-rssi "$ROAM_RSSI"} \
+    ${BOND:+--bond-mode "$BOND"} $REMOTE_DEV
 fi
@@ -0,0 +1,20 @@
+'''Loads btnap.service.py (not importable by name) as "btnap" module for tests.'''
+
+import os, importlib.machinery, importlib.util
+
+service_path = os.path.join( os.path.dirname(__file__),
+	'..', 'files', 'usr', 'local', 'sbin', 'btnap.service.py' )
+
+def load_service():
+	loader = importlib.machinery.SourceFileLoader('btnap', service_path)
+	mod = importlib.util.module_from_spec(importlib.util.spec_from_loader(loader.name, loader))
+	loader.exec_module(mod)
+	mod.log = mod.Log('ERROR')
+	return mod
+
+btnap = load_service()
+
+class FakeSocket(object):
+	'Records sendto() calls as (data, addr) in "sent" list.'
+	def __init__(self): self.sent = list()
+	def sendto(self, data, addr): self.sent.append((data, addr))
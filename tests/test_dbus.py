@@ -0,0 +1,129 @@
+import struct, unittest
+
+from helpers import btnap
+
+
+def roundtrip(sig, values, prefix=b''):
+	'Marshals values after prefix bytes (to shift alignment) and reads them back.'
+	buf = btnap.DBusWriter(bytearray(prefix)).write_all(sig, values)
+	reader = btnap.DBusReader(buf, len(prefix))
+	values = list(reader.read(item_sig) for item_sig in btnap.dbus_sig_split(sig))
+	return values, reader.pos, buf
+
+
+class DBusMarshalTests(unittest.TestCase):
+
+	def check(self, sig, values, expected=None):
+		for prefix in b'', b'\x01', b'\x01\x02\x03', b'\x01' * 5:
+			res, pos, buf = roundtrip(sig, values, prefix)
+			self.assertEqual(res, values if expected is None else expected, (sig, prefix))
+			self.assertEqual(pos, len(buf), (sig, prefix))
+
+	def test_sig_split(self):
+		for sig, types in [
+				('', []), ('s', ['s']), ('yyyuua(yv)', ['y', 'y', 'y', 'u', 'u', 'a(yv)']),
+				('a{oa{sa{sv}}}', ['a{oa{sa{sv}}}']), ('y(ytd)ad', ['y', '(ytd)', 'ad']),
+				('aas(a{sv}(ii))v', ['aas', '(a{sv}(ii))', 'v']) ]:
+			self.assertEqual(btnap.dbus_sig_split(sig), types)
+
+	def test_fixed(self):
+		self.check( 'ybnqiuxtdh', [ 0xff, True, -2, 0xfffe,
+			-(1 << 31), (1 << 32) - 1, -(1 << 63), (1 << 64) - 1, 2.5, 3 ] )
+
+	def test_strings(self):
+		self.check('sogs', ['', '/org/bluez/hci0', 'a{sv}', 'zażółć'])
+
+	def test_managed_objects(self):
+		objects = {
+			'/org/bluez': {'org.freedesktop.DBus.Introspectable': {}},
+			'/org/bluez/hci0': {
+				'org.bluez.Adapter1': dict( Address='00:11:22:33:44:55',
+					Powered=True, Class=0x20000, UUIDs=['1116', '1115'] ),
+				'org.bluez.NetworkServer1': {} },
+			'/org/bluez/hci0/dev_00_11_22_33_44_66': {
+				'org.bluez.Device1': dict(RSSI=btnap.DBusVariant('n', -60), Connected=False) } }
+		expected = {
+			'/org/bluez': {'org.freedesktop.DBus.Introspectable': {}},
+			'/org/bluez/hci0': objects['/org/bluez/hci0'],
+			'/org/bluez/hci0/dev_00_11_22_33_44_66': {
+				'org.bluez.Device1': dict(RSSI=-60, Connected=False) } }
+		self.check('a{oa{sa{sv}}}', [objects], [expected])
+
+	def test_struct_and_doubles(self):
+		self.check('y(ytd)ad', [7, (1, 1 << 40, 0.5), [1.5, -2.25]])
+
+	def test_empty_arrays(self):
+		self.check('adya(ii)ya{sv}yayas', [[], 1, [], 2, {}, 3, b'', []])
+
+	def test_empty_array_padding(self):
+		# Padding to element alignment follows length even when there are no elements,
+		#  and is not counted in array length
+		buf = btnap.DBusWriter().write_all('uyad', [1, 2, []])
+		self.assertEqual(bytes(buf), struct.pack('<IB3xI4x', 1, 2, 0))
+		buf = btnap.DBusWriter().write_all('uyadu', [1, 2, [], 3])
+		self.assertEqual(bytes(buf), struct.pack('<IB3xI4xI', 1, 2, 0, 3))
+
+	def test_array_padding(self):
+		buf = btnap.DBusWriter().write_all('yad', [1, [0.5]])
+		self.assertEqual(bytes(buf), struct.pack('<B3xId', 1, 8, 0.5))
+
+	def test_nested_variants(self):
+		values = [
+			btnap.DBusVariant('v', btnap.DBusVariant('ai', [1, 2])),
+			btnap.DBusVariant('(sv)', ('x', btnap.DBusVariant('at', [1 << 60]))),
+			{'a': btnap.DBusVariant('a{sv}', {'b': btnap.DBusVariant('v', 'c'), 'd': 1.0})} ]
+		self.check('vva{sv}', values, [[1, 2], ('x', [1 << 60]), {'a': {'b': 'c', 'd': 1.0}}])
+
+	def test_guessed_variants(self):
+		self.check( 'a{sv}', [dict(b=True, i=-1, d=0.5, ay=b'\x00\x01', s='x', l=['y'], m={'k': 1})],
+			[dict(b=True, i=-1, d=0.5, ay=b'\x00\x01', s='x', l=['y'], m={'k': 1})] )
+
+	def test_big_endian(self):
+		buf = struct.pack('>BxxxIdIs', 1, 8, 0.5, 1, b'x') + b'\0'
+		reader = btnap.DBusReader(buf, 0, '>')
+		self.assertEqual([reader.read('y'), reader.read('ad'), reader.read('s')], [1, [0.5], 'x'])
+
+
+class DBusMessageTests(unittest.TestCase):
+
+	def build(self, serial, body_sig, body):
+		return btnap.DBusMessage.build( serial, btnap.DBUS_METHOD_CALL,
+			path='/org/bluez/hci0', interface='org.freedesktop.DBus.Properties', member='Set',
+			destination='org.bluez', signature=body_sig, body=body )
+
+	def test_roundtrip(self):
+		body = ['org.bluez.Adapter1', 'Powered', True]
+		buf = self.build(5, 'ssv', body)
+		body_len, fields_len = struct.unpack_from('<I', buf, 4)[0], struct.unpack_from('<I', buf, 12)[0]
+		self.assertEqual(len(buf), 16 + (fields_len + 7) // 8 * 8 + body_len) # body starts 8-aligned
+		msg, end = btnap.DBusMessage.parse(buf)
+		self.assertEqual(end, len(buf))
+		self.assertEqual( (msg.mtype, msg.serial, msg.path, msg.interface, msg.member),
+			(btnap.DBUS_METHOD_CALL, 5, '/org/bluez/hci0', 'org.freedesktop.DBus.Properties', 'Set') )
+		self.assertEqual(msg.fields[btnap.DBUS_HDR_DESTINATION], 'org.bluez')
+		self.assertEqual(msg.body, body)
+
+	def test_no_body(self):
+		buf = btnap.DBusMessage.build( 1, btnap.DBUS_METHOD_RETURN, reply_serial=7 )
+		msg, end = btnap.DBusMessage.parse(buf)
+		self.assertEqual((msg.reply_serial, msg.body, end), (7, [], len(buf)))
+		self.assertNotIn(btnap.DBUS_HDR_SIGNATURE, msg.fields)
+
+	def test_stream(self):
+		'Messages in one buffer, each aligned relative to its own start, and partial one.'
+		msgs = [ self.build(1, 'y', [1]), self.build(2, 'y(ytd)ad', [2, (3, 4, 0.5), []]),
+			self.build(3, 'a{oa{sa{sv}}}', [{'/': {'i': {'p': 1}}}]) ]
+		buf = b''.join(msgs)
+		self.assertNotEqual(len(msgs[0]) % 8, 0) # second one starts unaligned
+		pos, bodies = 0, list()
+		while True:
+			msg, pos = btnap.DBusMessage.parse(buf, pos)
+			if not msg: break
+			bodies.append(msg.body)
+		self.assertEqual(bodies, [[1], [2, (3, 4, 0.5), []], [{'/': {'i': {'p': 1}}}]])
+		pos = len(msgs[0]) + len(msgs[1])
+		self.assertEqual(btnap.DBusMessage.parse(buf[:-1], pos), (None, pos))
+		self.assertEqual(btnap.DBusMessage.parse(buf[:10]), (None, 0))
+
+
+if __name__ == '__main__': unittest.main()
@@ -0,0 +1,178 @@
+import os, json, struct, tempfile, unittest, ipaddress as ipa
+from unittest import mock
+
+from helpers import btnap, FakeSocket
+
+
+def dhcp_msg(mtype, mac, ciaddr='0.0.0.0', requested=None, server_id=None, rapid=False, broadcast=True):
+	chaddr = bytes.fromhex(mac.replace(':', '')).ljust(16, b'\0')
+	buf = btnap.dhcp_bootp.pack( 1, 1, 6, 0, 0x1234, 0, 0x8000 if broadcast else 0,
+		ipa.ip_address(ciaddr).packed, bytes(4), bytes(4), bytes(4), chaddr, bytes(64), bytes(128) )
+	opts = [(btnap.DHCP_OPT_TYPE, bytes([mtype]))]
+	if requested: opts.append((btnap.DHCP_OPT_REQ_ADDR, ipa.ip_address(requested).packed))
+	if server_id: opts.append((btnap.DHCP_OPT_SERVER_ID, ipa.ip_address(server_id).packed))
+	if rapid: opts.append((btnap.DHCP_OPT_RAPID_COMMIT, b''))
+	return buf + btnap.dhcp_magic + b''.join(bytes([k, len(v)]) + v for k, v in opts) + b'\xff'
+
+def dhcp_reply(data):
+	fields = btnap.dhcp_bootp.unpack_from(data)
+	opts = btnap.dhcp_options(data[240:])
+	return dict( op=fields[0], xid=fields[4], yiaddr=ipa.ip_address(fields[8]),
+		mtype=opts[btnap.DHCP_OPT_TYPE][0], opts=opts )
+
+
+class DHCPTests(unittest.TestCase):
+
+	mac, mac2 = '00:11:22:33:44:55', '00:11:22:33:44:66'
+
+	def setUp(self):
+		tmp = tempfile.TemporaryDirectory()
+		self.addCleanup(tmp.cleanup)
+		self.lease_file = os.path.join(tmp.name, 'dhcp.leases')
+		patch = mock.patch.object(btnap.DHCPServer, 'lease_file', self.lease_file)
+		patch.start()
+		self.addCleanup(patch.stop)
+		self.server = self.make_server()
+
+	def make_server(self, pool=('10.0.0.100', '10.0.0.110')):
+		server = btnap.DHCPServer( 'br0', '10.0.0.1/24',
+			tuple(map(ipa.IPv4Address, pool)), 3600, router='10.0.0.1', dns=['10.0.0.1'] )
+		server.sock = FakeSocket()
+		return server
+
+	def handle(self, *args, **kws):
+		sent = self.server.sock.sent
+		n = len(sent)
+		self.server.handle(dhcp_msg(*args, **kws))
+		self.assertLessEqual(len(sent), n + 1)
+		return (dhcp_reply(sent[-1][0]), sent[-1][1]) if len(sent) > n else (None, None)
+
+	def test_options_parse(self):
+		buf = bytes([0, 12, 2]) + b'ab' + bytes([12, 1]) + b'c' + bytes([255, 1, 1])
+		self.assertEqual(btnap.dhcp_options(buf), {12: b'abc'}) # padding, split option, end
+
+	def test_duration(self):
+		for spec, n in ('3600', 3600), ('45m', 2700), ('12h', 43200), ('1d', 86400):
+			self.assertEqual(btnap.dhcp_duration(spec), n)
+
+	def test_discover_offer(self):
+		reply, dst = self.handle(btnap.DHCP_DISCOVER, self.mac)
+		self.assertEqual(reply['mtype'], btnap.DHCP_OFFER)
+		self.assertEqual((reply['op'], reply['xid'], dst), (2, 0x1234, ('255.255.255.255', 68)))
+		self.assertIn(reply['yiaddr'], self.server.pool)
+		opts = reply['opts']
+		self.assertEqual(opts[btnap.DHCP_OPT_SERVER_ID], ipa.ip_address('10.0.0.1').packed)
+		self.assertEqual(opts[btnap.DHCP_OPT_MASK], ipa.ip_address('255.255.255.0').packed)
+		self.assertEqual(struct.unpack('!I', opts[btnap.DHCP_OPT_LEASE])[0], 3600)
+		self.assertNotIn(btnap.DHCP_OPT_RAPID_COMMIT, opts)
+		self.assertEqual(self.server.leases, dict()) # only committed on request
+
+	def test_discover_requested_addr(self):
+		reply, dst = self.handle(btnap.DHCP_DISCOVER, self.mac, requested='10.0.0.105')
+		self.assertEqual(reply['yiaddr'], ipa.ip_address('10.0.0.105'))
+		reply, dst = self.handle(btnap.DHCP_DISCOVER, self.mac2, requested='10.0.0.1')
+		self.assertNotEqual(reply['yiaddr'], ipa.ip_address('10.0.0.1')) # server address
+
+	def test_rapid_commit(self):
+		reply, dst = self.handle(btnap.DHCP_DISCOVER, self.mac, rapid=True)
+		self.assertEqual(reply['mtype'], btnap.DHCP_ACK)
+		self.assertIn(btnap.DHCP_OPT_RAPID_COMMIT, reply['opts'])
+		self.assertEqual(self.server.leases[self.mac][0], reply['yiaddr'])
+		with open(self.lease_file) as src: leases = json.load(src)
+		self.assertEqual(leases[self.mac][0], str(reply['yiaddr']))
+
+	def test_request_selecting(self):
+		offer, dst = self.handle(btnap.DHCP_DISCOVER, self.mac)
+		reply, dst = self.handle( btnap.DHCP_REQUEST, self.mac,
+			requested=offer['yiaddr'], server_id='10.0.0.1' )
+		self.assertEqual((reply['mtype'], reply['yiaddr']), (btnap.DHCP_ACK, offer['yiaddr']))
+		offer2, dst = self.handle(btnap.DHCP_DISCOVER, self.mac2)
+		self.assertNotEqual(offer2['yiaddr'], offer['yiaddr'])
+
+	def test_request_other_server(self):
+		offer, dst = self.handle(btnap.DHCP_DISCOVER, self.mac)
+		reply, dst = self.handle( btnap.DHCP_REQUEST, self.mac,
+			requested='10.0.0.200', server_id='10.0.0.2' )
+		self.assertIsNone(reply)
+		self.assertEqual(self.server.leases, dict())
+
+	def test_request_wrong_addr(self):
+		offer, dst = self.handle(btnap.DHCP_DISCOVER, self.mac, rapid=True)
+		reply, dst = self.handle( btnap.DHCP_REQUEST, self.mac,
+			requested='10.0.0.109' if offer['yiaddr'] != ipa.ip_address('10.0.0.109') else '10.0.0.108',
+			server_id='10.0.0.1' )
+		self.assertEqual((reply['mtype'], dst), (btnap.DHCP_NAK, ('255.255.255.255', 68)))
+		self.assertEqual(reply['yiaddr'], ipa.ip_address(0))
+
+	def test_init_reboot(self):
+		ack, dst = self.handle(btnap.DHCP_DISCOVER, self.mac, rapid=True)
+		reply, dst = self.handle(btnap.DHCP_REQUEST, self.mac, requested=ack['yiaddr'])
+		self.assertEqual((reply['mtype'], reply['yiaddr']), (btnap.DHCP_ACK, ack['yiaddr']))
+
+	def test_init_reboot_wrong_addr(self):
+		reply, dst = self.handle(btnap.DHCP_DISCOVER, self.mac, rapid=True)
+		other = self.server.pool[(self.server.pool.index(reply['yiaddr']) + 1) % len(self.server.pool)]
+		reply, dst = self.handle(btnap.DHCP_REQUEST, self.mac, requested=other)
+		self.assertEqual(reply['mtype'], btnap.DHCP_NAK)
+
+	def test_init_reboot_other_network(self):
+		# RFC 2131 4.3.2 - server must not reply to client that roamed in with foreign lease
+		reply, dst = self.handle(btnap.DHCP_REQUEST, self.mac, requested='192.168.5.5')
+		self.assertIsNone(reply)
+		self.assertEqual(self.server.leases, dict())
+
+	def test_renew(self):
+		ack, dst = self.handle(btnap.DHCP_DISCOVER, self.mac, rapid=True)
+		reply, dst = self.handle(btnap.DHCP_REQUEST, self.mac, ciaddr=ack['yiaddr'], broadcast=False)
+		self.assertEqual((reply['mtype'], reply['yiaddr']), (btnap.DHCP_ACK, ack['yiaddr']))
+		self.assertEqual(dst, (str(ack['yiaddr']), 68)) # unicast to ciaddr
+
+	def test_release_keeps_addr_pinned(self):
+		ack, dst = self.handle(btnap.DHCP_DISCOVER, self.mac, rapid=True)
+		self.handle(btnap.DHCP_RELEASE, self.mac, ciaddr=ack['yiaddr'])
+		self.assertLessEqual(self.server.leases[self.mac][1], btnap.time.time())
+		offer, dst = self.handle(btnap.DHCP_DISCOVER, self.mac)
+		self.assertEqual(offer['yiaddr'], ack['yiaddr'])
+
+	def test_decline(self):
+		ack, dst = self.handle(btnap.DHCP_DISCOVER, self.mac, rapid=True)
+		self.handle(btnap.DHCP_DECLINE, self.mac, requested=ack['yiaddr'])
+		self.assertNotIn(self.mac, self.server.leases)
+		offer, dst = self.handle(btnap.DHCP_DISCOVER, self.mac2, requested=ack['yiaddr'])
+		self.assertNotEqual(offer['yiaddr'], ack['yiaddr'])
+
+	def test_renew_save_delayed(self):
+		ack, dst = self.handle(btnap.DHCP_DISCOVER, self.mac, rapid=True)
+		with open(self.lease_file) as src: saved = src.read()
+		for n in range(3): self.handle(btnap.DHCP_REQUEST, self.mac, ciaddr=ack['yiaddr'], broadcast=False)
+		with open(self.lease_file) as src: self.assertEqual(src.read(), saved)
+		timer = self.server.save_timer
+		self.assertIsNotNone(timer)
+		self.addCleanup(timer.cancel)
+		self.server.handle(dhcp_msg(btnap.DHCP_DISCOVER, self.mac2, rapid=True)) # new binding
+		self.assertTrue(timer.cancelled())
+		with open(self.lease_file) as src: leases = json.load(src)
+		self.assertEqual(leases[self.mac][1], self.server.leases[self.mac][1]) # renewal saved too
+		self.assertIn(self.mac2, leases)
+
+	def test_leases_persist(self):
+		ack, dst = self.handle(btnap.DHCP_DISCOVER, self.mac, rapid=True)
+		self.server = self.make_server()
+		offer, dst = self.handle(btnap.DHCP_DISCOVER, self.mac)
+		self.assertEqual(offer['yiaddr'], ack['yiaddr'])
+
+	def test_range_exhausted(self):
+		self.server = self.make_server(pool=('10.0.0.100', '10.0.0.101'))
+		for mac in self.mac, self.mac2: self.handle(btnap.DHCP_DISCOVER, mac, rapid=True)
+		reply, dst = self.handle(btnap.DHCP_DISCOVER, '00:11:22:33:44:77')
+		self.assertIsNone(reply)
+
+	def test_expired_lease_reuse(self):
+		self.server = self.make_server(pool=('10.0.0.100', '10.0.0.100'))
+		ack, dst = self.handle(btnap.DHCP_DISCOVER, self.mac, rapid=True)
+		self.server.leases[self.mac][1] = btnap.time.time() - 1
+		reply, dst = self.handle(btnap.DHCP_DISCOVER, self.mac2)
+		self.assertEqual(reply['yiaddr'], ack['yiaddr'])
+
+
+if __name__ == '__main__': unittest.main()
@@ -0,0 +1,170 @@
+import struct, asyncio, unittest
+
+from helpers import btnap, FakeSocket
+
+
+def dns_name(name):
+	return b''.join(bytes([len(label)]) + label.encode() for label in name.split('.')) + b'\0'
+
+def dns_query(name, qtype=1, qid=b'\x12\x34'):
+	return qid + struct.pack('>5H', 0x0100, 1, 0, 0, 0) + dns_name(name) + struct.pack('>HH', qtype, 1)
+
+def dns_response(query, answers=(), rcode=0, soa_ttl=None, extra=True):
+	'Builds response to query with A records [(ip, ttl), ...], SOA and unrelated additional ones.'
+	nscount, arcount = int(soa_ttl is not None), int(extra)
+	resp = bytearray(query[:2]) + struct.pack( '>5H',
+		0x8180 | rcode, 1, len(answers), nscount, arcount ) + query[12:]
+	for ip, ttl in answers:
+		resp += b'\xc0\x0c' + struct.pack('>HHIH', 1, 1, ttl, 4) + bytes(map(int, ip.split('.')))
+	if soa_ttl is not None:
+		soa = dns_name('ns.example.com') + dns_name('admin.example.com') + struct.pack('>5I', 1, 2, 3, 4, 60)
+		resp += dns_name('example.com') + struct.pack('>HHIH', 6, 1, soa_ttl, len(soa)) + soa
+	if extra: resp += dns_name('ns.example.com') + struct.pack('>HHIH', 1, 1, 3600, 4) + bytes(4)
+	return bytes(resp)
+
+def dns_answers(resp):
+	'Returns (rcode, [(ip, ttl), ...]) for A records in response.'
+	ancount = struct.unpack_from('>H', resp, 6)[0]
+	pos, answers = btnap.dns_question(resp)[1], list()
+	for n in range(ancount):
+		pos = btnap.dns_skip_name(resp, pos)
+		rtype, rclass, ttl, rdlen = struct.unpack_from('>HHIH', resp, pos)
+		answers.append(('.'.join(map(str, resp[pos+10:pos+10+rdlen])), ttl))
+		pos += 10 + rdlen
+	return resp[3] & 0xf, answers
+
+
+class DNSMessageTests(unittest.TestCase):
+
+	def test_question_key(self):
+		key, pos = btnap.dns_question(dns_query('Example.COM', qtype=28))
+		self.assertEqual(key, (dns_name('example.com'), 28, 1))
+		self.assertEqual(pos, len(dns_query('example.com')))
+
+	def test_minimal(self):
+		resp = dns_response(dns_query('example.com'), [('1.2.3.4', 300), ('1.2.3.5', 200)])
+		out, ttls, ttl = btnap.dns_minimal(resp)
+		self.assertEqual(struct.unpack_from('>4H', out, 4), (1, 2, 0, 0)) # additional dropped
+		self.assertEqual(dns_answers(out), (0, [('1.2.3.4', 300), ('1.2.3.5', 200)]))
+		self.assertEqual((len(ttls), ttl), (2, 200))
+
+	def test_minimal_negative(self):
+		resp = dns_response(dns_query('nx.example.com'), rcode=3, soa_ttl=900)
+		out, ttls, ttl = btnap.dns_minimal(resp)
+		self.assertEqual(struct.unpack_from('>4H', out, 4), (1, 0, 1, 0)) # SOA kept
+		self.assertEqual(ttl, 900)
+
+	def test_minimal_truncated(self):
+		resp = dns_response(dns_query('example.com'), [('1.2.3.4', 300)], extra=False)
+		self.assertRaises((IndexError, struct.error), btnap.dns_minimal, resp[:-2])
+
+
+class DNSForwarderTests(unittest.TestCase):
+
+	client = '10.0.0.100', 5353
+
+	def setUp(self):
+		self.loop = btnap.get_loop()
+		self.fwd = btnap.DNSForwarder('br0', ['192.0.2.1', '192.0.2.2:5300'])
+		self.fwd.sock, self.fwd.sock_up = FakeSocket(), FakeSocket()
+
+	def run_loop(self, n=5):
+		for k in range(n): self.loop.run_until_complete(asyncio.sleep(0))
+
+	def answer(self, reply, n=0):
+		'Answers n-th pending upstream query with reply(query) response.'
+		query, upstream = self.fwd.sock_up.sent[n]
+		fut, upstream_chk = self.fwd.queries[query[:2]]
+		self.assertEqual(upstream, upstream_chk)
+		fut.set_result(reply(query))
+
+	def query(self, name, reply=None, qid=b'\xab\xcd'):
+		'Runs query through forwarder, returning (rcode, answers) and upstream query count.'
+		sent_up = len(self.fwd.sock_up.sent)
+		task = self.loop.create_task(self.fwd.on_query(dns_query(name, qid=qid), self.client))
+		self.run_loop()
+		n = len(self.fwd.sock_up.sent) - sent_up
+		if n and reply: self.answer(reply, sent_up)
+		self.loop.run_until_complete(task)
+		resp, addr = self.fwd.sock.sent[-1]
+		self.assertEqual((resp[:2], addr), (qid, self.client))
+		return dns_answers(resp), n
+
+	def age(self, name, seconds):
+		'Moves cache entry timestamp back, to make it look older.'
+		self.fwd.cache[btnap.dns_question(dns_query(name))[0]].ts -= seconds
+
+	def test_upstreams(self):
+		self.assertEqual(self.fwd.upstreams, [('192.0.2.1', 53), ('192.0.2.2', 5300)])
+		self.assertRaises(btnap.BTError, btnap.DNSForwarder, 'br0', ['2001:db8::1'])
+
+	def test_miss_then_hit(self):
+		reply = lambda q: dns_response(q, [('1.2.3.4', 300)])
+		self.assertEqual(self.query('example.com', reply), ((0, [('1.2.3.4', 300)]), 1))
+		self.age('example.com', 0.5)
+		self.assertEqual(self.query('EXAMPLE.com'), ((0, [('1.2.3.4', 299)]), 0))
+		self.assertEqual(len(self.fwd.cache), 1)
+
+	def test_ttl_countdown(self):
+		self.query('example.com', lambda q: dns_response(q, [('1.2.3.4', 300), ('1.2.3.5', 100)]))
+		self.age('example.com', 40.5)
+		self.assertEqual(self.query('example.com'), ((0, [('1.2.3.4', 259), ('1.2.3.5', 59)]), 0))
+
+	def test_stale_refresh(self):
+		self.query('example.com', lambda q: dns_response(q, [('1.2.3.4', 60)]))
+		self.age('example.com', 120)
+		(rcode, answers), n = self.query('example.com')
+		self.assertEqual((answers, n), ([('1.2.3.4', self.fwd.stale_ttl)], 1)) # served, refresh sent
+		self.answer(lambda q: dns_response(q, [('5.6.7.8', 60)]), 1)
+		self.run_loop()
+		self.age('example.com', 0.5)
+		self.assertEqual(self.query('example.com'), ((0, [('5.6.7.8', 59)]), 0))
+
+	def test_stale_max(self):
+		self.query('example.com', lambda q: dns_response(q, [('1.2.3.4', 60)]))
+		self.age('example.com', 60 + self.fwd.stale_max)
+		reply = lambda q: dns_response(q, [('5.6.7.8', 60)])
+		self.assertEqual(self.query('example.com', reply), ((0, [('5.6.7.8', 60)]), 1))
+
+	def test_prefetch(self):
+		self.query('example.com', lambda q: dns_response(q, [('1.2.3.4', 100)]))
+		self.age('example.com', 95)
+		for n in range(self.fwd.prefetch_hits - 1): self.assertEqual(self.query('example.com')[1], 0)
+		self.assertEqual(self.query('example.com')[1], 1) # hot and near expiry
+
+	def test_negative_ttl_cap(self):
+		self.query( 'nx.example.com',
+			lambda q: dns_response(q, rcode=3, soa_ttl=86400, extra=False) )
+		entry = self.fwd.cache[btnap.dns_question(dns_query('nx.example.com'))[0]]
+		self.assertEqual(entry.ttl, self.fwd.negative_ttl_max)
+		self.assertEqual(self.query('nx.example.com'), ((3, []), 0))
+
+	def test_not_cached(self):
+		for reply in ( lambda q: dns_response(q, [('1.2.3.4', 0)]),
+				lambda q: dns_response(q, rcode=2) ): # zero ttl, servfail
+			self.assertEqual(self.query('example.com', reply)[1], 1)
+			self.assertEqual(len(self.fwd.cache), 0)
+
+	def test_question_mismatch(self):
+		self.fwd.timeout = 0.01
+		reply = lambda q: dns_response(dns_query('other.com', qid=q[:2]), [('6.6.6.6', 60)])
+		(rcode, answers), n = self.query('example.com', reply)
+		self.assertEqual((rcode, answers), (2, [])) # servfail after second upstream times out
+		self.assertEqual([addr for q, addr in self.fwd.sock_up.sent], self.fwd.upstreams)
+
+	def test_lru(self):
+		self.fwd.cache_size = 2
+		for name in 'a.com', 'b.com', 'c.com':
+			self.query(name, lambda q: dns_response(q, [('1.2.3.4', 60)]))
+		self.query('b.com')
+		self.query('d.com', lambda q: dns_response(q, [('1.2.3.4', 60)]))
+		names = list(bytes(key[0]) for key in self.fwd.cache)
+		self.assertEqual(names, [dns_name('b.com'), dns_name('d.com')])
+
+	def test_bad_query(self):
+		self.loop.run_until_complete(self.fwd.on_query(b'\x00' * 5, self.client))
+		self.loop.run_until_complete(self.fwd.on_query(dns_response(dns_query('a.com')), self.client))
+		self.assertEqual(self.fwd.sock.sent, list())
+
+
+if __name__ == '__main__': unittest.main()
@@ -0,0 +1,280 @@
+import os, json, types, struct, socket, asyncio, tempfile, unittest
+from unittest import mock
+
+from helpers import btnap
+
+
+class ConnectRaceTests(unittest.TestCase):
+
+	def test_no_candidates(self):
+		with self.assertRaisesRegex(btnap.BTError, 'No NAP candidates'):
+			btnap.client_connect_race(dict(), 'nap', list())
+		loop = btnap.get_loop()
+		self.assertEqual(loop.run_until_complete(asyncio.sleep(0, 'ok')), 'ok') # loop is not stopped
+
+
+
+class NAPSelectorTests(unittest.TestCase):
+
+	addrs = 'AA:00:00:00:00:01', 'AA:00:00:00:00:02', 'AA:00:00:00:00:03'
+
+	def setUp(self):
+		tmp = tempfile.TemporaryDirectory()
+		self.addCleanup(tmp.cleanup)
+		self.history_file = os.path.join(tmp.name, 'nap-history.json')
+		self.connected, self.objects = set(), dict()
+		for patch in (
+				mock.patch.object(btnap.NAPSelector, 'history_file', self.history_file),
+				mock.patch.object(btnap, 'prop_get', lambda obj, k: obj.object_path in self.connected),
+				mock.patch.object(btnap, 'get_objects', lambda: types.SimpleNamespace(objects=self.objects)) ):
+			patch.start()
+			self.addCleanup(patch.stop)
+		self.devs = dict( (addr, btnap.DBusObject( None, 'org.bluez',
+			'/org/bluez/hci0/dev_' + addr.replace(':', '_') )) for addr in self.addrs )
+
+	def selector(self, *history, **kws):
+		'Returns NAPSelector with history file made from (addr, entry) pairs, if any.'
+		if history:
+			with open(self.history_file, 'w') as dst: json.dump(dict(history), dst)
+		return btnap.NAPSelector(self.devs, 'nap', 0, **kws)
+
+	def set_rssi(self, addr, rssi):
+		self.objects[self.devs[addr].object_path] = {btnap.iface_dev: dict(RSSI=rssi)}
+
+	def test_score_rssi_sources(self):
+		a, b, c = self.addrs
+		sel = self.selector((b, dict(rssi=-70)), (c, dict(rssi=-70)))
+		self.assertEqual(sel.score(a), sel.rssi_default)
+		self.assertEqual(sel.score(b), -70) # from history
+		self.set_rssi(b, -60)
+		self.assertEqual(sel.score(b), -60) # cached in Device1 props
+		sel.rssi[b] = -50
+		self.assertEqual(sel.score(b), -50) # measured on current link
+		self.assertEqual(sel.rank(), [b, c, a])
+
+	def test_score_penalties(self):
+		a, b, c = self.addrs
+		sel = self.selector(
+			(a, dict(rssi=-60, connect=2.0)),
+			(b, dict(rssi=-60, fails=2)),
+			(c, dict(rssi=-60, fails=100)) )
+		self.assertEqual(sel.score(a), -60 - 2 * sel.connect_penalty)
+		self.assertEqual(sel.score(b), -60 - 2 * sel.fail_penalty)
+		self.assertEqual(sel.score(c), -60 - sel.fails_max * sel.fail_penalty)
+		self.assertEqual(sel.rank(), [a, b, c])
+
+	def test_score_rate_bonus(self):
+		a, b, c = self.addrs
+		sel = self.selector(
+			(a, dict(rssi=-60, rate=btnap.NAPSelector.rate_ref * 2)),
+			(b, dict(rssi=-60, rate=btnap.NAPSelector.rate_ref * 1000)),
+			(c, dict(rssi=-60, rate=btnap.NAPSelector.rate_ref / 1000)) )
+		self.assertAlmostEqual(sel.score(a), -57)
+		self.assertEqual((sel.score(b), sel.score(c)), (-54, -66)) # capped at +/- 6 dB
+
+	def test_initial_pick(self):
+		a, b, c = self.addrs
+		history = (a, dict(rssi=-50)), (b, dict(rssi=-80))
+		self.assertEqual(self.selector(*history).current, a)
+		self.connected.add(self.devs[b].object_path)
+		self.assertEqual(self.selector(*history).current, b) # already connected
+
+	def test_history(self):
+		a, b, c = self.addrs
+		sel = self.selector()
+		sel.on_connect(a, 2.0)
+		sel.on_connect(a, 4.0)
+		self.assertAlmostEqual(sel.history[a]['connect'], 2.0 * 0.7 + 4.0 * 0.3)
+		for n in range(3): sel.on_connect(b, None)
+		self.assertEqual(sel.history[b]['fails'], 3)
+		sel.on_connect(b, 1.0)
+		self.assertEqual(sel.history[b], dict(fails=0, connect=1.0))
+		self.assertEqual(self.selector().history, sel.history) # saved and loaded
+
+	def test_check_switch_after(self):
+		a, b, c = self.addrs
+		sel = self.selector((a, dict(rssi=-60)), (b, dict(rssi=-70)), (c, dict(rssi=-95)))
+		sel.link = types.SimpleNamespace(iface=None)
+		sel.current = b
+		with mock.patch.object(sel, 'switch') as switch:
+			for n in range(sel.switch_after - 1): sel.check()
+			self.assertEqual((sel.better, switch.call_count), ((a, sel.switch_after - 1), 0))
+			sel.check()
+			switch.assert_called_once_with(a, 'rank')
+
+	def test_check_margin(self):
+		a, b, c = self.addrs
+		sel = self.selector((a, dict(rssi=-65)), (b, dict(rssi=-70)), margin=6.0)
+		sel.link, sel.current = types.SimpleNamespace(iface=None), b
+		with mock.patch.object(sel, 'switch') as switch:
+			for n in range(sel.switch_after * 2): sel.check()
+			self.assertEqual((sel.better, switch.call_count), ((None, 0), 0))
+
+	def test_failover(self):
+		a, b, c = self.addrs
+		sel = self.selector((a, dict(rssi=-60)), (b, dict(rssi=-70)), (c, dict(rssi=-80)))
+		sel.link, events = object(), list()
+		sel.handlers.append(lambda sel, event, value: events.append((event, value)))
+		with mock.patch.object(sel, 'switch') as switch:
+			sel.on_link(sel.link, 'failed', 'retry')
+			self.assertEqual(switch.call_count, 0) # one more attempt to same NAP
+			sel.on_link(sel.link, 'failed', 'retry')
+			switch.assert_called_once_with(b, 'failure')
+		self.assertEqual(sel.history[a]['fails'], 2)
+		self.assertEqual(events, [('failed', 'retry')] * 2)
+
+	def test_check_rssi_async(self):
+		a, b, c = self.addrs
+		sel = self.selector((a, dict(rssi=-60)), (b, dict(rssi=-70)))
+		sel.link, sel.check_ts, queries = types.SimpleNamespace(iface='bnep0'), btnap.time.monotonic(), list()
+		def query(index, addr, callback):
+			queries.append((addr, callback))
+			return mock.Mock()
+		with mock.patch.object(btnap, 'hci_conn_rssi_query', query), \
+				mock.patch.object(btnap, 'nl_link_get', lambda iface: None):
+			sel.check()
+			self.assertEqual((len(queries), sel.history[a].get('connect')), (1, None))
+			sel.check() # ranks without starting another query
+			self.assertEqual(len(queries), 1)
+			queries[0][1](-40, None)
+		self.assertEqual((sel.rssi[a], sel.rssi_query), (-40, None))
+		self.assertAlmostEqual(sel.history[a]['rssi'], -60 * 0.7 + -40 * 0.3)
+
+	def test_roam_check_rssi_async(self):
+		a, b, c = self.addrs
+		sel = self.selector((a, dict(rssi=-60)), (b, dict(rssi=-70)), roam_rssi=-75)
+		sel.link, sel.current, queries = types.SimpleNamespace(iface='bnep0'), b, list()
+		def query(index, addr, callback):
+			queries.append(callback)
+			return mock.Mock()
+		with mock.patch.object(btnap, 'hci_conn_rssi_query', query), \
+				mock.patch.object(sel, 'roam_start') as roam_start:
+			sel.roam_check()
+			queries.pop()(-70, None)
+			self.assertEqual(roam_start.call_count, 0)
+			sel.roam_check()
+			queries.pop()(None, btnap.BTError('timeout'))
+			sel.roam_check()
+			queries.pop()(-80, None)
+			roam_start.assert_called_once_with([a], 'rssi')
+
+
+class MgmtRequestTests(unittest.TestCase):
+
+	def setUp(self):
+		self.loop = btnap.get_loop()
+		self.sock, self.kernel = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+		self.addCleanup(self.kernel.close)
+		patch = mock.patch.object(btnap, 'hci_socket', lambda channel: self.sock)
+		patch.start()
+		self.addCleanup(patch.stop)
+
+	def request(self):
+		'Starts RSSI query, returning future for its (rssi, err) result.'
+		fut = self.loop.create_future()
+		req = btnap.hci_conn_rssi_query(0, '00:11:22:33:44:55', lambda *res: fut.set_result(res))
+		return req, fut
+
+	def reply(self, ev, index, op, status, params=b''):
+		self.kernel.send( struct.pack('<HHH', ev, index, 3 + len(params))
+			+ struct.pack('<HB', op, status) + params )
+
+	def test_reply(self):
+		req, fut = self.request()
+		cmd = self.kernel.recv(1024)
+		self.assertEqual( cmd, struct.pack('<HHH', btnap.MGMT_OP_GET_CONN_INFO, 0, 7)
+			+ bytes.fromhex('554433221100') + b'\0' )
+		self.reply(btnap.MGMT_EV_INDEX_ADDED, 1, 0, 0) # unrelated event
+		self.reply(btnap.MGMT_EV_CMD_COMPLETE, 0, btnap.MGMT_OP_SET_FAST_CONNECTABLE, 0)
+		self.reply( btnap.MGMT_EV_CMD_COMPLETE, 0, btnap.MGMT_OP_GET_CONN_INFO, 0,
+			cmd[6:] + struct.pack('bbb', -42, 4, 10) )
+		self.assertEqual(self.loop.run_until_complete(fut), (-42, None))
+		self.assertEqual((req.sock, req.timer), (None, None))
+
+	def test_rssi_unavailable(self):
+		req, fut = self.request()
+		cmd = self.kernel.recv(1024)
+		self.reply( btnap.MGMT_EV_CMD_COMPLETE, 0, btnap.MGMT_OP_GET_CONN_INFO, 0,
+			cmd[6:] + struct.pack('bbb', 127, 127, 127) )
+		self.assertEqual(self.loop.run_until_complete(fut), (None, None))
+
+	def test_error_status(self):
+		req, fut = self.request()
+		self.reply(btnap.MGMT_EV_CMD_STATUS, 0, btnap.MGMT_OP_GET_CONN_INFO, 0x02) # not connected
+		rssi, err = self.loop.run_until_complete(fut)
+		self.assertIsInstance(err, btnap.BTError)
+
+	def test_timeout(self):
+		fut = self.loop.create_future()
+		btnap.MgmtRequest( 0, btnap.MGMT_OP_GET_CONN_INFO, bytes(7),
+			lambda *res: fut.set_result(res), timeout=0.01 )
+		reply, err = self.loop.run_until_complete(fut)
+		self.assertEqual((reply, str(err)), (None, 'mgmt command 0x0031 timed out for hci0'))
+		self.assertEqual(self.sock.fileno(), -1) # closed
+
+	def test_cancel(self):
+		req, fut = self.request()
+		req.cancel()
+		self.loop.run_until_complete(asyncio.sleep(0.01))
+		self.assertEqual((fut.done(), self.sock.fileno()), (False, -1))
+
+	def test_socket_error(self):
+		def hci_socket(channel): raise OSError(97, 'Address family not supported')
+		with mock.patch.object(btnap, 'hci_socket', hci_socket):
+			req, fut = self.request()
+		self.assertFalse(fut.done()) # not called from within hci_conn_rssi_query
+		rssi, err = self.loop.run_until_complete(fut)
+		self.assertEqual(err.errno, 97)
+		self.sock.close()
+
+
+class AdapterBalancerTests(unittest.TestCase):
+
+	addrs = '00:AA:00:00:00:00', '00:AA:00:00:00:01'
+
+	def setUp(self):
+		self.props, self.mgmt = dict(), list()
+		self.devs = dict( (addr, btnap.DBusObject(None, 'org.bluez', '/org/bluez/hci{}'.format(n)))
+			for n, addr in enumerate(self.addrs) )
+		for addr, dev in self.devs.items(): self.props[dev.object_path] = dict(Discoverable=True)
+		for patch in (
+				mock.patch.object(btnap, 'prop_get', lambda dev, k: self.props[dev.object_path][k]),
+				mock.patch.object(btnap, 'prop_set', self.prop_set),
+				mock.patch.object( btnap, 'hci_set_connectable',
+					lambda index, state: self.mgmt.append((index, state)) ) ):
+			patch.start()
+			self.addCleanup(patch.stop)
+
+	def prop_set(self, dev, k, v):
+		if k == 'Connectable' and self.connectable_ro:
+			raise btnap.DBusError('org.freedesktop.DBus.Error.PropertyReadOnly')
+		self.props[dev.object_path][k] = v
+
+	def update(self, balancer, *conns):
+		ports = dict( (n, dict(local=addr, rates=dict()))
+			for n, addr in enumerate(addr for addr, k in zip(self.addrs, conns) for m in range(k)) )
+		balancer.update(types.SimpleNamespace(ports=ports))
+
+	def steer(self, connectable_ro=False):
+		'Loads first adapter up to limit and back, returning its properties.'
+		self.connectable_ro = connectable_ro
+		balancer = btnap.AdapterBalancer(self.devs, max_conns=2)
+		a, b = (self.props[dev.object_path] for dev in self.devs.values())
+		self.update(balancer, 2, 1)
+		self.assertEqual(list(balancer.closed), [self.addrs[0]])
+		self.assertEqual(a['Discoverable'], False)
+		self.update(balancer, 2, 2) # no spare adapter to steer clients to
+		self.assertEqual((balancer.closed, a['Discoverable'], b['Discoverable']), (dict(), True, True))
+		return a
+
+	def test_steer_connectable(self):
+		a = self.steer()
+		self.assertEqual((a['Connectable'], self.mgmt), (True, list()))
+
+	def test_steer_mgmt(self):
+		a = self.steer(connectable_ro=True)
+		self.assertNotIn('Connectable', a)
+		self.assertEqual(self.mgmt, [(0, False), (0, True)])
+
+
+if __name__ == '__main__': unittest.main()
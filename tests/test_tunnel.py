@@ -0,0 +1,210 @@
+import json, zlib, unittest
+from unittest import mock
+
+from helpers import btnap
+
+
+class FakeTunnel(object):
+	def __init__(self): self.sent = list()
+	def sendto(self, addr, msg): self.sent.append(bytes(msg))
+
+def packets(n, start=0):
+	return list( json.dumps(dict( ts=1700000000.0 + k * 0.01, seq=k, dev='sensor-{:02d}'.format(k % 8),
+		temp=round(20 + k % 50 / 10, 1), hum=40 + k % 7, status='ok' )).encode() * 2
+		for k in range(start, start + n) )
+
+
+class TunnelTests(unittest.TestCase):
+
+	def setUp(self):
+		# zlib, as in default install without python3-zstandard
+		patch = mock.patch.object(btnap.tunnel_zstd, 'cached_obj', False, create=True)
+		patch.start()
+		self.addCleanup(patch.stop)
+		self.client = btnap.TunnelPeer(FakeTunnel(), None, 'server')
+		self.server = btnap.TunnelPeer(FakeTunnel(), ('10.0.0.2', 5333), 'client')
+		self.addCleanup(self.client.stop)
+		self.addCleanup(self.server.stop)
+
+	def deliver(self, src, dst, drop=()):
+		'Passes messages sent by src peer to dst one, returning decoded packets.'
+		msgs, src.tunnel.sent = src.tunnel.sent, list()
+		pkts = list()
+		for msg in msgs:
+			if msg[0] in drop: continue
+			pkt = dst.recv(msg)
+			if pkt is not None: pkts.append(pkt)
+		return pkts
+
+	def connect(self):
+		self.client.hello()
+		self.deliver(self.client, self.server)
+		self.deliver(self.server, self.client)
+		self.assertTrue(self.client.hello_ok and self.server.hello_ok)
+
+	def send(self, pkts, deliver=True):
+		for pkt in pkts: self.client.send(pkt)
+		if deliver: return self.deliver(self.client, self.server)
+
+	def test_hello(self):
+		self.client.hello()
+		self.assertEqual(self.client.tunnel.sent, [bytes([btnap.TUN_HELLO, 1 << btnap.TUN_ZLIB, 1])])
+		self.deliver(self.client, self.server)
+		self.assertEqual(self.server.tunnel.sent, [bytes([btnap.TUN_HELLO, 1 << btnap.TUN_ZLIB, 0])])
+		self.deliver(self.server, self.client)
+		self.assertTrue(self.client.hello_ok and self.server.hello_ok)
+		self.assertEqual(self.server.tunnel.sent, list()) # no reply to reply
+
+	def test_framing(self):
+		self.connect()
+		pkt = packets(1)[0]
+		self.client.send(pkt)
+		msg = self.client.tunnel.sent[0]
+		self.assertEqual(msg[:2], bytes([btnap.TUN_ZLIB, 0]))
+		self.assertLess(len(msg), len(pkt))
+		self.assertEqual(self.deliver(self.client, self.server), [pkt])
+
+	def test_raw(self):
+		import os
+		pkts = [b'x', os.urandom(1000)]
+		for pkt in pkts: self.client.send(pkt)
+		self.assertEqual([msg[0] for msg in self.client.tunnel.sent], [btnap.TUN_RAW] * 2)
+		self.assertEqual(self.deliver(self.client, self.server), pkts)
+
+	def test_bad_messages(self):
+		for msg in b'\x09abc', bytes([btnap.TUN_ZLIB, 0]) + b'garbage', bytes([btnap.TUN_DICT_ACK]):
+			self.assertIsNone(self.server.recv(msg))
+
+	def test_dict_handshake(self):
+		self.connect()
+		n = self.client.samples_max
+		self.assertEqual(self.send(packets(n - 1)), packets(n - 1))
+		self.send(packets(1, n - 1), deliver=False)
+		msgs = self.client.tunnel.sent
+		dicts = list(msg for msg in msgs if msg[0] == btnap.TUN_DICT)
+		self.assertEqual(len(dicts), 1)
+		self.assertEqual(dicts[0][1:3], bytes([1, btnap.TUN_ZLIB]))
+		self.assertEqual(list(msg[1] for msg in msgs if msg[0] == btnap.TUN_ZLIB), [0]) # not acked yet
+		self.deliver(self.client, self.server)
+		self.assertEqual(self.server.tunnel.sent, [bytes([btnap.TUN_DICT_ACK, 1])])
+		self.deliver(self.server, self.client)
+		self.assertEqual(self.client.tx_dict_id, 1)
+		pkts = packets(50, n)
+		self.assertEqual(self.send(pkts), pkts)
+
+	def test_dict_ack_lost(self):
+		self.connect()
+		self.send(packets(self.client.samples_max))
+		self.server.tunnel.sent.clear() # ack lost
+		self.send(packets(10, 1000))
+		self.assertEqual(self.client.tx_dict_id, 0)
+		self.client.announce() # retry from timer
+		self.deliver(self.client, self.server)
+		self.deliver(self.server, self.client)
+		self.assertEqual((self.client.tx_dict_id, self.client.pending), (1, None))
+		self.client.recv(bytes([btnap.TUN_DICT_ACK, 7])) # stale ack is ignored
+		self.assertEqual(self.client.tx_dict_id, 1)
+
+	def test_dict_compression(self):
+		'Dictionary from recent packets must compress next ones better than plain deflate.'
+		self.connect()
+		n = self.client.samples_max
+		self.send(packets(n))
+		self.deliver(self.server, self.client)
+		self.assertEqual(self.client.tx_dict_id, 1)
+		pkts = packets(100, n)
+		self.send(pkts, deliver=False)
+		wire = sum(len(msg) for msg in self.client.tunnel.sent)
+		plain = sum(len(zlib.compress(pkt)) for pkt in pkts)
+		self.assertLess(wire, plain * 0.6)
+		self.assertEqual(self.deliver(self.client, self.server), pkts)
+
+	def test_peer_restart(self):
+		self.connect()
+		self.send(packets(self.client.samples_max))
+		self.deliver(self.server, self.client)
+		self.server.stop()
+		self.server = btnap.TunnelPeer(FakeTunnel(), ('10.0.0.2', 5333), 'client')
+		self.assertEqual(self.send(packets(1)), list()) # unknown dictionary
+		self.assertEqual(self.server.tunnel.sent[0][0], btnap.TUN_HELLO)
+		self.deliver(self.server, self.client)
+		self.assertEqual(self.client.tx_dict_id, 0)
+		self.deliver(self.client, self.server) # hello reply, retrained dictionary announce
+		self.deliver(self.server, self.client)
+		pkts = packets(10, 5000)
+		self.assertEqual(self.send(pkts), pkts)
+
+	def test_decompression_limit(self):
+		c = zlib.compressobj(9, zlib.DEFLATED, -15)
+		bomb = bytes([btnap.TUN_ZLIB, 0]) + c.compress(bytes(10 << 20)) + c.flush()
+		self.assertLess(len(bomb), 16384)
+		self.assertIsNone(self.server.recv(bomb))
+		pkt = bytes(65536)
+		c = zlib.compressobj(9, zlib.DEFLATED, -15)
+		self.assertEqual(self.server.recv(bytes([btnap.TUN_ZLIB, 0]) + c.compress(pkt) + c.flush()), pkt)
+
+
+class FakeUDPSocket(object):
+	def __init__(self): self.sent, self.recv = list(), list()
+	def sendto(self, msg, addr): self.sent.append((msg, addr))
+	def recvfrom(self, n):
+		if not self.recv: raise BlockingIOError
+		return self.recv.pop(0)
+
+def ip_packet(src, dst):
+	import ipaddress
+	return ( bytes([0x45, 0, 0, 28]) + bytes(8)
+		+ ipaddress.ip_address(src).packed + ipaddress.ip_address(dst).packed + bytes(8) )
+
+
+class CompressTunnelTests(unittest.TestCase):
+
+	def setUp(self):
+		import os
+		# server side without TUN device, with its packets going into a pipe
+		self.tunnel = btnap.CompressTunnel.__new__(btnap.CompressTunnel)
+		self.tunnel.net, self.tunnel.remote = '10.222.0.0/16', None
+		self.tunnel.peers, self.tunnel.routes = dict(), dict()
+		self.tunnel.sock = FakeUDPSocket()
+		self.rfd, self.tunnel.fd = os.pipe()
+		os.set_blocking(self.rfd, False)
+		self.addCleanup(os.close, self.rfd)
+		self.addCleanup(os.close, self.tunnel.fd)
+		self.addCleanup(lambda: [peer.stop() for peer in self.tunnel.peers.values()])
+
+	def deliver(self, addr, *pkts):
+		'Sends packets to tunnel as raw messages from addr, returning ones written to TUN.'
+		import os
+		for pkt in pkts: self.tunnel.sock.recv.append((bytes([btnap.TUN_RAW]) + pkt, addr))
+		self.tunnel.on_sock()
+		try: return os.read(self.rfd, 65536)
+		except BlockingIOError: return b''
+
+	def test_addr(self):
+		self.assertEqual(btnap.tunnel_addr('10.222.0.0/16'), '10.222.0.1/16')
+		addr = btnap.tunnel_addr('10.222.0.0/16', '10.1.2.3')
+		self.assertEqual(addr, btnap.tunnel_addr('10.222.0.0/16', '10.1.2.3'))
+		self.assertNotIn(addr, ['10.222.0.0/16', '10.222.0.1/16', '10.222.255.255/16'])
+
+	def test_route_binding(self):
+		a, b = ('10.0.0.100', 40000), ('10.0.0.101', 40000)
+		ip_a, ip_b = (btnap.tunnel_addr(self.tunnel.net, addr[0]).split('/')[0] for addr in [a, b])
+		pkt = ip_packet(ip_a, '1.1.1.1')
+		self.assertEqual(self.deliver(a, pkt), pkt)
+		self.assertEqual(self.deliver(b, ip_packet(ip_a, '1.1.1.1')), b'') # spoofed source
+		self.assertEqual(self.deliver(b, ip_packet('10.222.9.9', '1.1.1.1')), b'')
+		pkt = ip_packet(ip_b, '1.1.1.1')
+		self.assertEqual(self.deliver(b, pkt), pkt)
+		import ipaddress
+		self.assertIs(self.tunnel.routes[ipaddress.ip_address(ip_a).packed], self.tunnel.peers[a])
+
+	def test_peer_restart(self):
+		a, a2 = ('10.0.0.100', 40000), ('10.0.0.100', 40001)
+		ip = btnap.tunnel_addr(self.tunnel.net, a[0]).split('/')[0]
+		self.deliver(a, ip_packet(ip, '1.1.1.1'))
+		pkt = ip_packet(ip, '1.1.1.1')
+		self.assertEqual(self.deliver(a2, pkt), pkt) # new source port from same client
+		self.assertEqual(list(self.tunnel.peers), [a2])
+
+
+if __name__ == '__main__': unittest.main()